@@ -1,12 +1,28 @@
 # -*- coding: utf-8 -*-
 from django.conf import settings
 from django.test.simple import DjangoTestSuiteRunner
+from mongoengine import connect
+from mongoengine.connection import _get_db
 
 import coverage
 
 
 class CoverageRunner(DjangoTestSuiteRunner):
 
+    def setup_databases(self, **kwargs):
+        # The documents go to a MongoDB database of their own as well
+        old_db = _get_db().name
+        connect('test_%s' % old_db)
+        _get_db().connection.drop_database(_get_db().name)
+        old_config = super(CoverageRunner, self).setup_databases(**kwargs)
+        return old_config, old_db
+
+    def teardown_databases(self, old_config, **kwargs):
+        old_config, old_db = old_config
+        super(CoverageRunner, self).teardown_databases(old_config, **kwargs)
+        _get_db().connection.drop_database(_get_db().name)
+        connect(old_db)
+
     def run_tests(self, *args, **kwargs):
         run_with_coverage = hasattr(settings, 'COVERAGE_MODULES')
 
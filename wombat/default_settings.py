@@ -89,6 +89,62 @@ LOGIN_URL = '/'
 LOGIN_REDIRECT_URL = '/mail/'
 AUTH_PROFILE_MODULE = 'users.Profile'
 
+# IMAP connection pool: idle connections kept per account, seconds before an
+# idle connection is dropped, seconds before it is checked with a NOOP and
+# seconds to wait for a busy connection before opening an extra one.
+IMAP_POOL_SIZE = 2
+IMAP_POOL_IDLE_TIMEOUT = 300
+IMAP_POOL_CHECK_AFTER = 10
+IMAP_POOL_WAIT = 5
+
+# Sync daemon (manage.py syncmail): worker threads, concurrent jobs per IMAP
+# server and per account (at most IMAP_POOL_SIZE to reuse the connections),
+# seconds between two syncs of an account (or of an account whose owner did
+# something in the last SYNC_ACTIVE_TIMEOUT seconds) and between two logs of
+# the counters of the daemon, of the connection pool and of the body cache.
+SYNC_THREADS = 4
+SYNC_PER_SERVER = 2
+SYNC_PER_ACCOUNT = 2
+SYNC_INTERVAL = 900
+SYNC_ACTIVE_INTERVAL = 120
+SYNC_ACTIVE_TIMEOUT = 1800
+SYNC_STATS_INTERVAL = 3600
+
+# Initial import of large folders: UIDs fetched per FETCH command and number
+# of fetched windows waiting to be stored.
+IMAP_FETCH_WINDOW = 500
+IMAP_FETCH_QUEUE = 2
+
+# Size of the chunks fetched when downloading an attachment.
+IMAP_CHUNK_SIZE = 65536
+
+# Bytes of message bodies kept in MongoDB per account. The least recently
+# read bodies are evicted when the account is checked, and downloaded again
+# when needed.
+BODY_CACHE_SIZE = 50 * 1024 * 1024
+
+# Prefetching of the content of the messages before someone opens them:
+# most recent unread threads of each inbox, after each sync, and bytes that
+# can be prefetched per account and per hour.
+SYNC_PREFETCH_THREADS = 20
+SYNC_PREFETCH_BUDGET = 10 * 1024 * 1024
+
+# Seconds the number of threads of a listing is cached.
+THREAD_COUNT_TIMEOUT = 60
+
+# Seconds the folder sidebar of a user is cached. It's invalidated by the
+# sync when the folders or their counts change.
+SIDEBAR_TIMEOUT = 3600
+
+# Flushes of the pending flag changes (see mail.outbox) after which the
+# changes refused by the server are dropped.
+FLAG_OUTBOX_ATTEMPTS = 5
+
+# Set to True when running the IDLE listener (manage.py idlemail): the sync
+# daemon then stops polling the inboxes the listener keeps in IDLE.
+IMAP_IDLE = False
+IMAP_IDLE_MAX_SESSIONS = 500
+
 
 AUTHENTICATION_BACKENDS = (
     'mail.backends.EmailAuthBackend',
@@ -106,19 +162,34 @@ LANGUAGES = (
 # Test settings
 TEST_RUNNER = 'coverage_runner.CoverageRunner'
 
+# Run the benchmarks of the test suite (slow)
+RUN_BENCHMARKS = False
+
 COVERAGE_MODULES = [
     'users.admin',
     'users.forms',
     'users.models',
     'users.views',
 
+    'mail.actions',
     'mail.admin',
     'mail.backends',
     'mail.forms',
+    'mail.idle',
+    'mail.mime',
     'mail.models',
     'mail.models.imap',
+    'mail.models.mongo',
     'mail.models.smtp',
+    'mail.outbox',
+    'mail.paging',
+    'mail.pool',
+    'mail.search',
+    'mail.sidebar',
+    'mail.sync',
+    'mail.threader',
     'mail.templatetags.mail_tags',
+    'mail.utils',
     'mail.views',
 ]
 
@@ -0,0 +1,350 @@
+# -*- coding: utf-8 -*-
+"""
+Actions on threads: marking them as read or unread, moving and deleting
+them.
+
+An action applies to any number of threads of an account at once. Their
+messages are grouped by mailbox, and each mailbox costs a few commands with
+compact UID sets (``1:500,702``) over a single pooled connection:
+
+* Flags are changed with UID STORE.
+* Messages are moved with UID MOVE (RFC 6851) if the server supports it,
+  with UID COPY, UID STORE \\Deleted and UID EXPUNGE otherwise.
+* Deleted messages are expunged with UID EXPUNGE (UIDPLUS, RFC 4315), which
+  leaves alone the other messages flagged as deleted in the folder. Servers
+  without UIDPLUS get a plain EXPUNGE.
+
+The threads are then updated in the DB from the UIDs we know and from the
+UIDs the server gave to the moved messages (COPYUID), instead of resyncing
+the folders.
+"""
+import imaplib
+
+import imapclient
+
+from django.db.models import F
+
+from mail.models import Mailbox, Thread, NORMAL, INBOX, SPAM, TRASH
+from mail.utils import has_capability, uid_ranges, encode_folder_name, \
+                       parse_copyuid, discard_expunges
+
+READ = 'read'
+UNREAD = 'unread'
+MOVE = 'move'
+DELETE = 'delete'
+ACTIONS = (READ, UNREAD, MOVE, DELETE)
+
+# Messages are only moved out of these folders: not out of the outbox, the
+# drafts, the queue or Gmail's special folders.
+MOVABLE = (NORMAL, INBOX, SPAM, TRASH)
+
+# Maximum number of UIDs per command
+CHUNK = 1000
+
+
+def _chunks(uids):
+    uids = sorted(uids)
+    for i in range(0, len(uids), CHUNK):
+        yield uids[i:i + CHUNK]
+
+
+def _uid_command(m, command, *args):
+    """
+    Runs ``UID <command>`` and returns the data of its tagged response.
+    """
+    typ, data = m._imap._simple_command('UID', command, *args)
+    if typ != 'OK':
+        raise imaplib.IMAP4.error('UID %s failed: %s' % (command, data))
+    return data
+
+
+def store_flags(m, uids, flag, add=True):
+    item = add and '+FLAGS.SILENT' or '-FLAGS.SILENT'
+    for chunk in _chunks(uids):
+        _uid_command(m, 'STORE', uid_ranges(chunk), item, '(%s)' % flag)
+
+
+def _expunge(m, uids):
+    """
+    Expunges the messages ``uids``, flagged as deleted.
+    """
+    if has_capability(m, 'UIDPLUS'):
+        for chunk in _chunks(uids):
+            _uid_command(m, 'EXPUNGE', uid_ranges(chunk))
+    else:
+        m.expunge()
+    discard_expunges(m)
+
+
+def _move(m, uids, destination):
+    """
+    Moves the messages ``uids`` of the selected folder to ``destination``.
+    Returns the {UID: UID in destination} mapping sent by the server, empty
+    if it doesn't support UIDPLUS.
+    """
+    folder = encode_folder_name(m, destination.name)
+    moved = {}
+    if has_capability(m, 'MOVE'):
+        for chunk in _chunks(uids):
+            data = _uid_command(m, 'MOVE', uid_ranges(chunk), folder)
+            # Sent before the expunges, in an untagged OK response
+            untagged = m._imap.untagged_responses.pop('COPYUID', [])
+            moved.update(parse_copyuid(untagged + data))
+        discard_expunges(m)
+        return moved
+
+    for chunk in _chunks(uids):
+        data = _uid_command(m, 'COPY', uid_ranges(chunk), folder)
+        moved.update(parse_copyuid(data))
+    store_flags(m, uids, imapclient.DELETED)
+    _expunge(m, uids)
+    return moved
+
+
+def _run(groups, operation, connection=None):
+    """
+    Selects each mailbox of ``groups`` ({mailbox id: UIDs}) and calls
+    ``operation(m, mailbox, uids)``. Returns False if the account could not
+    be reached.
+
+    The mailboxes aren't closed: CLOSE would expunge every message flagged
+    as deleted. The next SELECT leaves them as they are.
+    """
+    mailboxes = list(Mailbox.objects.filter(id__in=groups.keys()))
+    if not mailboxes:
+        return True
+    imap = mailboxes[0].imap
+    if connection is None:
+        m = imap.get_connection()
+    else:
+        m = connection
+    if m is None:
+        return False
+
+    discard = True
+    try:
+        for mailbox in mailboxes:
+            m.select_folder(mailbox.name)
+            operation(m, mailbox, groups[mailbox.id])
+        discard = False
+    finally:
+        if connection is None:
+            imap.release_connection(m, discard=discard)
+    return True
+
+
+def _expunged(counts):
+    """
+    Keeps the number of synchronized messages of each mailbox ({mailbox id:
+    number of expunged messages}) in line with the server, so that the
+    next sync doesn't look for the missing messages.
+    """
+    for mbox_id, count in counts.items():
+        Mailbox.objects.filter(pk=mbox_id, synced_messages__gte=count).update(
+            synced_messages=F('synced_messages') - count)
+
+
+def _remove(threads, groups, gained=None):
+    """
+    Removes the messages of ``groups`` ({mailbox id: UIDs}) from
+    ``threads``. The threads that lose all their messages are deleted with
+    a single query.
+
+    The unread counts of the mailboxes lose the unread messages removed from
+    them, plus ``gained`` ({mailbox id: number}), and the sidebars are
+    invalidated (see ``mail.outbox``).
+    """
+    from mail.outbox import _adjust_unread
+    removed = set()
+    for mbox_id, uids in groups.items():
+        removed.update([(mbox_id, uid) for uid in uids])
+    counts = dict(gained or {})
+    for thread in threads:
+        for msg in thread.messages:
+            if msg.read:
+                continue
+            for mbox_id, uid in msg.uids:
+                if (mbox_id, uid) in removed:
+                    counts[mbox_id] = counts.get(mbox_id, 0) - 1
+    empty = []
+    for thread in threads:
+        if all([tuple(pair) in removed for msg in thread.messages
+                for pair in msg.uids]):
+            empty.append(thread.id)
+            thread.messages = []
+            continue
+        for mbox_id, uids in groups.items():
+            if not thread.messages:
+                # Deleted
+                break
+            if mbox_id in thread.mailboxes:
+                thread.remove_message(mbox_id,
+                                      [[mbox_id, uid] for uid in uids])
+    if empty:
+        Thread.objects(id__in=empty).delete()
+
+    counts = dict([(mbox_id, count) for mbox_id, count in counts.items()
+                   if count])
+    if counts:
+        imap_ids = set(Mailbox.objects.filter(
+            id__in=counts.keys()).values_list('imap', flat=True))
+        _adjust_unread(imap_ids, counts)
+
+
+def mark_read(threads, read=True, connection=None):
+    """
+    Marks the messages of ``threads`` as read (or unread if ``read`` is
+    False), on the server and in the DB.
+    """
+    groups = {}
+    for thread in threads:
+        for msg in thread.messages:
+            if msg.read == read:
+                continue
+            for mbox_id, uid in msg.uids:
+                groups.setdefault(mbox_id, []).append(uid)
+    if not groups:
+        return True
+
+    def store(m, mailbox, uids):
+        store_flags(m, uids, imapclient.SEEN, add=read)
+    if not _run(groups, store, connection):
+        return False
+
+    spec = {'_id': {'$in': [thread.id for thread in threads]}}
+    for mbox_id, uids in groups.items():
+        Thread.set_flags(mbox_id, dict([(uid, read) for uid in uids]), spec)
+    for thread in threads:
+        for msg in thread.messages:
+            msg.read = read
+        thread.update_summary()
+    return True
+
+
+def delete(threads, connection=None):
+    """
+    Deletes the messages of ``threads`` from every mailbox, on the server and
+    in the DB.
+    """
+    groups = {}
+    for thread in threads:
+        for msg in thread.messages:
+            for mbox_id, uid in msg.uids:
+                groups.setdefault(mbox_id, []).append(uid)
+    if not groups:
+        return True
+
+    def expunge(m, mailbox, uids):
+        store_flags(m, uids, imapclient.DELETED)
+        _expunge(m, uids)
+    if not _run(groups, expunge, connection):
+        return False
+
+    _remove(threads, groups)
+    _expunged(dict([(mbox_id, len(uids)) for mbox_id, uids
+                    in groups.items()]))
+    return True
+
+
+def move(threads, destination, connection=None):
+    """
+    Moves the messages of ``threads`` to the mailbox ``destination``. A
+    message stored in several mailboxes is moved from the first one and
+    deleted from the others, except from the mailboxes that aren't
+    ``MOVABLE``.
+    """
+    movable = set(Mailbox.objects.filter(imap=destination.imap_id,
+                                         folder_type__in=MOVABLE).exclude(
+        pk=destination.pk).values_list('id', flat=True))
+    to_move = {}
+    to_delete = {}
+    for thread in threads:
+        for msg in thread.messages:
+            uids = [pair for pair in msg.uids if pair[0] in movable]
+            if not uids:
+                continue
+            if destination.pk not in msg.mailboxes:
+                mbox_id, uid = uids.pop(0)
+                to_move.setdefault(mbox_id, []).append(uid)
+            for mbox_id, uid in uids:
+                to_delete.setdefault(mbox_id, []).append(uid)
+
+    moved = {}  # (mailbox id, uid) -> uid in destination
+
+    def move_and_delete(m, mailbox, uids):
+        if mailbox.id in to_move:
+            for uid, new_uid in _move(m, to_move[mailbox.id],
+                                      destination).items():
+                moved[(mailbox.id, uid)] = new_uid
+        if mailbox.id in to_delete:
+            store_flags(m, to_delete[mailbox.id], imapclient.DELETED)
+            _expunge(m, to_delete[mailbox.id])
+
+    groups = dict([(mbox_id, None) for mbox_id in to_move.keys() +
+                   to_delete.keys()])
+    if not groups:
+        return True
+    m = connection
+    if m is None:
+        m = destination.imap.get_connection()
+        if m is None:
+            return False
+    discard = True
+    try:
+        if not _run(groups, move_and_delete, m):
+            return False
+
+        # The moved messages get their new UID before losing the old one,
+        # they stay in their thread.
+        collection = Thread.objects._collection
+        gained = 0  # Unread messages in the destination
+        for thread in threads:
+            for msg in thread.messages:
+                for mbox_id, uid in msg.uids:
+                    new_uid = moved.get((mbox_id, uid))
+                    if new_uid is None:
+                        continue
+                    if not msg.read:
+                        gained += 1
+                    pair = [destination.pk, new_uid]
+                    msg.uids.append(pair)
+                    collection.update(
+                        {'_id': thread.id, 'messages.oid': msg.oid},
+                        {'$addToSet': {'messages.$.uids': pair,
+                                       'mailboxes': destination.pk}})
+                    break
+            thread.update_mailboxes()
+
+        removed = {}
+        for group in (to_move, to_delete):
+            for mbox_id, uids in group.items():
+                removed.setdefault(mbox_id, []).extend(uids)
+        _remove(threads, removed, {destination.pk: gained})
+        _expunged(dict([(mbox_id, len(uids)) for mbox_id, uids
+                        in removed.items()]))
+
+        if len(moved) < sum([len(uids) for uids in to_move.values()]):
+            # The server didn't tell where some of the messages went
+            destination.update_messages(connection=m)
+        discard = False
+    finally:
+        if connection is None:
+            destination.imap.release_connection(m, discard=discard)
+    return True
+
+
+def apply_action(threads, action, destination=None, connection=None):
+    """
+    Applies one of the ``ACTIONS`` to ``threads``, all in the same account.
+    ``destination`` is the mailbox to move them to. Returns False if the
+    account could not be reached.
+    """
+    if action == READ:
+        return mark_read(threads, True, connection)
+    elif action == UNREAD:
+        return mark_read(threads, False, connection)
+    elif action == DELETE:
+        return delete(threads, connection)
+    elif action == MOVE:
+        return move(threads, destination, connection)
+    raise ValueError('Unknown action: %s' % action)
@@ -3,7 +3,8 @@
 from django import forms
 from django.utils.translation import ugettext_lazy as _
 
-from mail.models import NORMAL, INBOX
+from mail.actions import ACTIONS, MOVE
+from mail.models import Mailbox, NORMAL, INBOX
 
 
 class MailForm(forms.Form):
@@ -54,3 +55,37 @@ class MoveForm(ActionForm):
             if exclude is not None and directory == exclude:
                 continue
             yield ('%s' % directory.id, u'%s' % directory.name)
+
+
+class BulkActionForm(forms.Form):
+    """
+    Action on the threads checked in a listing. The destination of a move
+    can be in any account of the profile.
+    """
+    action = forms.ChoiceField(choices=[(a, a) for a in ACTIONS])
+    destination = forms.TypedChoiceField(coerce=lambda x: int(x),
+                                         required=False, empty_value=None)
+
+    def __init__(self, profile, **kwargs):
+        super(BulkActionForm, self).__init__(**kwargs)
+        self.fields['destination'].choices = self._get_dirs(profile)
+
+    def _get_dirs(self, profile):
+        yield ('', _('Move to...'))
+        mailboxes = Mailbox.objects.filter(imap__account__profile=profile,
+                                           no_select=False,
+                                           folder_type__in=(NORMAL, INBOX))
+        mailboxes = list(mailboxes.select_related('imap__account').order_by(
+            'imap', 'folder_type', 'name'))
+        several = len(set([m.imap_id for m in mailboxes])) > 1
+        for directory in mailboxes:
+            name = directory.name
+            if several:
+                name = u'%s: %s' % (directory.imap.account.name, name)
+            yield ('%s' % directory.id, name)
+
+    def clean(self):
+        data = self.cleaned_data
+        if data.get('action') == MOVE and data.get('destination') is None:
+            raise forms.ValidationError(_('Choose a destination'))
+        return data
@@ -0,0 +1,228 @@
+# -*- coding: utf-8 -*-
+"""
+IMAP IDLE (RFC 2177) listener.
+
+One thread per active account keeps a dedicated connection in IDLE on the
+INBOX. When the server reports new (EXISTS), expunged (EXPUNGE) or modified
+(FETCH) messages, an incremental sync of the INBOX is queued for the sync
+daemon, which fetches only what changed.
+
+The inboxes with a live session are recorded as IdleMailbox documents, the
+sync daemon doesn't poll them (see IMAP_IDLE).
+"""
+import logging
+import resource
+import socket
+import ssl
+import threading
+import time
+
+from django.conf import settings
+
+from mail.models import IdleMailbox, INBOX
+from mail.pool import connect
+from mail.utils import has_capability
+from mail.sync import enqueue, active_accounts, UPDATE, ACTIVE, INBOX_BONUS
+
+logger = logging.getLogger('wombat.idle')
+
+# Servers may drop connections idling for more than 30 minutes
+IDLE_TIMEOUT = 29 * 60
+
+# Notifications arriving within this delay are handled in one sync
+DEBOUNCE = 1
+
+# File descriptors kept for the rest of the process (DB, logs...)
+RESERVED_FDS = 64
+
+
+def capacity():
+    """
+    Returns the number of IDLE sessions this process can sustain: each one
+    uses a thread and a socket, bounded by IMAP_IDLE_MAX_SESSIONS and by the
+    limit of open files.
+    """
+    soft, hard = resource.getrlimit(resource.RLIMIT_NOFILE)
+    limit = getattr(settings, 'IMAP_IDLE_MAX_SESSIONS', 500)
+    if soft != resource.RLIM_INFINITY:
+        limit = min(limit, soft - RESERVED_FDS)
+    return max(limit, 0)
+
+
+class IdleSession(threading.Thread):
+    """
+    Keeps the INBOX of an account in IDLE until ``stop`` is called.
+    """
+
+    class Error(Exception):
+        pass
+
+    def __init__(self, mailbox):
+        super(IdleSession, self).__init__()
+        self.setDaemon(True)
+        self.mailbox = mailbox
+        self.imap = mailbox.imap
+        self.stopped = threading.Event()
+        self.supported = True
+        self.listening = False
+        self.notifications = 0
+
+    def stop(self):
+        self.stopped.set()
+
+    def run(self):
+        failures = 0
+        while not self.stopped.isSet():
+            try:
+                self.listen()
+                failures = 0
+            except (socket.error, ssl.SSLError, self.Error), e:
+                failures += 1
+                logger.warning('IDLE on %s failed: %s' % (self.mailbox, e))
+                self.stopped.wait(min(2 ** failures, 300))
+
+    def listen(self):
+        m = connect(self.imap)
+        if m is None:
+            raise self.Error('login failed')
+
+        try:
+            if not has_capability(m, 'IDLE'):
+                # No push, the sync daemon polls this account
+                logger.info('%s does not support IDLE' % self.imap.server)
+                self.supported = False
+                self.stopped.set()
+                return
+
+            m.select_folder(self.mailbox.name, readonly=True)
+            self.listening = True
+            # Catching up with what happened before we were listening
+            self.notify()
+            while not self.stopped.isSet():
+                if self.idle(m._imap):
+                    self.notify()
+        finally:
+            self.listening = False
+            try:
+                m.logout()
+            except (socket.error, ssl.SSLError):
+                pass
+
+    def idle(self, imap):
+        """
+        Sends IDLE on a raw imaplib connection, waits for a notification and
+        ends the IDLE command. Returns True if something has changed.
+        """
+        tag = imap._new_tag()
+        imap.send('%s IDLE\r\n' % tag)
+        if not imap.readline().startswith('+'):
+            raise self.Error('IDLE refused')
+
+        sock = getattr(imap, 'sslobj', None) or imap.sock
+        changed = False
+        deadline = time.time() + IDLE_TIMEOUT
+        try:
+            while not self.stopped.isSet():
+                if changed:
+                    timeout = DEBOUNCE
+                else:
+                    # Waking up regularly to check if we should stop
+                    timeout = min(deadline - time.time(), 30)
+                    if timeout <= 0:
+                        break
+                sock.settimeout(timeout)
+                try:
+                    line = imap.readline()
+                except (socket.timeout, ssl.SSLError):
+                    if changed:
+                        break
+                    continue
+                if not line:
+                    raise self.Error('connection closed')
+                tokens = line.split()
+                if len(tokens) > 2 and tokens[0] == '*' and \
+                   tokens[2].upper() in ('EXISTS', 'EXPUNGE', 'FETCH'):
+                    changed = True
+        finally:
+            sock.settimeout(None)
+
+        imap.send('DONE\r\n')
+        while True:
+            line = imap.readline()
+            if not line:
+                raise self.Error('connection closed')
+            if line.startswith(tag):
+                break
+        return changed
+
+    def notify(self):
+        self.notifications += 1
+        enqueue(UPDATE, self.imap, mailbox=self.mailbox,
+                priority=ACTIVE - INBOX_BONUS)
+
+
+class IdleListener(object):
+    """
+    Maintains one ``IdleSession`` per active account, up to ``max_sessions``
+    sessions.
+    """
+
+    def __init__(self, max_sessions=None, refresh=60):
+        if max_sessions is None:
+            max_sessions = capacity()
+        self.max_sessions = max_sessions
+        self.refresh = refresh
+        self.sessions = {}  # mailbox id -> IdleSession
+        self.unsupported = set()  # mailbox ids on servers without IDLE
+        self.covered = set()  # mailbox ids recorded as IdleMailbox
+
+    def stats(self):
+        return {
+            'sessions': len(self.sessions),
+            'capacity': self.max_sessions,
+            'notifications': sum([s.notifications for s in
+                                  self.sessions.values()]),
+        }
+
+    def run(self):
+        while True:
+            self.update_sessions()
+            time.sleep(self.refresh)
+
+    def update_sessions(self):
+        """
+        Starts sessions for the accounts that became active and stops the
+        others. The inboxes whose session is listening are recorded for
+        three refresh periods.
+        """
+        inboxes = {}
+        for imap in active_accounts():
+            for mailbox in imap.directories.filter(folder_type=INBOX,
+                                                   no_select=False):
+                inboxes[mailbox.pk] = mailbox
+
+        for mbox_id, session in self.sessions.items():
+            if not session.supported:
+                self.unsupported.add(mbox_id)
+            if mbox_id not in inboxes or not session.isAlive():
+                session.stop()
+                del self.sessions[mbox_id]
+
+        for mbox_id, mailbox in inboxes.items():
+            if mbox_id in self.sessions or mbox_id in self.unsupported:
+                continue
+            if len(self.sessions) >= self.max_sessions:
+                logger.warning('Too many IDLE sessions (%s), %s is polled' %
+                               (self.max_sessions, mailbox))
+                break
+            session = IdleSession(mailbox)
+            session.start()
+            self.sessions[mbox_id] = session
+
+        listening = [mbox_id for mbox_id, s in self.sessions.items()
+                     if s.listening]
+        IdleMailbox.renew(listening, 3 * self.refresh)
+        # The others are polled again right away
+        IdleMailbox.objects(mailbox__in=list(self.covered -
+                                             set(listening))).delete()
+        self.covered = set(listening)
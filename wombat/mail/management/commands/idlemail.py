@@ -0,0 +1,32 @@
+import logging
+from optparse import make_option
+
+from django.core.management.base import NoArgsCommand
+
+from mail.idle import IdleListener, capacity
+
+
+class Command(NoArgsCommand):
+    help = ('Keeps an IMAP IDLE session on the inbox of every active account '
+            'and queues a sync when something changes.')
+    option_list = NoArgsCommand.option_list + (
+        make_option('--max-sessions', type='int', dest='max_sessions',
+                    help='Maximum number of IDLE sessions'),
+        make_option('--capacity', action='store_true', dest='capacity',
+                    default=False,
+                    help='Print the number of sessions this process can '
+                         'sustain and exit'),
+    )
+
+    def handle_noargs(self, **options):
+        if options['capacity']:
+            print capacity()
+            return
+
+        logging.basicConfig(level=logging.INFO)
+        listener = IdleListener(max_sessions=options['max_sessions'])
+        logging.info('Up to %s IDLE sessions' % listener.max_sessions)
+        try:
+            listener.run()
+        except KeyboardInterrupt:
+            pass
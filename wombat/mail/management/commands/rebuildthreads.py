@@ -0,0 +1,30 @@
+from django.core.management.base import NoArgsCommand
+
+from mail.models import Mailbox, Thread, MessageBody
+
+
+class Command(NoArgsCommand):
+    help = ('Rebuilds the summary and the search keywords of every thread, '
+            'for threads stored by an older version of wombat. Bodies '
+            'stored in the threads are moved to their own collection.')
+
+    def handle_noargs(self, **options):
+        for data in Thread.objects._collection.find():
+            thread = Thread.objects.with_id(data['_id'])
+            fetched = []
+            for message, msg_data in zip(thread.messages,
+                                         data.get('messages', [])):
+                message.body = msg_data.get('body')
+                message.html_body = msg_data.get('html_body')
+                if message.body or message.html_body:
+                    message.fetched = True
+                    fetched.append(message)
+            if fetched:
+                mailboxes = Mailbox.objects.filter(id__in=thread.mailboxes)
+                uidvalidities = dict(mailboxes.values_list('id',
+                                                           'uidvalidity'))
+                imap_id = mailboxes.values_list('imap', flat=True)[0]
+                MessageBody.store(imap_id, fetched, uidvalidities)
+            thread.update_summary()
+            thread.update_keywords()
+            thread.save(safe=True)
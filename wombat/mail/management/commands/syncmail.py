@@ -0,0 +1,74 @@
+import logging
+import multiprocessing
+from optparse import make_option
+
+from django.conf import settings
+from django.core.management.base import NoArgsCommand, CommandError
+from django.db import connection
+from mongoengine.connection import _get_db
+
+from mail.sync import SyncDaemon
+
+
+def run_daemon(options, partition=None):
+    logging.basicConfig(level=logging.INFO)
+    per_server = options['per_server']
+    if partition is not None:
+        # Connections inherited from the parent can't be shared
+        connection.close()
+        _get_db(reconnect=True)
+        # Splitting the connections allowed per server between the
+        # processes, see Command.handle_noargs
+        per_server = per_server / partition[1]
+    daemon = SyncDaemon(threads=options['threads'], per_server=per_server,
+                        per_account=options['per_account'],
+                        partition=partition)
+    try:
+        daemon.run(once=options['once'])
+    except KeyboardInterrupt:
+        pass
+
+
+class Command(NoArgsCommand):
+    help = 'Runs the queued IMAP jobs and keeps the accounts in sync.'
+    option_list = NoArgsCommand.option_list + (
+        make_option('--threads', type='int', dest='threads',
+                    help='Number of worker threads (per process)'),
+        make_option('--per-server', type='int', dest='per_server',
+                    help='Maximum number of concurrent jobs per IMAP server'),
+        make_option('--per-account', type='int', dest='per_account',
+                    help='Maximum number of concurrent jobs per account'),
+        make_option('--processes', type='int', dest='processes', default=1,
+                    help='Number of processes sharing the accounts'),
+        make_option('--once', action='store_true', dest='once',
+                    default=False,
+                    help='Run the queued jobs and exit'),
+    )
+
+    def handle_noargs(self, **options):
+        count = options['processes']
+        if count <= 1:
+            run_daemon(options)
+            return
+
+        if options['per_server'] is None:
+            options['per_server'] = getattr(settings, 'SYNC_PER_SERVER', 2)
+        if count > options['per_server']:
+            # Each process needs at least one connection per server
+            raise CommandError('%s processes would open more than %s '
+                               'connections per server, use at most %s '
+                               'processes or raise --per-server.' % (
+                                   count, options['per_server'],
+                                   options['per_server']))
+        processes = []
+        for index in range(count):
+            process = multiprocessing.Process(target=run_daemon,
+                                              args=(options, (index, count)))
+            process.start()
+            processes.append(process)
+        try:
+            for process in processes:
+                process.join()
+        except KeyboardInterrupt:
+            for process in processes:
+                process.terminate()
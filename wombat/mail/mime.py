@@ -0,0 +1,314 @@
+# -*- coding: utf-8 -*-
+"""
+MIME structure of the messages.
+
+The structure of each message is known from the BODYSTRUCTURE fetched with
+its headers (RFC 3501, section 7.4.2). When a message is displayed, only its
+text parts are downloaded with ``BODY.PEEK[part]``: attachments are
+described by their metadata and downloaded when someone asks for them.
+"""
+import base64
+import binascii
+import email.parser
+import quopri
+
+from mail.utils import clean_header
+
+# The parts displayed as the content of a message, the others are
+# attachments
+TEXT_TYPES = ('text/plain', 'text/html')
+
+
+def _params(params):
+    """
+    Converts a body parameter list, ('NAME', 'value', ...), to a dict with
+    lowercased keys.
+    """
+    if not isinstance(params, (list, tuple)):
+        return {}
+    return dict([(params[i].lower(), params[i + 1])
+                 for i in range(0, len(params) - 1, 2)])
+
+
+def parse_bodystructure(structure, prefix=''):
+    """
+    Returns the leaves of a BODYSTRUCTURE response as a list of dicts:
+
+        * part: the section number, for BODY[part]
+        * content_type: lowercased, 'text/plain'
+        * charset, encoding (lowercased) and size (encoded, in bytes)
+        * filename: None if the part has no name
+        * attachment: True if the part isn't a text to display
+
+    Encapsulated messages (message/rfc822) are attachments, their own parts
+    aren't listed.
+    """
+    if not structure:
+        return []
+
+    if isinstance(structure[0], (list, tuple)):
+        # multipart: (part, part, ..., subtype, extension data)
+        parts = []
+        number = 0
+        for child in structure:
+            if not isinstance(child, (list, tuple)):
+                break
+            number += 1
+            parts.extend(parse_bodystructure(child, '%s%s.' % (prefix,
+                                                                number)))
+        return parts
+
+    main_type = (structure[0] or '').lower()
+    sub_type = (structure[1] or '').lower()
+    params = _params(structure[2])
+
+    # The disposition is after the type-specific fields and the MD5
+    extension = 8
+    if main_type == 'text':
+        extension = 9
+    elif main_type == 'message' and sub_type == 'rfc822':
+        extension = 11
+    disposition = None
+    disposition_params = {}
+    if len(structure) > extension and \
+       isinstance(structure[extension], (list, tuple)) and \
+       structure[extension]:
+        disposition = (structure[extension][0] or '').lower()
+        if len(structure[extension]) > 1:
+            disposition_params = _params(structure[extension][1])
+
+    filename = disposition_params.get('filename') or params.get('name')
+    if filename is not None:
+        filename = clean_header(filename)
+
+    content_type = '%s/%s' % (main_type, sub_type)
+    try:
+        size = int(structure[6])
+    except (IndexError, TypeError, ValueError):
+        size = 0
+    return [{
+        'part': prefix and prefix[:-1] or '1',
+        'content_type': content_type,
+        'charset': params.get('charset'),
+        'encoding': (structure[5] or '7bit').lower(),
+        'size': size,
+        'filename': filename,
+        'attachment': (content_type not in TEXT_TYPES or
+                       disposition == 'attachment'),
+    }]
+
+
+def decode_text(data, charset=None):
+    """
+    Decodes a string with its declared charset, falling back to UTF-8 and
+    latin-1 if the charset is unknown or wrong.
+    """
+    if isinstance(data, unicode):
+        return data
+    for candidate in (charset, 'utf-8'):
+        if not candidate:
+            continue
+        try:
+            return data.decode(candidate)
+        except (LookupError, UnicodeDecodeError):
+            pass
+    return data.decode('latin-1')
+
+
+def decode_part(data, encoding, charset=None):
+    """
+    Decodes the content of a text part given its transfer encoding and its
+    charset.
+    """
+    if encoding == 'base64':
+        try:
+            data = base64.decodestring(data)
+        except binascii.Error:
+            pass
+    elif encoding == 'quoted-printable':
+        data = quopri.decodestring(data)
+    return decode_text(data, charset)
+
+
+class IdentityDecoder(object):
+    """
+    Decoder for the 7bit, 8bit and binary transfer encodings.
+    """
+
+    def decode(self, data):
+        return data
+
+    def flush(self):
+        return ''
+
+
+class Base64Decoder(object):
+    """
+    Decodes base64 data fed by chunks of any size: the characters that
+    don't make a full quantum are kept for the next chunk.
+    """
+
+    def __init__(self):
+        self.pending = ''
+
+    def decode(self, data):
+        data = self.pending + ''.join(data.split())
+        end = len(data) - len(data) % 4
+        self.pending = data[end:]
+        return self._decode(data[:end])
+
+    def flush(self):
+        data = self.pending
+        self.pending = ''
+        if not data:
+            return ''
+        return self._decode(data + '=' * (-len(data) % 4))
+
+    def _decode(self, data):
+        try:
+            return base64.b64decode(data)
+        except TypeError:
+            # Broken data, doing our best
+            return base64.decodestring(data)
+
+
+class QuotedPrintableDecoder(object):
+    """
+    Decodes quoted-printable data fed by chunks of any size: incomplete
+    lines are kept for the next chunk.
+    """
+
+    def __init__(self):
+        self.pending = ''
+
+    def decode(self, data):
+        data = self.pending + data
+        end = data.rfind('\n') + 1
+        self.pending = data[end:]
+        return quopri.decodestring(data[:end])
+
+    def flush(self):
+        data = self.pending
+        self.pending = ''
+        return quopri.decodestring(data)
+
+
+DECODERS = {
+    'base64': Base64Decoder,
+    'quoted-printable': QuotedPrintableDecoder,
+}
+
+
+def decode_stream(chunks, encoding, start=0, end=None):
+    """
+    Decodes an iterable of encoded chunks, as they come. Yields the decoded
+    bytes from ``start`` to ``end`` (included, None for the end of the
+    data). ``chunks`` is closed as soon as ``end`` is reached.
+    """
+    decoder = DECODERS.get(encoding, IdentityDecoder)()
+
+    def decoded():
+        for chunk in chunks:
+            yield decoder.decode(chunk)
+        yield decoder.flush()
+
+    position = 0
+    try:
+        for data in decoded():
+            if end is not None and position > end:
+                break
+            first = max(start - position, 0)
+            last = len(data)
+            if end is not None:
+                last = min(last, end - position + 1)
+            if first < last:
+                yield data[first:last]
+            position += len(data)
+    finally:
+        if hasattr(chunks, 'close'):
+            chunks.close()
+
+
+def _header_end(raw, start, end):
+    """
+    Returns the positions of the end of the headers of the entity between
+    ``start`` and ``end`` and of the beginning of its body.
+    """
+    for newline in ('\r\n', '\n'):
+        if raw.startswith(newline, start):
+            # No headers
+            return start, start + len(newline)
+    found = []
+    for separator in ('\r\n\r\n', '\n\n'):
+        position = raw.find(separator, start, end)
+        if position != -1:
+            found.append((position, position + len(separator)))
+    if not found:
+        return end, end
+    return min(found)
+
+
+def _parts(raw, start, end, boundary):
+    """
+    Yields the (start, end) positions of the parts of a multipart body,
+    without copying them.
+    """
+    delimiter = '--' + boundary
+    position = raw.find(delimiter, start, end)
+    while position != -1:
+        position += len(delimiter)
+        if raw.startswith('--', position):
+            # Closing delimiter
+            return
+        line_end = raw.find('\n', position, end)
+        if line_end == -1:
+            return
+        next_part = raw.find('\n' + delimiter, line_end, end)
+        if next_part == -1:
+            yield line_end + 1, end
+            return
+        part_end = next_part
+        if raw[part_end - 1:part_end] == '\r':
+            part_end -= 1
+        yield line_end + 1, part_end
+        position = next_part + 1
+
+
+def _walk(raw, start, end, found):
+    header_end, body_start = _header_end(raw, start, end)
+    headers = email.parser.HeaderParser().parsestr(raw[start:header_end])
+    content_type = headers.get_content_type()
+
+    if content_type.startswith('multipart/'):
+        boundary = headers.get_boundary()
+        if not boundary:
+            return
+        for part_start, part_end in _parts(raw, body_start, end, boundary):
+            _walk(raw, part_start, part_end, found)
+            if len(found) == len(TEXT_TYPES):
+                # The rest is attachments or alternatives we don't need
+                return
+        return
+
+    disposition = headers.get('Content-Disposition', '')
+    disposition = disposition.split(';')[0].strip().lower()
+    if content_type in TEXT_TYPES and content_type not in found and \
+       disposition != 'attachment':
+        encoding = headers.get('Content-Transfer-Encoding', '7bit')
+        charset = headers.get_content_charset()
+        found[content_type] = decode_part(raw[body_start:end],
+                                          encoding.strip().lower(), charset)
+
+
+def parse_message(raw):
+    """
+    Extracts the content of a raw message: returns the first text/plain and
+    text/html parts, decoded to unicode (empty if missing).
+
+    The parts are located by scanning for the boundaries: only the headers
+    and the text parts are copied, parsed and decoded. Parsing stops as soon
+    as both texts are found.
+    """
+    found = {}
+    _walk(raw, 0, len(raw), found)
+    return found.get('text/plain', u''), found.get('text/html', u'')
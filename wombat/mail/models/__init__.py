@@ -1,9 +1,11 @@
 from mail.models.smtp import SMTP
 from mail.models.imap import IMAP, Mailbox, Thread, Message
+from mail.models.mongo import MessageBody, FlagChange, SyncJob, IdleMailbox
 from mail.models.imap import FOLDER_TYPES, NORMAL, INBOX, OUTBOX, DRAFTS, \
                              QUEUE, TRASH, SPAM, OTHER
 
 
-__all__ = ('SMTP', 'IMAP', 'Mailbox', 'Thread', 'Message',
+__all__ = ('SMTP', 'IMAP', 'Mailbox', 'Thread', 'Message', 'MessageBody',
+           'FlagChange', 'SyncJob', 'IdleMailbox',
            'FOLDER_TYPES', 'NORMAL', 'INBOX', 'OUTBOX', 'DRAFTS', 'QUEUE',
            'TRASH', 'SPAM', 'OTHER')
@@ -5,14 +5,30 @@
 # * Best practices: http://www.imapwiki.org/ClientImplementation
 # * IMAP4rev1 RFC: http://tools.ietf.org/html/rfc3501
 
-import imapclient
+import logging
+import Queue
+import sys
+import threading
+import time
 
 from django.conf import settings
-from django.db import models
+from django.db import connection as db_connection, models, transaction
 from django.utils.translation import ugettext_lazy as _
 
-from mail.models.mongo import Message, Thread
-from mail.utils import clean_subject
+from mail.models.mongo import Message, Thread, REFERENCES
+from mail.pool import pool
+from mail.utils import has_capability, enable_qresync, pop_vanished, \
+                       fetch_changed_flags, uid_ranges, list_folders, \
+                       decode_envelopes
+
+logger = logging.getLogger('wombat.imap')
+
+# Counts stored for each folder
+STATUS = ['MESSAGES', 'UNSEEN']
+
+# Data fetched for each new message
+HEADERS = ['FLAGS', 'RFC822.SIZE', 'ENVELOPE', 'BODYSTRUCTURE',
+           'INTERNALDATE', REFERENCES]
 
 # Folder types
 NORMAL = 100
@@ -61,6 +77,10 @@ class IMAP(models.Model):
     # something is wrong.
     healthy = models.BooleanField(_('Healthy account'), default=True)
 
+    # Last time the owner asked for something, the active accounts are
+    # synchronized more often.
+    active_at = models.DateTimeField(_('Last activity'), null=True)
+
     def __unicode__(self):
         return u'%s imap' % self.account
 
@@ -72,41 +92,39 @@ class IMAP(models.Model):
     def get_connection(self):
         """
         Shortcut used by every method that needs an IMAP connection
-        instance.
+        instance. The connection is borrowed from the connection pool and
+        must be given back with ``release_connection`` instead of being
+        logged out.
 
         Returns None or an IMAPClient instance (connected).
         """
         if not self.healthy:
             # Spam eggs, bacon and spam
             return
-        ssl = self.port == 993
-        m = imapclient.IMAPClient(self.server, port=self.port, ssl=ssl)
-        try:
-            m.login(self.username, self.password)
-            return m
-        except imapclient.IMAPClient.Error:
-            return
+        return pool.get(self)
+
+    def release_connection(self, connection, discard=False):
+        """
+        Gives a connection obtained with ``get_connection`` back to the pool.
+        ``discard`` closes it instead, if it is in an unknown state.
+        """
+        pool.put(self, connection, discard=discard)
 
     def check_mail(self, connection=None):
         """
         Refresh all directories for this connection.
         """
-        if not self.healthy:
-            return
-
-        if connection is None:
-            m = self.get_connection()
-        else:
-            m = connection
-
-        for directory in self.directories.exclude(no_select=True):
-            directory.count_messages(connection=m)
-        m.logout()
+        return self.update_tree(connection=connection)
 
-    def update_tree(self, directory="", update_counts=True, connection=None):
+    def update_tree(self, update_counts=True, connection=None):
         """
         Updates directories statuses cached in the database.
 
+        The whole tree is listed with a single LIST command, along with the
+        counts of the directories (see ``mail.utils.list_folders``). Only the
+        directories that have changed are written, and the counts are stored
+        with a single UPDATE.
+
         Returns the number of directories or None if failed.
         """
         if not self.healthy:
@@ -117,64 +135,127 @@ class IMAP(models.Model):
         else:
             m = connection
 
-        pattern = '%'
-        if directory:
-            pattern = '%s/%%' % directory
-        directories = m.list_folders(directory="", pattern=pattern)
-
-        parent = None
-        if directory:
-            parent = self.directories.get(name=directory)
-
-        dirs = []
-        for d in directories:
-            name = d[2]
-
-            ftype = _guess_folder_type(name.lower())
-
-            dir_, created = Mailbox.objects.get_or_create(imap=self,
-                                                          name=name)
-            dir_.parent = parent
-            dir_.has_children = '\\HasChildren' in d[0]
-            if dir_.has_children:
-                children = self.update_tree(directory=name, connection=m)
-                for child in children:
-                    dirs.append(child)
-            if r'\Noselect' in d[0] or r'\NoInferiors' in d[0]:
-                dir_.no_select = True
-            dir_.folder_type = ftype
-            dir_.save()
-            dirs.append(dir_)
-
-        if not directory:
-            # Deleting 'old' directories. If things have changed on
-            # the server via another client for instance
-            uptodate_dirs = [d.name for d in dirs]
-            self.directories.exclude(name__in=uptodate_dirs).delete()
-
-        if update_counts:
-            for dir_ in dirs:
-                if dir_.no_select:
-                    continue
-                dir_.count_messages(update=True, connection=m)
-
-        if connection is None:
-            m.logout()
+        if m is None:
+            return
 
-        if directory:
-            return dirs
+        discard = True
+        try:
+            folders = list_folders(m, update_counts and STATUS or None)
+            discard = False
+        finally:
+            if connection is None:
+                self.release_connection(m, discard=discard)
+
+        def depth(folder):
+            flags, delimiter, name, status = folder
+            return delimiter and name.count(delimiter) or 0
+        # Parents first
+        folders.sort(key=depth)
+
+        existing = dict([(d.name, d) for d in self.directories.all()])
+        dirs = {}
+        counts = []
+        modified = False
+        for flags, delimiter, name, status in folders:
+            parent = None
+            if delimiter and delimiter in name:
+                parent = dirs.get(name.rsplit(delimiter, 1)[0])
+            values = {
+                'parent': parent,
+                'has_children': '\\haschildren' in flags,
+                'no_select': ('\\noselect' in flags or
+                              '\\noinferiors' in flags),
+                'folder_type': _guess_folder_type(name.lower()),
+            }
+
+            dir_ = existing.get(name)
+            if dir_ is None:
+                dir_ = Mailbox(imap=self, name=name, **values)
+                dir_.save()
+                modified = True
+            else:
+                changed = {}
+                for key, value in values.items():
+                    if key == 'parent':
+                        # Avoiding a query per directory
+                        differs = dir_.parent_id != (parent and parent.pk)
+                    else:
+                        differs = getattr(dir_, key) != value
+                    if differs:
+                        changed[key] = value
+                if changed:
+                    modified = True
+                    for key, value in changed.items():
+                        setattr(dir_, key, value)
+                    # Not saving the whole instance, it may hold an
+                    # outdated synchronization state.
+                    Mailbox.objects.filter(pk=dir_.pk).update(**changed)
+            dirs[name] = dir_
+
+            if status is not None and \
+               (dir_.total, dir_.unread) != (status['MESSAGES'],
+                                             status['UNSEEN']):
+                dir_.total = status['MESSAGES']
+                dir_.unread = status['UNSEEN']
+                counts.append((dir_.pk, dir_.total, dir_.unread))
+
+        # Deleting 'old' directories. If things have changed on
+        # the server via another client for instance
+        removed = [d.pk for name, d in existing.items() if name not in dirs]
+        if removed:
+            Mailbox.objects.filter(pk__in=removed).delete()
+            modified = True
+
+        _update_counts(counts)
+        if modified or counts:
+            from mail.sidebar import invalidate_sidebars
+            invalidate_sidebars([self.pk])
         return len(dirs)
 
 
 def update_tree_on_save(sender, instance, created, **kwargs):
     """
     When an account is saved, the cached directories are automatically updated.
+    Pooled connections may use outdated credentials and are dropped first.
     """
+    pool.clear(instance)
     if instance.healthy:
         instance.update_tree()
 models.signals.post_save.connect(update_tree_on_save, sender=IMAP)
 
 
+def clear_pool_on_delete(sender, instance, **kwargs):
+    pool.clear(instance)
+models.signals.post_delete.connect(clear_pool_on_delete, sender=IMAP)
+
+
+def _update_counts(counts):
+    """
+    Stores the (mailbox id, total, unread) counts of several mailboxes with
+    a single UPDATE query.
+    """
+    if not counts:
+        return
+    qn = db_connection.ops.quote_name
+    cases = ' '.join(['WHEN %s THEN %s'] * len(counts))
+    sql = 'UPDATE %s SET %s = CASE %s %s END, %s = CASE %s %s END ' \
+          'WHERE %s IN (%s)' % (
+              qn(Mailbox._meta.db_table),
+              qn('total'), qn('id'), cases,
+              qn('unread'), qn('id'), cases,
+              qn('id'), ', '.join(['%s'] * len(counts)))
+    params = []
+    for pk, total, unread in counts:
+        params.extend([pk, total])
+    for pk, total, unread in counts:
+        params.extend([pk, unread])
+    params.extend([pk for pk, total, unread in counts])
+
+    cursor = db_connection.cursor()
+    cursor.execute(sql, params)
+    transaction.commit_unless_managed()
+
+
 def _guess_folder_type(name):
     """
     Guesses the type of the folder given its name. Returns a constant to put
@@ -222,6 +303,14 @@ class Mailbox(models.Model):
     unread = models.PositiveIntegerField(_('Unread messages'), default=0)
     total = models.PositiveIntegerField(_('Number of messages'), default=0)
 
+    # State of the folder when the messages were last synchronized, used
+    # to only fetch what has changed since then.
+    uidvalidity = models.BigIntegerField(_('UIDVALIDITY'), null=True)
+    uidnext = models.BigIntegerField(_('UIDNEXT'), null=True)
+    highestmodseq = models.BigIntegerField(_('HIGHESTMODSEQ'), null=True)
+    synced_messages = models.PositiveIntegerField(_('Synchronized messages'),
+                                                  default=0)
+
     # Folders types: Inbox, Trash, Spam...
     folder_type = models.IntegerField(_('Folder type'),
                                       choices=FOLDER_TYPES,
@@ -233,22 +322,25 @@ class Mailbox(models.Model):
         app_label = 'mail'
 
     def __unicode__(self):
+        parent = None
+        if self.folder_type == NORMAL and self.parent_id is not None:
+            parent = self.parent
+        return self.get_label(parent)
+
+    def get_label(self, parent=None):
+        """
+        Name of the directory to display, ``parent`` being its parent
+        directory. Doesn't run any query.
+        """
         if not self.folder_type == NORMAL:
             if self.folder_type == OTHER:
                 return self.name.replace('[Gmail]/', '')  # XXX GMail-only Fix
             return self.get_folder_type_display()
 
-        if self.parent:
-            return self.name.replace(self.parent.name + '/', '')
+        if parent is not None:
+            return self.name.replace(parent.name + '/', '')
         return self.name
 
-    @property
-    def unread_threads(self):
-        if not hasattr(self, '_unread_threads'):
-            self._unread_threads = Thread.objects(mailboxes=self.id,
-                                                  messages__read=False).count()
-        return self._unread_threads
-
     def list_messages(self, number_of_messages=50, offset=0, force_uids=None,
                      connection=None):
         """
@@ -281,35 +373,47 @@ class Mailbox(models.Model):
         if m is None:
             return
 
-        if force_uids is None:
-            ids_list = self.get_uids(connection=m)
-            if not len(ids_list):
-                return []
-
-            number_of_messages = min(number_of_messages, len(ids_list))
-            begin = - (number_of_messages + offset)
-            end = - offset - 1
-            fetch_range = '%s:%s' % (ids_list[begin], ids_list[end])
-        else:
-            fetch_range = ','.join(force_uids)
-
-        m.select_folder(self.name, readonly=True)
-        response = m.fetch(fetch_range, ['FLAGS', 'RFC822.SIZE', 'ENVELOPE',
-                                         'BODYSTRUCTURE', 'INTERNALDATE'])
-        m.close_folder()
-
-        if connection is None:
-            m.logout()
+        discard = True
+        try:
+            if force_uids is None:
+                ids_list = self.get_uids(connection=m)
+                if not len(ids_list):
+                    discard = False
+                    return []
+
+                number_of_messages = min(number_of_messages, len(ids_list))
+                begin = - (number_of_messages + offset)
+                end = - offset - 1
+                fetch_range = '%s:%s' % (ids_list[begin], ids_list[end])
+            else:
+                fetch_range = uid_ranges(map(int, force_uids))
+
+            m.select_folder(self.name, readonly=True)
+            response = m.fetch(fetch_range, HEADERS)
+            m.close_folder()
+            discard = False
+        finally:
+            if connection is None:
+                self.imap.release_connection(m, discard=discard)
+
+        messages = self.parse_headers(response)
+        messages.sort(key=lambda msg: msg.date, reverse=True)
+        return reversed(messages)
 
+    def parse_headers(self, response):
+        """
+        Builds ``Message`` instances from the response of a FETCH of
+        ``HEADERS``.
+        """
+        envelopes = decode_envelopes(response)
         messages = []
         for uid, msg in response.items():
             message = Message(mailbox=self.id,
                               uids=[[self.id, uid]],
-                              msg_dict=msg, update=False)
+                              msg_dict=msg, envelope=envelopes.get(uid),
+                              update=False)
             messages.append(message)
-
-        messages.sort(key=lambda msg: msg.date, reverse=True)
-        return reversed(messages)
+        return messages
 
     def count_messages(self, connection=None, update=True):
         """
@@ -340,9 +444,13 @@ class Mailbox(models.Model):
         if m is None:
             return
 
-        statuses = m.folder_status(self.name)
-        if connection is None:
-            m.logout()
+        discard = True
+        try:
+            statuses = m.folder_status(self.name)
+            discard = False
+        finally:
+            if connection is None:
+                self.imap.release_connection(m, discard=discard)
 
         values = {
             'total': statuses['MESSAGES'],
@@ -351,10 +459,16 @@ class Mailbox(models.Model):
             'unread': statuses['UNSEEN'],
         }
 
-        if update:
+        if update and (self.total, self.unread) != (values['total'],
+                                                    values['unread']):
             self.total = values['total']
             self.unread = values['unread']
-            self.save()
+            # Not saving the whole instance, it may hold an outdated
+            # synchronization state.
+            Mailbox.objects.filter(pk=self.pk).update(total=self.total,
+                                                      unread=self.unread)
+            from mail.sidebar import invalidate_sidebars
+            invalidate_sidebars([self.imap_id])
 
         return values
 
@@ -370,116 +484,362 @@ class Mailbox(models.Model):
         if m is None:
             return
 
-        m.select_folder(self.name, readonly=True)
+        discard = True
+        try:
+            m.select_folder(self.name, readonly=True)
+
+            # Fetch the UIDs of the messages in this directory
+            uids = m.search(['NOT DELETED'])
+            m.close_folder()
+            discard = False
+        finally:
+            if connection is None:
+                self.imap.release_connection(m, discard=discard)
+        return uids
 
-        # Fetch the UIDs of the messages in this directory
-        uids = m.search(['NOT DELETED'])
-        m.close_folder()
+    def search(self, words, connection=None):
+        """
+        Searches the messages containing all ``words`` on the server.
 
+        Returns a list of UIDs.
+        """
         if connection is None:
-            m.logout()
+            m = self.imap.get_connection()
+        else:
+            m = connection
+
+        if m is None:
+            return
+
+        criteria = []
+        for word in words:
+            if isinstance(word, unicode):
+                word = word.encode('utf-8')
+            criteria.append('TEXT "%s"' % word.replace('"', ''))
+
+        discard = True
+        try:
+            m.select_folder(self.name, readonly=True)
+            uids = m.search(criteria, charset='UTF-8')
+            m.close_folder()
+            discard = False
+        finally:
+            if connection is None:
+                self.imap.release_connection(m, discard=discard)
         return uids
 
-    def get_uids_in_db(self):
+    def get_uids_in_db(self, uids=None):
         """
-        Returns the UIDs of messages in this mailbox & stored in the DB
+        Returns the UIDs of messages in this mailbox & stored in the DB.
+        Set ``uids`` to only look for a few UIDs.
         """
-        uids = set()
         threads = Thread.objects(mailboxes=self.id)
+        if uids is not None:
+            pairs = [[self.id, uid] for uid in uids]
+            threads = threads.filter(messages__uids__in=pairs)
+
+        found = set()
         for t in threads:
             for m in t.messages:
                 if self.id in m.mailboxes:
-                    uids.add(m.get_uid(self.id))
-        return uids
+                    found.add(m.get_uid(self.id))
+        if uids is not None:
+            found &= set(uids)
+        return found
+
+    def remove_messages(self, uids):
+        """
+        Removes messages from this mailbox in the DB, given their UIDs.
+        """
+        if not uids:
+            return
+        pairs = [[self.id, uid] for uid in uids]
+        for t in Thread.objects(mailboxes=self.id,
+                                messages__uids__in=pairs):
+            t.remove_message(self.id, pairs)
 
-    def update_messages(self, connection=None):
+    def update_messages(self, connection=None, full=False):
+        """
+        Synchronizes the messages stored in the DB with the server.
+
+        The synchronization is incremental: only the messages above the
+        UIDNEXT seen during the last sync are fetched and, if the server
+        supports CONDSTORE, only the flags that changed since the last
+        HIGHESTMODSEQ. Every UID is compared (full resync) on the first
+        sync, if the UIDVALIDITY has changed or if ``full`` is set.
+        """
         if connection is None:
             m = self.imap.get_connection()
         else:
             m = connection
 
+        if m is None:
+            return
+
+        discard = True
+        try:
+            condstore = has_capability(m, 'CONDSTORE')
+            what = ['MESSAGES', 'UIDNEXT', 'UIDVALIDITY']
+            if condstore:
+                what.append('HIGHESTMODSEQ')
+            status = m.folder_status(self.name, what)
+
+            if self.uidvalidity != status['UIDVALIDITY']:
+                if self.uidvalidity is not None:
+                    # The UIDs we know are meaningless now
+                    self.remove_messages(self.get_uids_in_db())
+                full = True
+            if self.uidnext is None:
+                full = True
+
+            if full:
+                self._full_sync(m)
+            else:
+                self._incremental_sync(m, status, condstore)
+
+            self.uidvalidity = status['UIDVALIDITY']
+            self.uidnext = status['UIDNEXT']
+            self.highestmodseq = status.get('HIGHESTMODSEQ')
+            self.synced_messages = status['MESSAGES']
+            Mailbox.objects.filter(pk=self.pk).update(
+                uidvalidity=self.uidvalidity,
+                uidnext=self.uidnext,
+                highestmodseq=self.highestmodseq,
+                synced_messages=self.synced_messages,
+            )
+            discard = False
+        finally:
+            if connection is None:
+                self.imap.release_connection(m, discard=discard)
+
+    def _full_sync(self, m):
+        """
+        Compares every UID on the server with the ones stored in the DB.
+        """
         db_uids = self.get_uids_in_db()
         imap_uids = set(self.get_uids(connection=m))
 
-        remove_from_db = list(db_uids - imap_uids)
-        remove_from_db = [[self.id, uid] for uid in remove_from_db]
-        threads_remove = Thread.objects(mailboxes=self.id,
-                                        messages__uids__in=remove_from_db)
-        for t in threads_remove:
-            t.remove_message(self.id, remove_from_db)
-
-        fetch_from_imap = map(str, list(imap_uids - db_uids))
-
-        messages = ()
-        if fetch_from_imap:
-            print "Updating %s messages" % len(fetch_from_imap)
-            while len(fetch_from_imap) > 1000:
-                print "%s remaining" % len(fetch_from_imap)
-                fetch_this = fetch_from_imap[:1000]
-                fetch_from_imap = fetch_from_imap[1000:]
-                messages = self.list_messages(force_uids=fetch_this,
-                                              connection=m)
-                self.handle_new_messages(messages)
-            messages = self.list_messages(force_uids=fetch_from_imap,
-                                          connection=m)
-            self.handle_new_messages(messages)
+        self.remove_messages(db_uids - imap_uids)
+        self.fetch_new_messages(list(imap_uids - db_uids), m)
 
-        m.select_folder(self.name)
+        m.select_folder(self.name, readonly=True)
         unseen = m.search(['NOT SEEN'])
         m.close_folder()
+        self.update_unseen(unseen)
 
-        if connection is None:
-            m.logout()
+    def update_unseen(self, unseen):
+        """
+        Marks the messages whose UID is in ``unseen`` as unread and the other
+        messages of this mailbox as read. Only the threads with unread
+        messages are loaded, the changes are applied in bulk.
+        """
+        unseen = set(unseen)
+        unread = set()
+        for t in Thread.objects(mailboxes=self.id,
+                                unread__gt=0).only('messages'):
+            for msg in t.messages:
+                uid = msg.get_uid(self.id)
+                if uid is not None and not msg.read:
+                    unread.add(uid)
+
+        flags = {}
+        for uid in unread - unseen:
+            flags[uid] = True
+        for uid in unseen - unread:
+            flags[uid] = False
+        Thread.set_flags(self.id, flags)
+
+    def _incremental_sync(self, m, status, condstore):
+        """
+        Fetches the messages that arrived and the flags that changed since
+        the last sync. Expunged messages are detected with QRESYNC if
+        available, or by comparing the number of messages with what it
+        should be.
+        """
+        qresync = condstore and enable_qresync(m)
+        m.select_folder(self.name, readonly=True)
 
-        threads = Thread.objects(mailboxes=self.id)
-        for t in threads:
-            t.ensure_unread(self.id, unseen)
+        new_uids = []
+        if status['UIDNEXT'] > self.uidnext:
+            # 'n:*' always matches the last message, even below n
+            new_uids = [uid for uid in m.search(['UID %s:*' % self.uidnext])
+                        if uid >= self.uidnext]
+
+        flags = {}
+        vanished = None
+        unseen = None
+        if condstore:
+            if self.highestmodseq is not None and self.uidnext > 1 and \
+               status['HIGHESTMODSEQ'] > self.highestmodseq:
+                flags = fetch_changed_flags(m, '1:%s' % (self.uidnext - 1),
+                                            self.highestmodseq,
+                                            vanished=qresync)
+            if qresync:
+                vanished = pop_vanished(m)
+        else:
+            unseen = m.search(['NOT SEEN'])
+        m.close_folder()
+
+        if vanished is not None:
+            self.remove_messages(vanished)
+        elif status['MESSAGES'] != self.synced_messages + len(new_uids):
+            # Something has been expunged, finding out what
+            db_uids = self.get_uids_in_db()
+            imap_uids = set(self.get_uids(connection=m))
+            self.remove_messages(db_uids - imap_uids)
+
+        # Messages that arrived during the previous sync may already be there
+        known = self.get_uids_in_db(new_uids)
+        self.fetch_new_messages([uid for uid in new_uids if uid not in known],
+                                m)
+
+        if unseen is not None:
+            self.update_unseen(unseen)
+        elif flags:
+            Thread.set_flags(self.id, flags)
+
+    def fetch_new_messages(self, uids, m):
+        """
+        Fetches the headers of new messages and stores them in their threads.
+
+        This is a two-stage pipeline: a thread keeps the folder selected and
+        fetches the messages by windows of IMAP_FETCH_WINDOW UIDs while the
+        calling thread stores the previous windows. At most
+        IMAP_FETCH_QUEUE windows are waiting to be stored.
+        """
+        if not uids:
+            return
+        uids = sorted(uids)
+        size = getattr(settings, 'IMAP_FETCH_WINDOW', 500)
+        windows = [uids[i:i + size] for i in range(0, len(uids), size)]
+        batches = Queue.Queue(getattr(settings, 'IMAP_FETCH_QUEUE', 2))
+        stop = threading.Event()
+        producer = threading.Thread(target=self._fetch_windows,
+                                    args=(m, windows, batches, stop))
+        producer.setDaemon(True)
+        producer.start()
+
+        logger.info('%s: fetching %s messages' % (self, len(uids)))
+        done = 0
+        started = time.time()
+        try:
+            while True:
+                item = batches.get()
+                if item is None:
+                    break
+                if isinstance(item, tuple):
+                    # Failure in the producer, with its traceback
+                    raise item[0], item[1], item[2]
+                count, messages = item
+                self.handle_new_messages(messages)
+                done += count
+                elapsed = max(time.time() - started, 0.001)
+                logger.info('%s: %s/%s messages (%d/s)' % (
+                    self, done, len(uids), done / elapsed))
+        finally:
+            stop.set()
+            producer.join()
+
+    def _fetch_windows(self, m, windows, batches, stop):
+        """
+        Producer of ``fetch_new_messages``: puts (number of UIDs, messages)
+        items in ``batches``, then None. Stops early if ``stop`` is set.
+        """
+        def put(item):
+            while not stop.isSet():
+                try:
+                    batches.put(item, timeout=1)
+                    return True
+                except Queue.Full:
+                    pass
+            return False
+
+        try:
+            m.select_folder(self.name, readonly=True)
+            try:
+                for window in windows:
+                    response = m.fetch(uid_ranges(window), HEADERS)
+                    if not put((len(window), self.parse_headers(response))):
+                        return
+            finally:
+                m.close_folder()
+        except Exception:
+            put(sys.exc_info())
+            return
+        put(None)
 
     def handle_new_messages(self, messages):
-        account_mailboxes = self.imap.directories.values_list('id', flat=True)
-        for message in messages:
-            if message.message_id is None and message.in_reply_to is None:
-                message.assign_new_thread()
-                continue
-
-            qs = []
-            if message.message_id is not None:
-                qs.append({'messages__in_reply_to': message.message_id})
-            if message.in_reply_to is not None:
-                qs.append({'messages__message_id': message.in_reply_to})
-                qs.append({'messages__in_reply_to': message.in_reply_to})
-
-            threads = set()
-            for query in qs:
-                for t in Thread.objects(mailboxes__in=account_mailboxes).filter(**query):
-                    threads.add(t)
-
-            if not threads:
-                subject = clean_subject(message.subject)
-                if subject != message.subject:
-                    # This is a Re: RE or whatever without any In-Reply-To.
-                    # Trying to guess which thread it's in.
-                    thrds = Thread.objects(mailboxes__in=account_mailboxes)
-                    thrds = thrds.filter(messages__subject=subject)
-                    for t in thrds.order_by('-date'):
-                        threads.add(t)
-                        break
-
-            if not threads:
-                message.assign_new_thread()
-                continue
-
-            current_thread = threads.pop()
-            if len(threads) > 0:  # Merge threads
-                for thread in threads:
-                    current_thread.merge_with(thread, self.id)
-            current_thread.add_message(message, self.id)
-
-    def fetch_messages(self, uids, m):
-        """
-        Fetch the content of a few messages, given the UID.
         """
+        Puts a batch of new messages in their threads. See
+        ``mail.threader.ThreadIndex``.
+        """
+        from mail.threader import ThreadIndex, account_lock
+        messages = list(messages)
+        if not messages:
+            return
+        lock = account_lock(self.imap_id)
+        lock.acquire()
+        try:
+            index = ThreadIndex(self.imap.directories.values_list('id',
+                                                                  flat=True))
+            index.load(messages)
+            index.add_messages(messages, self.id)
+            index.flush()
+        finally:
+            lock.release()
+
+    def stream_part(self, uid, part, offset=0, length=None, chunk_size=None):
+        """
+        Yields the content of a part of a message, as stored on the server
+        (encoded), starting at byte ``offset`` and stopping after ``length``
+        bytes if it's set. The part is fetched by
+        chunks of IMAP_CHUNK_SIZE bytes with ``BODY.PEEK[part]<offset.size>``
+        so that only one chunk is in memory at a time.
+        """
+        if chunk_size is None:
+            chunk_size = getattr(settings, 'IMAP_CHUNK_SIZE', 65536)
+        m = self.imap.get_connection()
+        if m is None:
+            return
+
+        # The connection is in an unknown state if the download is
+        # interrupted
+        discard = True
+        try:
+            m.select_folder(self.name, readonly=True)
+            section = 'BODY[%s]' % part
+            while length is None or length > 0:
+                size = chunk_size
+                if length is not None:
+                    size = min(size, length)
+                response = m.fetch([uid], ['BODY.PEEK[%s]<%s.%s>' % (
+                    part, offset, size)])
+                data = None
+                # The server replies with BODY[part]<offset>
+                for key, value in response.get(uid, {}).items():
+                    if key.upper().startswith(section):
+                        data = value
+                if not data:
+                    break
+                yield data
+                if len(data) < size:
+                    break
+                offset += len(data)
+                if length is not None:
+                    length -= len(data)
+            m.close_folder()
+            discard = False
+        finally:
+            self.imap.release_connection(m, discard=discard)
+
+    def fetch_messages(self, uids, m, items=None):
+        """
+        Fetch the content of a few messages, given the UID. ``items`` are
+        the parts to fetch, the whole messages by default.
+        """
+        if items is None:
+            items = ['RFC822', 'FLAGS']
         m.select_folder(self.name, readonly=True)
-        response = m.fetch(uids, ['RFC822', 'FLAGS'])
+        response = m.fetch(uids, items)
         m.close_folder()
         return response
@@ -1,7 +1,9 @@
 # -*- coding: utf-8 -*-
-import email.header
-import email.parser
+import datetime
 import imapclient
+import pymongo
+import threading
+from pymongo.objectid import ObjectId
 from mongoengine import (Document, EmbeddedDocument, IntField, StringField,
                          DateTimeField, ListField, EmbeddedDocumentField,
                          BooleanField)
@@ -9,13 +11,35 @@ from mongoengine import (Document, EmbeddedDocument, IntField, StringField,
 from django.utils.html import strip_tags
 from django.utils.text import unescape_entities
 
-from mail.utils import address_struct_to_addresses, clean_header
+from mail.mime import parse_bodystructure, parse_message, decode_part
+from mail.utils import decode_envelope, parse_references, message_keywords
+
+REFERENCES = 'BODY.PEEK[HEADER.FIELDS (REFERENCES)]'
+
+# Maximum number of UIDs per update query
+UPDATE_CHUNK = 1000
+
+
+class Part(EmbeddedDocument):
+    """
+    A part of a message, as described by its BODYSTRUCTURE. See mail.mime.
+    """
+    part = StringField()  # Section number, for BODY[part]
+    content_type = StringField()
+    charset = StringField()
+    encoding = StringField()
+    size = IntField()
+    filename = StringField()
+
+    def __unicode__(self):
+        return u'%s' % (self.filename or self.content_type)
 
 
 class Message(EmbeddedDocument):
     uids = ListField(ListField(IntField()))  # ((1, 324), ... (mbox_id, uid))
     message_id = StringField()
     in_reply_to = StringField()
+    references = ListField(StringField())
     date = DateTimeField()
     subject = StringField()
     fro = StringField()  # I wish I could call it 'from'
@@ -26,11 +50,17 @@ class Message(EmbeddedDocument):
     bcc = ListField(StringField())
     size = IntField()
     read = BooleanField(default=False)
+    has_attachment = BooleanField(default=False)
+
+    # Structure of the message: the parts downloaded when it's displayed
+    # and the ones downloaded on demand.
+    text_parts = ListField(EmbeddedDocumentField(Part))
+    attachments = ListField(EmbeddedDocumentField(Part))
 
-    # Fields fetched for each message individually
+    # Key of the content of the message, stored as a MessageBody once
+    # fetched. See Thread.load_bodies()
+    oid = StringField()
     fetched = BooleanField(default=False)
-    body = StringField()
-    html_body = StringField()
 
     meta = {
         'indexes': ['uids', 'message_id', 'in_reply_to', 'date'],
@@ -49,6 +79,20 @@ class Message(EmbeddedDocument):
             if mbox_id == mbid:
                 return uid
 
+    @property
+    def ancestors(self):
+        """
+        The ids of the messages this one replies to, oldest first: the
+        References and the In-Reply-To if it's not the last reference.
+        """
+        ancestors = list(self.references or [])
+        if self.in_reply_to is not None and \
+           (not ancestors or ancestors[-1] != self.in_reply_to):
+            if self.in_reply_to in ancestors:
+                ancestors.remove(self.in_reply_to)
+            ancestors.append(self.in_reply_to)
+        return ancestors
+
     def __init__(self, *args, **kwargs):
         """
         Creates a ``Message`` instance.
@@ -58,81 +102,118 @@ class Message(EmbeddedDocument):
         to be saved.
         """
         msg_dict = kwargs.pop('msg_dict', None)
+        envelope = kwargs.pop('envelope', None)
         update = kwargs.pop('update', True)
         super(Message, self).__init__(*args, **kwargs)
+        if self.oid is None:
+            self.oid = str(ObjectId())
+
+        # Not stored in the thread, see Thread.load_bodies()
+        self.body = None
+        self.html_body = None
 
         if msg_dict is not None:
-            self.parse_dict(msg_dict, update=update)
-        self.attachment = None # XXX see BODYSTRUCTURE
+            self.parse_dict(msg_dict, update=update, envelope=envelope)
 
-    def parse_dict(self, msg_dict, update=True):
+    def parse_dict(self, msg_dict, update=True, envelope=None):
         """
         Parsed the response from a FETCH command and populates as
         much headers as possible
 
         if ``update`` is set to False, the model won't be saved
-        once parse.
+        once parse. ``envelope`` is the ENVELOPE already decoded by
+        ``mail.utils.decode_envelopes``, if any.
         """
+        if envelope is None:
+            envelope = decode_envelope(msg_dict['ENVELOPE'])
         self.read = imapclient.SEEN in msg_dict['FLAGS']
         self.size = msg_dict['RFC822.SIZE']
         self.date = msg_dict['INTERNALDATE']
-        self.subject = clean_header(msg_dict['ENVELOPE'][1])
-        self.in_reply_to = msg_dict['ENVELOPE'][8]
-        self.message_id = msg_dict['ENVELOPE'][9]
-
-        addresses = {
-            'from': msg_dict['ENVELOPE'][2],
-            'sender': msg_dict['ENVELOPE'][3],
-            'reply-to': msg_dict['ENVELOPE'][4],
-            'to': msg_dict['ENVELOPE'][5],
-            'cc': msg_dict['ENVELOPE'][6],
-            'bcc': msg_dict['ENVELOPE'][7],
-        }
-
-        for key, value in addresses.items():
-            if value is not None:
-                addresses[key] = address_struct_to_addresses(value)
-
-        self.to = addresses['to']
-        self.fro = addresses['from'][0]
-        self.sender = addresses['sender'][0]
-        self.reply_to = addresses['reply-to'][0]
-        self.cc = addresses['cc']
-        self.bcc = addresses['bcc']
+        self.subject = envelope['subject']
+        self.in_reply_to = envelope['in-reply-to']
+        self.message_id = envelope['message-id']
+        self.text_parts = []
+        self.attachments = []
+        for part in parse_bodystructure(msg_dict.get('BODYSTRUCTURE')):
+            attachment = part.pop('attachment')
+            if attachment:
+                self.attachments.append(Part(**part))
+            else:
+                self.text_parts.append(Part(**part))
+        self.has_attachment = bool(self.attachments)
+        for key, value in msg_dict.items():
+            # The server replies with BODY[...] to BODY.PEEK[...]
+            if key.upper().startswith('BODY[HEADER.FIELDS (REFERENCES)]'):
+                self.references = parse_references(value)
+
+        self.to = envelope['to']
+        self.fro = envelope['from'][0]
+        self.sender = envelope['sender'][0]
+        self.reply_to = envelope['reply-to'][0]
+        self.cc = envelope['cc']
+        self.bcc = envelope['bcc']
         if update:
             self.save()
 
-    def parse(self, raw_email):
+    def fetch_items(self):
         """
-        Fetches the content of the message and populates the available headers
+        Returns the FETCH items needed to download the content of this
+        message: its text parts, or the whole message if its structure
+        isn't known.
         """
-        body = u''
-        html_body = u''
-        msg = email.parser.Parser().parsestr(raw_email)
-
-        for part in msg.walk():
-            #for key, header in part.items():
-            #    self.headers[key.lower()] = clean_header(header)
+        if not self.text_parts and not self.attachments:
+            return ('RFC822',)
+        return tuple(['BODY.PEEK[%s]' % part.part
+                      for part in self.text_parts])
 
-            payload = part.get_payload(decode=1)
-            charset = part.get_content_charset()
-            if charset is not None:
-                payload = payload.decode(charset)
+    def parse_response(self, response):
+        """
+        Populates the content of the message from the response to a FETCH of
+        ``fetch_items()``.
+        """
+        if 'RFC822' in response:
+            self.parse(response['RFC822'])
+            return
 
-            if part.get_content_type() == 'text/plain':
-                body += payload
+        # The server replies with BODY[...] to BODY.PEEK[...]
+        response = dict([(key.upper(), value)
+                         for key, value in response.items()])
+        body = []
+        html_body = []
+        for part in self.text_parts:
+            data = response.get('BODY[%s]' % part.part)
+            if data is None:
+                continue
+            text = decode_part(data, part.encoding, part.charset)
+            if part.content_type == 'text/html':
+                html_body.append(text)
+            else:
+                body.append(text)
+        self.html_body = u''.join(html_body)
+        self.body = u''.join(body)
+        if not self.body:
+            self.body = unescape_entities(strip_tags(self.html_body))
 
-            if part.get_content_type() == 'text/html':
-                html_body += payload
+    def get_attachment(self, part):
+        for attachment in self.attachments:
+            if attachment.part == part:
+                return attachment
 
+    def parse(self, raw_email):
+        """
+        Populates the content of the message from its raw source.
+        """
+        body, html_body = parse_message(raw_email)
         if not body:
             body = unescape_entities(strip_tags(html_body))
         self.body = body
-        #self.html_body = html_body
+        self.html_body = html_body
 
     def assign_new_thread(self):
         thread = Thread(date=self.date, mailboxes=self.mailboxes,
                         messages=[self])
+        thread.update_summary()
+        thread.update_keywords()
         thread.save(safe=True)
 
 
@@ -148,44 +229,63 @@ class Thread(Document):
     mailboxes = ListField(IntField())
     date = DateTimeField()
     messages = ListField(EmbeddedDocumentField(Message))
+    keywords = ListField(StringField())  # See mail.search
+
+    # Summary of the messages, kept up to date by update_summary() so that
+    # listings don't need to load the messages.
+    subject = StringField()
+    senders = ListField(StringField())
+    unread = IntField(default=0)
+    messages_count = IntField(default=0)
+    has_attachment = BooleanField(default=False)
 
     meta = {
-        'indexes': ['mailboxes', 'date'],
+        'indexes': ['date', 'keywords', 'messages.uids',
+                    'messages.message_id', 'messages.in_reply_to',
+                    'messages.references', 'messages.subject'],
         'ordering': ['-date'],
     }
 
     def __unicode__(self):
         return u'%s' % self.id
 
-    @property
-    def subject(self):
-        return self.messages[0].subject
+    # Fields needed to display a thread in a listing
+    SUMMARY_FIELDS = ('mailboxes', 'date', 'subject', 'senders', 'unread',
+                      'messages_count', 'has_attachment')
 
     @property
     def read(self):
-        return all([m.read for m in self.messages])
+        return self.unread == 0
 
     @property
     def last_date(self):
-        return self.messages[-1].date
+        return self.date
 
-    @property
-    def messages_count(self):
-        return len(self.messages)
-
-    @property
-    def senders(self):
+    def update_summary(self):
+        """
+        Updates the summary fields from the messages.
+        """
         senders = []
         for msg in self.messages:
             if msg.fro not in senders:
                 senders.append(msg.fro)
-        return senders
+        self.senders = senders
 
-    def merge_with(self, other_thread, mbox_id):
+        if self.messages:
+            self.subject = self.messages[0].subject
+            self.date = max([msg.date for msg in self.messages])
+        self.unread = len([msg for msg in self.messages if not msg.read])
+        self.messages_count = len(self.messages)
+        self.has_attachment = any([msg.has_attachment
+                                   for msg in self.messages])
+
+    def merge_with(self, other_thread, mbox_id, update=True):
         """
-        Steal the messages stored in ``other_thread`` and delete it
+        Steal the messages stored in ``other_thread`` and delete it. If
+        ``update`` is False, nothing is saved nor deleted.
         """
-        if self.id == other_thread.id:
+        if self is other_thread or \
+           (self.id is not None and self.id == other_thread.id):
             # Nothing to merge with
             return
         for msg in other_thread.messages:
@@ -193,62 +293,183 @@ class Thread(Document):
         # Sanity check / rebuild if something bad happens to the uids
         for msg in self.messages:
             msg.uids = [uid for uid in msg.uids if uid[1] is not None]
-        self.save(safe=True)
-        other_thread.delete()
+        if update:
+            self.save(safe=True)
+            other_thread.delete()
 
     def add_message(self, message, mbox_id, update=True):
         """
-        Appends a message to the thread and updates relevant parameters
+        Appends a message to the thread and updates relevant parameters.
+        Returns the message of the thread ``message`` is a copy of (the same
+        message in another mailbox), None if it's a new one.
+
+        If ``update`` is False, nothing is saved: see ``push_message``.
         """
-        existing = False
+        existing = None
         for msg in self.messages:
             if all([msg.date == message.date,
                     msg.fro == message.fro,
                     msg.subject == message.subject]):
-                existing = True
+                existing = msg
                 msg.uids.append([mbox_id, message.get_uid(mbox_id)])
 
-        if not existing:
+        if existing is None:
             self.date = max(self.date, message.date)
             self.messages.append(message)
+            keywords = set(self.keywords or [])
+            keywords.update(message_keywords(message))
+            self.keywords = list(keywords)
 
         self.update_mailboxes()
         self.messages.sort(key=lambda m: m.date)
+        self.update_summary()
         if update:
-            self.save(safe=True)
+            self.push_message(message, mbox_id, existing)
+        return existing
+
+    def push_message(self, message, mbox_id, existing=None):
+        """
+        Saves a message added with ``add_message``, ``existing`` being what
+        it returned. The thread is updated in place: the changes made to it
+        in the meantime (flags for instance) are kept.
+        """
+        collection = Thread.objects._collection
+        pair = [mbox_id, message.get_uid(mbox_id)]
+        if existing is not None:
+            if pair[1] is None:
+                # No UID in this mailbox, nothing to add
+                return
+            collection.update({'_id': self.id, 'messages.oid': existing.oid},
+                              {'$addToSet': {'messages.$.uids': pair,
+                                             'mailboxes': mbox_id}},
+                              safe=True)
+            return
+
+        # Appended as is, the messages are sorted when displayed
+        collection.update({'_id': self.id}, {
+            '$push': {'messages': message.to_mongo()},
+            '$addToSet': {'mailboxes': {'$each': message.mailboxes},
+                          'senders': message.fro,
+                          'keywords': {'$each': self.keywords}},
+            '$inc': {'messages_count': 1,
+                     'unread': not message.read and 1 or 0},
+            '$set': {'date': self.date,
+                     'subject': self.subject,
+                     'has_attachment': self.has_attachment},
+        }, safe=True)
 
     def remove_message(self, mailbox_id, message_ids, update=True):
         # message_ids is already a list of (mbox_id, uid) pairs!
         to_remove = []
+        to_update = []
         for msg in self.messages:
             for uid in msg.uids:
                 if mailbox_id in msg.mailboxes and uid in message_ids:
                     if len(msg.mailboxes) == 1:
                         to_remove.append(msg)
                     else:
+                        pulled = [uid for uid in msg.uids if \
+                                  uid[0] == mailbox_id]
                         msg.uids = [uid for uid in msg.uids if \
                                     uid[0] != mailbox_id]
+                        to_update.append((msg, pulled))
+                    break
         for msg in to_remove:
             self.messages.remove(msg)
+        # Their bodies are evicted from the cache with the least recently
+        # read ones, see MessageBody.evict()
+        removed = [m.oid for m in to_remove]
 
         if len(self.messages) == 0:
             self.delete()
             return
 
         self.update_mailboxes()
-        if update:
-            self.save(safe=True)
+        self.update_summary()
+        if to_remove:
+            self.update_keywords()
+        if not update:
+            return
+
+        collection = Thread.objects._collection
+        for msg, pulled in to_update:
+            collection.update({'_id': self.id, 'messages.oid': msg.oid},
+                              {'$pullAll': {'messages.$.uids': pulled}})
+        changes = {
+            '$set': {'mailboxes': self.mailboxes,
+                     'date': self.date,
+                     'subject': self.subject,
+                     'senders': self.senders,
+                     'has_attachment': self.has_attachment,
+                     'keywords': self.keywords},
+        }
+        if removed:
+            changes['$pull'] = {'messages': {'oid': {'$in': removed}}}
+            changes['$inc'] = {
+                'messages_count': -len(removed),
+                'unread': -len([m for m in to_remove if not m.read]),
+            }
+        collection.update({'_id': self.id}, changes, safe=True)
 
     def ensure_unread(self, mailbox_id, message_ids, update=True):
-        message_ids = [[mailbox_id, msg_id] for msg_id in message_ids]
+        """
+        Marks the messages of ``mailbox_id`` as unread if their UID is in
+        ``message_ids``, as read otherwise.
+        """
+        message_ids = set(message_ids)
+        flags = {}
         for msg in self.messages:
-            read = True
-            for uid in msg.uids:
-                if mailbox_id in msg.mailboxes and uid in message_ids:
-                    read = False
-            msg.read = read
+            uid = msg.get_uid(mailbox_id)
+            if uid is not None:
+                flags[uid] = uid not in message_ids
+        self.update_flags(mailbox_id, flags, update=update)
+
+    def update_flags(self, mailbox_id, flags, update=True):
+        """
+        Applies flag changes to the messages of this thread. ``flags`` is a
+        {uid: read} dict for UIDs in ``mailbox_id``, other messages are left
+        untouched.
+        """
+        for msg in self.messages:
+            uid = msg.get_uid(mailbox_id)
+            if uid in flags:
+                msg.read = flags[uid]
+        self.update_summary()
         if update:
-            self.save(safe=True)
+            Thread.set_flags(mailbox_id, flags, {'_id': self.id})
+
+    @classmethod
+    def set_flags(cls, mailbox_id, flags, spec=None):
+        """
+        Applies flag changes ({uid: read} for UIDs in ``mailbox_id``) to all
+        the threads at once, with a few atomic updates and without loading
+        them. ``spec`` restricts the threads to update.
+        """
+        spec = dict(spec or {}, mailboxes=mailbox_id)
+        for read in (True, False):
+            uids = [uid for uid, value in flags.items() if value == read]
+            for i in range(0, len(uids), UPDATE_CHUNK):
+                pairs = [[mailbox_id, uid] for uid in
+                         uids[i:i + UPDATE_CHUNK]]
+                cls._set_read({'uids': {'$in': pairs}}, read, spec)
+
+    @classmethod
+    def _set_read(cls, match, read, spec=None):
+        """
+        Sets the read flag of the messages matching ``match`` and updates the
+        unread counts, in the DB only.
+        """
+        match = dict(match, read=not read)
+        spec = dict(spec or {}, messages={'$elemMatch': match})
+        changes = {'$set': {'messages.$.read': read},
+                   '$inc': {'unread': read and -1 or 1}}
+        collection = cls.objects._collection
+        while True:
+            # The positional operator only updates the first matching
+            # message of each thread, running again until none is left.
+            result = collection.update(spec, changes, multi=True, safe=True)
+            if not result or not result.get('n'):
+                break
 
     def update_mailboxes(self):
         mailboxes = set()
@@ -257,6 +478,19 @@ class Thread(Document):
                 mailboxes.add(mbox)
         self.mailboxes = list(mailboxes)
 
+    def update_keywords(self):
+        """
+        Rebuilds the list of words this thread can be found with.
+        """
+        self.load_bodies()
+        keywords = set()
+        for message in self.messages:
+            keywords.update(message_keywords(message))
+            if getattr(message, 'evicted', False):
+                # The words of its body are only in the current keywords
+                keywords.update(self.keywords or [])
+        self.keywords = list(keywords)
+
     def get_mailboxes(self):
         from mail.models import Mailbox, OUTBOX
         mboxes = Mailbox.objects.filter(id__in=self.mailboxes)
@@ -268,7 +502,7 @@ class Thread(Document):
         """
         missing = {}
         for message in self.messages:
-            if not message.body:
+            if not message.fetched:
                 mbox, uid = message.uids[0]
                 if mbox in missing:
                     missing[mbox].append(uid)
@@ -276,134 +510,360 @@ class Thread(Document):
                     missing[mbox] = [uid]
         return missing
 
+    def missing_size(self):
+        """
+        Returns the number of bytes ``fetch_missing`` would download.
+        """
+        size = 0
+        for message in self.messages:
+            if message.fetched:
+                continue
+            if message.text_parts or message.attachments:
+                size += sum([part.size or 0 for part in message.text_parts])
+            else:
+                size += message.size or 0
+        return size
+
     def fetch_missing(self):
         """
         Fetches the content of the messages that haven't been fetched yet.
+        Returns False if the account could not be reached or if the
+        mailboxes of the messages are gone.
         """
         from mail.models import Mailbox
+        self.load_bodies()
         missing = self.find_missing()
         if not missing:
+            return True
+
+        mailboxes = list(Mailbox.objects.filter(id__in=missing.keys()))
+        if not mailboxes:
+            # Deleted since the thread was synced
+            return False
+        imap = mailboxes[0].imap
+        connection = imap.get_connection()
+        if connection is None:
+            return False
+
+        fetched = []
+        discard = True
+        try:
+            for mailbox in mailboxes:
+                # Messages needing the same parts are fetched together
+                groups = {}
+                for msg in self.messages:
+                    if mailbox.id in msg.mailboxes and not msg.fetched:
+                        groups.setdefault(msg.fetch_items(), []).append(msg)
+
+                for items, msgs in groups.items():
+                    if not items:
+                        # Nothing but attachments
+                        for msg in msgs:
+                            msg.fetched = True
+                            fetched.append(msg)
+                        continue
+                    uids = [msg.get_uid(mailbox.id) for msg in msgs]
+                    response = mailbox.fetch_messages(uids, connection,
+                                                      list(items))
+                    for msg in msgs:
+                        uid = msg.get_uid(mailbox.id)
+                        if uid in response:
+                            msg.parse_response(response[uid])
+                            msg.fetched = True
+                            fetched.append(msg)
+            discard = False
+        finally:
+            imap.release_connection(connection, discard=discard)
+        if not fetched:
+            return True
+
+        uidvalidities = dict([(mailbox.id, mailbox.uidvalidity)
+                              for mailbox in mailboxes])
+        MessageBody.store(imap.pk, fetched, uidvalidities)
+        keywords = set()
+        for msg in fetched:
+            keywords.update(message_keywords(msg))
+        self.keywords = list(keywords | set(self.keywords or []))
+
+        collection = Thread.objects._collection
+        for msg in fetched:
+            collection.update({'_id': self.id, 'messages.oid': msg.oid},
+                              {'$set': {'messages.$.fetched': True}})
+        collection.update({'_id': self.id},
+                          {'$addToSet': {'keywords': {'$each':
+                                                      list(keywords)}}},
+                          safe=True)
+        return True
+
+    def load_bodies(self):
+        """
+        Loads the content of the fetched messages from the cache. Messages
+        whose content has been evicted are marked as not fetched, to be
+        downloaded again.
+        """
+        messages = [msg for msg in self.messages
+                    if msg.fetched and msg.body is None]
+        if not messages:
             return
+        found = MessageBody.lookup(messages, self.mailboxes)
+        for msg in messages:
+            content = found.get(msg.oid)
+            if content is None:
+                msg.fetched = False
+                msg.evicted = True
+            else:
+                msg.body = content.body
+                msg.html_body = content.html_body
 
-        mailboxes = Mailbox.objects.filter(id__in=missing.keys())
-        connection = mailboxes[0].imap.get_connection()
-        for mailbox in mailboxes:
-            response = mailbox.fetch_messages(missing[mailbox.id], connection)
-            for msg in self.messages:
-                if mailbox.id in msg.mailboxes:
-                    uid = msg.get_uid(mailbox.id)
-                    if uid in response:
-                        msg.parse(response[uid]['RFC822'])
-        self.save(safe=True)
+    # Actions, on the server and in the DB. See mail.actions to act on
+    # several threads at once.
 
     def mark_as_read(self):
-        from mail.models import Mailbox
-        to_mark = {}
-        for msg in self.messages:
-            if msg.read:
-                continue
-            msg.read = True
-            for mbox_id, uid in msg.uids:
-                if mbox_id in to_mark:
-                    to_mark[mbox_id].append(uid)
-                else:
-                    to_mark[mbox_id] = [uid]
-        if not to_mark:
-            return
-
-        mailboxes = Mailbox.objects.filter(id__in=to_mark.keys())
-        connection = mailboxes[0].imap.get_connection()
-        for mailbox in mailboxes:
-            uids = ','.join(map(str, to_mark[mailbox.id]))
-            connection.select_folder(mailbox.name)
-            connection.add_flags(uids, imapclient.SEEN)
-            connection.close_folder()
-        connection.logout()
-        self.save(safe=True)
+        from mail.actions import mark_read
+        return mark_read([self])
 
     def mark_as_unread(self):
-        from mail.models import Mailbox
-        to_mark = {}
-        for msg in self.messages:
-            for mbox_id, uid in msg.uids:
-                if mbox_id in to_mark:
-                    to_mark[mbox_id].append(uid)
-                else:
-                    to_mark[mbox_id] = [uid]
+        from mail.actions import mark_read
+        return mark_read([self], read=False)
 
-        mailboxes = Mailbox.objects.filter(id__in=to_mark.keys())
-        connection = mailboxes[0].imap.get_connection()
-        for mailbox in mailboxes:
-            uids = ','.join(map(str, to_mark[mailbox.id]))
-            connection.select_folder(mailbox.name)
-            connection.remove_flags(uids, imapclient.SEEN)
-            connection.close_folder()
+    def move_to(self, destination):
+        """
+        Moves the thread to ``destination``, a Mailbox.
+        """
+        from mail.actions import move
+        return move([self], destination)
 
-        for mailbox in mailboxes:
-            mailbox.update_messages(connection)
-        connection.logout()
+    def delete_from_imap(self):
+        from mail.actions import delete
+        return delete([self])
 
-    def move_to(self, destination):
-        from mail.models import Mailbox, NORMAL, INBOX, SPAM, TRASH
-        to_move = {}
-        to_delete = {}
-        for msg in self.messages:
-            mbox_id, uid = msg.uids[0]
-            if mbox_id in to_move:
-                to_move[mbox_id].append(uid)
-            else:
-                to_move[mbox_id] = [uid]
 
-            for mbox_id, uid in msg.uids[1:]:
-                if mbox_id in to_delete:
-                    to_delete[mbox_id].append(uid)
-                else:
-                    to_delete[mbox_id] = [uid]
-        mailboxes = Mailbox.objects.filter(id__in=to_move.keys())
-        # Don't delete messages in OUTBOX, DRAFTS, QUEUE, OTHER...
-        mailboxes = mailboxes.filter(folder_type__in=[NORMAL, INBOX,
-                                                      SPAM, TRASH])
-        connection = mailboxes[0].imap.get_connection()
-        for mailbox in mailboxes:
-            uids = ','.join(map(str, to_move[mailbox.id]))
-            connection.select_folder(mailbox.name)
-            connection.copy(uids, destination)
-            connection.add_flags(uids, imapclient.DELETED)
-            connection.expunge()
-            connection.close_folder()
-
-        mailboxes = Mailbox.objects.filter(id__in=to_delete.keys())
-        for mailbox in mailboxes:
-            uids = ','.join(map(str, to_delete[mailbox.id]))
-            connection.select_folder(mailbox.name)
-            connection.add_flags(uids, imapclient.DELETED)
-            connection.expunge()
-            connection.close_folder()
-
-        mailboxes = Mailbox.objects.filter(id__in=to_delete.keys()+to_move.keys())
-        for mailbox in mailboxes:
-            mailbox.update_messages(connection)
-        connection.logout()
+# The listings (see mail.paging) are served by a (mailboxes, -date, -_id)
+# index. The metaclass can't build an index on the id, the spec is given as
+# pymongo expects it.
+Thread._meta['indexes'].append([('mailboxes', pymongo.ASCENDING),
+                                ('date', pymongo.DESCENDING),
+                                ('_id', pymongo.DESCENDING)])
 
-    def delete_from_imap(self):
-        from mail.models import Mailbox
-        to_delete = {}
-        for msg in self.messages:
-            for mbox_id, uid in msg.uids:
-                if mbox_id in to_delete:
-                    to_delete[mbox_id].append(uid)
-                else:
-                    to_delete[mbox_id] = [uid]
-
-        mailboxes = Mailbox.objects.filter(id__in=to_delete.keys())
-        connection = mailboxes[0].imap.get_connection()
-        for mailbox in mailboxes:
-            uids = ','.join(map(str, to_delete[mailbox.id]))
-            connection.select_folder(mailbox.name)
-            connection.add_flags(uids, imapclient.DELETED)
-            connection.expunge()
-            connection.close_folder()
-
-        for mailbox in mailboxes:
-            mailbox.update_messages(connection)
-        connection.logout()
+
+class MessageBody(Document):
+    """
+    The content of a message, stored apart from its thread so that threads
+    stay small: flags and threading updates don't have to rewrite the
+    bodies, and long threads don't get near the size limit of a document.
+
+    The bodies are a cache of the server: the ones of each account are kept
+    under BODY_CACHE_SIZE bytes by evicting the least recently read, which
+    are downloaded again when needed. Besides their message, they can be
+    found by (mailbox, UIDVALIDITY, UID) so that re-imported messages don't
+    have to be downloaded again.
+    """
+    message = StringField()  # Message.oid
+    keys = ListField(StringField())  # 'mailbox:uidvalidity:uid'
+    imap = IntField()
+    size = IntField(default=0)
+    accessed = DateTimeField(default=datetime.datetime.now)
+    body = StringField()
+    html_body = StringField()
+
+    meta = {
+        'indexes': ['message', 'keys', ('imap', 'accessed')],
+    }
+
+    # Counters of this process, see SyncDaemon.stats()
+    _stats = {
+        'hits': 0,  # Bodies found in the cache
+        'misses': 0,  # Bodies that have to be downloaded
+        'evictions': 0,  # Bodies removed to stay under BODY_CACHE_SIZE
+    }
+    _stats_lock = threading.Lock()
+
+    def __unicode__(self):
+        return u'%s' % self.message
+
+    @staticmethod
+    def make_keys(message, uidvalidities):
+        return ['%s:%s:%s' % (mbox_id, uidvalidities[mbox_id], uid)
+                for mbox_id, uid in message.uids
+                if uidvalidities.get(mbox_id) is not None]
+
+    @classmethod
+    def stats(cls):
+        """
+        Returns a copy of the cache counters since the process started.
+        """
+        cls._stats_lock.acquire()
+        try:
+            return dict(cls._stats)
+        finally:
+            cls._stats_lock.release()
+
+    @classmethod
+    def _count(cls, **counts):
+        cls._stats_lock.acquire()
+        try:
+            for stat, count in counts.items():
+                cls._stats[stat] += count
+        finally:
+            cls._stats_lock.release()
+
+    @classmethod
+    def store(cls, imap_id, messages, uidvalidities):
+        """
+        Stores the content of freshly fetched messages. ``uidvalidities`` is
+        a {mailbox id: UIDVALIDITY} dict.
+        """
+        bodies = []
+        for msg in messages:
+            size = len(msg.body or '') + len(msg.html_body or '')
+            bodies.append(cls(message=msg.oid, imap=imap_id, size=size,
+                              keys=cls.make_keys(msg, uidvalidities),
+                              body=msg.body, html_body=msg.html_body))
+        if bodies:
+            cls.objects._collection.insert([b.to_mongo() for b in bodies],
+                                           safe=True)
+
+    @classmethod
+    def lookup(cls, messages, mailboxes):
+        """
+        Returns a {Message.oid: MessageBody} dict for the messages whose
+        content is in the cache, and marks them as recently read.
+        """
+        found = {}
+        for content in cls.objects(message__in=[m.oid for m in messages]):
+            found[content.message] = content
+
+        missing = [msg for msg in messages if msg.oid not in found]
+        if missing:
+            from mail.models import Mailbox
+            uidvalidities = dict(Mailbox.objects.filter(
+                id__in=mailboxes).values_list('id', 'uidvalidity'))
+            keys = {}
+            for msg in missing:
+                for key in cls.make_keys(msg, uidvalidities):
+                    keys[key] = msg
+            if keys:
+                for content in cls.objects(keys__in=keys.keys()):
+                    for key in content.keys:
+                        if key in keys:
+                            found[keys[key].oid] = content
+
+        cls._count(hits=len(found), misses=len(messages) - len(found))
+        if found:
+            cls.objects._collection.update(
+                {'_id': {'$in': [c.id for c in found.values()]}},
+                {'$set': {'accessed': datetime.datetime.now()}},
+                multi=True)
+        return found
+
+    @classmethod
+    def evict(cls, imap_id, max_size=None):
+        """
+        Removes the least recently read bodies of an account until they fit
+        in ``max_size`` bytes (BODY_CACHE_SIZE by default). Returns the
+        number of evicted bodies.
+        """
+        if max_size is None:
+            from django.conf import settings
+            max_size = getattr(settings, 'BODY_CACHE_SIZE', 50 * 1024 * 1024)
+        collection = cls.objects._collection
+        total = 0
+        evicted = []
+        for data in collection.find({'imap': imap_id},
+                                    ['size']).sort('accessed', -1):
+            total += data.get('size', 0)
+            if total > max_size:
+                evicted.append(data['_id'])
+        for i in range(0, len(evicted), UPDATE_CHUNK):
+            collection.remove({'_id': {'$in': evicted[i:i + UPDATE_CHUNK]}})
+        cls._count(evictions=len(evicted))
+        return len(evicted)
+
+
+class FlagChange(Document):
+    """
+    A flag change waiting to be pushed to the IMAP server, already applied
+    to the threads. See mail.outbox.
+    """
+    imap = IntField()
+    mailbox = IntField()
+    uid = IntField()
+    flag = StringField()  # imapclient.SEEN
+    value = BooleanField()  # Set or cleared
+    attempts = IntField(default=0)
+    created = DateTimeField(default=datetime.datetime.now)
+
+    meta = {
+        'indexes': [('imap', 'created')],
+        'ordering': ['created'],
+    }
+
+    def __unicode__(self):
+        return u'%s%s on %s:%s' % (self.value and '+' or '-', self.flag,
+                                   self.mailbox, self.uid)
+
+
+class SyncJob(Document):
+    """
+    A piece of IMAP work queued by the views or by the scheduler, and run in
+    the background by the sync daemon (``manage.py syncmail``) so that web
+    requests never wait for a mail server.
+
+    Jobs with the lowest ``priority`` run first.
+    """
+    kind = StringField()  # See mail.sync.JOB_KINDS
+    imap = IntField()
+    mailbox = IntField()
+    thread = StringField()
+    threads = ListField(StringField())  # Bulk actions, see mail.actions
+    action = StringField()
+    destination = IntField()
+    query = StringField()  # SEARCH jobs, see mail.search
+    priority = IntField(default=0)
+    created = DateTimeField(default=datetime.datetime.now)
+
+    meta = {
+        'indexes': [('priority', 'created'), 'imap'],
+        'ordering': ['priority', 'created'],
+    }
+
+    def __unicode__(self):
+        return u'%s job for account %s' % (self.kind, self.imap)
+
+
+class IdleMailbox(Document):
+    """
+    An inbox kept in IDLE by the listener (``manage.py idlemail``), which the
+    sync daemon doesn't need to poll. The listener renews the record while
+    its session is up, a dead listener's records expire.
+    """
+    mailbox = IntField()
+    expires = DateTimeField()
+
+    meta = {
+        'indexes': ['mailbox', 'expires'],
+    }
+
+    def __unicode__(self):
+        return u'IDLE on mailbox %s' % self.mailbox
+
+    @classmethod
+    def renew(cls, mbox_ids, ttl):
+        """
+        Records the mailboxes ``mbox_ids`` as covered for ``ttl`` seconds.
+        """
+        expires = datetime.datetime.now() + datetime.timedelta(seconds=ttl)
+        collection = cls.objects._collection
+        for mbox_id in mbox_ids:
+            collection.update({'mailbox': mbox_id},
+                              cls(mailbox=mbox_id, expires=expires).to_mongo(),
+                              upsert=True)
+
+    @classmethod
+    def covered(cls):
+        """
+        The ids of the mailboxes currently kept in IDLE.
+        """
+        now = datetime.datetime.now()
+        return set([record.mailbox for record in
+                    cls.objects(expires__gt=now).only('mailbox')])
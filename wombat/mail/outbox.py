@@ -0,0 +1,160 @@
+# -*- coding: utf-8 -*-
+"""
+Write-behind queue of the flag changes.
+
+Marking threads as read or unread never waits for the mail server: the
+threads are updated in the DB right away and the changes are recorded as
+FlagChange documents, an outbox that survives restarts. A FLUSH job of the
+sync daemon then pushes the pending changes of the account:
+
+* the changes of a message are coalesced, the last one wins;
+* each mailbox gets one UID STORE per flag and value, with compact UID
+  sets, over a pooled connection.
+
+The unread counts of the folders (``Mailbox.unread``) follow the changes
+and the sidebars of the account are invalidated.
+
+If the account can't be reached the job is retried like any other, with a
+backoff. Changes refused by the server are kept for the next flush and
+dropped after FLAG_OUTBOX_ATTEMPTS flushes, their counts are given back.
+The pending changes of an account are also flushed before its folders are
+synced, so that the sync doesn't undo them.
+"""
+import imaplib
+import logging
+
+import imapclient
+
+from django.conf import settings
+from django.db.models import F
+
+from mail.actions import store_flags
+from mail.models import Mailbox, Thread, FlagChange
+from mail.sidebar import invalidate_sidebars
+
+logger = logging.getLogger('wombat.outbox')
+
+
+def _adjust_unread(imap_ids, counts):
+    """
+    Adds the {mailbox id: number} ``counts`` to the unread counts of the
+    mailboxes, which can't go below 0, and invalidates the sidebars of the
+    accounts ``imap_ids``.
+    """
+    for mbox_id, count in counts.items():
+        if count > 0:
+            Mailbox.objects.filter(pk=mbox_id).update(
+                unread=F('unread') + count)
+        elif count < 0:
+            # The count may be behind the server, never negative
+            Mailbox.objects.filter(pk=mbox_id, unread__lt=-count).update(
+                unread=0)
+            Mailbox.objects.filter(pk=mbox_id, unread__gte=-count).update(
+                unread=F('unread') + count)
+    invalidate_sidebars(imap_ids)
+
+
+def mark_read(threads, read=True):
+    """
+    Marks the messages of ``threads`` as read (or unread if ``read`` is
+    False) and queues the changes for the server. Returns the number of
+    messages changed.
+    """
+    from mail.sync import enqueue, FLUSH
+    groups = {}
+    count = 0
+    for thread in threads:
+        for msg in thread.messages:
+            if msg.read == read:
+                continue
+            msg.read = read
+            count += 1
+            for mbox_id, uid in msg.uids:
+                groups.setdefault(mbox_id, []).append(uid)
+        thread.update_summary()
+    if not groups:
+        return 0
+
+    accounts = dict(Mailbox.objects.filter(id__in=groups.keys()).values_list(
+        'id', 'imap'))
+    changes = []
+    for mbox_id, uids in groups.items():
+        if mbox_id not in accounts:
+            continue
+        for uid in uids:
+            changes.append(FlagChange(imap=accounts[mbox_id], mailbox=mbox_id,
+                                      uid=uid, flag=imapclient.SEEN,
+                                      value=read).to_mongo())
+    if not changes:
+        return 0
+    # Recorded first: if the DB is updated and not the server, the next sync
+    # reverts the change.
+    FlagChange.objects._collection.insert(changes, safe=True)
+
+    spec = {'_id': {'$in': [thread.id for thread in threads]}}
+    for mbox_id, uids in groups.items():
+        if mbox_id in accounts:
+            Thread.set_flags(mbox_id, dict([(uid, read) for uid in uids]),
+                             spec)
+    sign = read and -1 or 1
+    _adjust_unread(set(accounts.values()),
+                   dict([(mbox_id, sign * len(uids))
+                         for mbox_id, uids in groups.items()
+                         if mbox_id in accounts]))
+    for imap_id in set(accounts.values()):
+        enqueue(FLUSH, imap_id)
+    return count
+
+
+def flush(imap, connection):
+    """
+    Pushes the pending flag changes of the account ``imap`` to the server,
+    over ``connection``.
+    """
+    changes = list(FlagChange.objects(imap=imap.pk))
+    if not changes:
+        return
+
+    flags = {}  # mailbox id -> {(flag, uid): value}
+    for change in changes:
+        # Oldest first, the last change wins
+        flags.setdefault(change.mailbox, {})[(change.flag, change.uid)] = \
+                change.value
+    mailboxes = Mailbox.objects.filter(id__in=flags.keys())
+
+    failed = set()
+    for mailbox in mailboxes:
+        groups = {}
+        for (flag, uid), value in flags[mailbox.id].items():
+            groups.setdefault((flag, value), []).append(uid)
+        try:
+            connection.select_folder(mailbox.name)
+            for (flag, value), uids in groups.items():
+                store_flags(connection, uids, flag, add=value)
+        except imaplib.IMAP4.abort:
+            # The connection is gone, the job is retried later
+            raise
+        except imaplib.IMAP4.error, e:
+            logger.warning('Flag changes refused in %s: %s' % (mailbox.pk,
+                                                               e))
+            failed.add(mailbox.id)
+
+    # The changes of deleted mailboxes are dropped too
+    FlagChange.objects(id__in=[change.id for change in changes
+                               if change.mailbox not in failed]).delete()
+    retry = [change.id for change in changes if change.mailbox in failed]
+    if retry:
+        FlagChange.objects._collection.update({'_id': {'$in': retry}},
+                                              {'$inc': {'attempts': 1}},
+                                              multi=True, safe=True)
+        attempts = getattr(settings, 'FLAG_OUTBOX_ATTEMPTS', 5)
+        dropped = FlagChange.objects(id__in=retry, attempts__gte=attempts)
+        counts = {}
+        for change in dropped:
+            if change.flag == imapclient.SEEN:
+                # The folder keeps its unread message
+                counts[change.mailbox] = counts.get(change.mailbox, 0) + \
+                        (change.value and 1 or -1)
+        dropped.delete()
+        if counts:
+            _adjust_unread([imap.pk], counts)
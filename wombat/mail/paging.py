@@ -0,0 +1,96 @@
+# -*- coding: utf-8 -*-
+"""
+Keyset pagination of the thread listings.
+
+Pages aren't numbered: a page is given by the thread it starts after (older
+threads) or before (newer threads), as a ``date_id`` cursor. Each page is a
+couple of range queries on the (mailboxes, date, id) index, whatever its
+depth in the listing, instead of a skip() over all the previous threads.
+
+The totals are counted once and cached for THREAD_COUNT_TIMEOUT seconds.
+"""
+from __future__ import absolute_import
+
+import datetime
+
+from django.conf import settings
+from django.core.cache import cache
+from pymongo.errors import InvalidId
+from pymongo.objectid import ObjectId
+
+from mail.models import Thread
+# wombat/utils.py, not mail.utils
+from utils import safe_cache_key
+
+PAGE_SIZES = (50, 100)
+DATE_FORMAT = '%Y%m%d%H%M%S%f'
+
+
+def make_cursor(thread):
+    return '%s_%s' % (thread.date.strftime(DATE_FORMAT), thread.id)
+
+
+def parse_cursor(cursor):
+    """
+    Returns the (date, id) couple of a cursor, None if it's invalid.
+    """
+    try:
+        date, thread_id = cursor.split('_')
+        return (datetime.datetime.strptime(date, DATE_FORMAT),
+                ObjectId(thread_id))
+    except (AttributeError, InvalidId, TypeError, ValueError):
+        return None
+
+
+def count_threads(mbox_ids):
+    """
+    Number of threads in the mailboxes ``mbox_ids``, cached.
+    """
+    key = safe_cache_key('thread_count_%s' % '-'.join(
+        [str(mbox_id) for mbox_id in sorted(mbox_ids)]))
+    total = cache.get(key)
+    if total is None:
+        total = Thread.objects(mailboxes__in=mbox_ids).count()
+        cache.set(key, total, getattr(settings, 'THREAD_COUNT_TIMEOUT', 60))
+    return total
+
+
+def page_threads(mbox_ids, size, before=None, after=None):
+    """
+    Returns the ``size`` threads of ``mbox_ids`` that come after the cursor
+    ``before`` (older threads) or before the cursor ``after`` (newer
+    threads), most recent first, and whether there are more threads after
+    (``before`` or no cursor) or before (``after``) the page.
+    """
+    def threads(**query):
+        # Querysets are filtered in place, each query starts from scratch
+        return Thread.objects(mailboxes__in=mbox_ids, **query).only(
+            *Thread.SUMMARY_FIELDS)
+
+    newer = after is not None
+    position = parse_cursor(newer and after or before)
+    if position is None:
+        page = list(threads().order_by('-date', '-_id')[:size + 1])
+        return page[:size], len(page) > size
+
+    date, thread_id = position
+    if newer:
+        # order_by() takes the names of the fields in the DB
+        order = ('date', '_id')
+        ties = threads(date=date, id__gt=thread_id)
+        others = threads(date__gt=date)
+    else:
+        order = ('-date', '-_id')
+        ties = threads(date=date, id__lt=thread_id)
+        others = threads(date__lt=date)
+
+    # The threads with the same date come first, then the others: one range
+    # on the index each.
+    page = list(ties.order_by(*order)[:size + 1])
+    if len(page) <= size:
+        page.extend(others.order_by(*order)[:size + 1 - len(page)])
+    more = len(page) > size
+    page = page[:size]
+    if newer:
+        page.reverse()
+    return page, more
@@ -0,0 +1,214 @@
+# -*- coding: utf-8 -*-
+"""
+A per-account pool of logged-in IMAP connections.
+
+Opening an IMAP connection costs a TCP connection, possibly a TLS handshake
+and a LOGIN round-trip. Instead of paying this on every call, the connections
+are kept open once used and handed out again the next time the same account
+needs one.
+"""
+import imaplib
+import socket
+import threading
+import time
+
+import imapclient
+
+from django.conf import settings
+
+
+def connect(imap):
+    """
+    Opens a new connection to an IMAP account, outside of the pool. Returns
+    None if the login fails.
+    """
+    ssl = imap.port == 993
+    m = imapclient.IMAPClient(imap.server, port=imap.port, ssl=ssl)
+    try:
+        m.login(imap.username, imap.password)
+    except imapclient.IMAPClient.Error:
+        return
+    refresh_capabilities(m)
+    return m
+
+
+def refresh_capabilities(m):
+    """
+    Asks the server for its capabilities again and remembers them on the
+    connection. imaplib only reads them before LOGIN, when many servers
+    don't advertise the extensions yet (CONDSTORE, MOVE...).
+    """
+    typ, data = m._imap.capability()
+    if typ == 'OK' and data and data[-1]:
+        m._capabilities = tuple(data[-1].upper().split())
+    else:
+        m._capabilities = tuple(m._imap.capabilities)
+    return m._capabilities
+
+
+class ConnectionPool(object):
+    """
+    Keeps at most ``max_size`` idle connections per IMAP account. Connections
+    idle for more than ``idle_timeout`` seconds are dropped, connections idle
+    for more than ``check_after`` seconds are checked with a NOOP before
+    being handed out again.
+
+    When every pooled connection of an account is in use, ``get`` waits up to
+    ``wait`` seconds for one to be released and opens an extra connection
+    after that: a leaked connection slows things down but never blocks an
+    account.
+    """
+
+    def __init__(self, max_size=None, idle_timeout=None, check_after=None,
+                 wait=None):
+        if max_size is None:
+            max_size = getattr(settings, 'IMAP_POOL_SIZE', 2)
+        if idle_timeout is None:
+            idle_timeout = getattr(settings, 'IMAP_POOL_IDLE_TIMEOUT', 300)
+        if check_after is None:
+            check_after = getattr(settings, 'IMAP_POOL_CHECK_AFTER', 10)
+        if wait is None:
+            wait = getattr(settings, 'IMAP_POOL_WAIT', 5)
+        self.max_size = max_size
+        self.idle_timeout = idle_timeout
+        self.check_after = check_after
+        self.wait = wait
+
+        self._lock = threading.Condition()
+        self._idle = {}  # account id -> [(connection, last release), ...]
+        self._busy = {}  # account id -> number of borrowed connections
+        self.stats = {
+            'hits': 0,  # An idle connection has been reused
+            'misses': 0,  # A new connection had to be opened
+            'reconnects': 0,  # A pooled connection was dead and replaced
+            'overflows': 0,  # Opened past max_size after waiting
+        }
+
+    def get(self, imap):
+        """
+        Borrows a connection for the ``imap`` account. Returns an IMAPClient
+        instance (connected and logged in) or None if the login fails.
+
+        The connection has to be given back with ``put``.
+        """
+        key = imap.pk
+        connection = None
+        deadline = time.time() + self.wait
+
+        self._lock.acquire()
+        try:
+            while True:
+                connection, last_used = self._pop_idle(key)
+                busy = self._busy.get(key, 0)
+                if connection is not None or busy < self.max_size:
+                    break
+                remaining = deadline - time.time()
+                if remaining <= 0:
+                    self.stats['overflows'] += 1
+                    break
+                self._lock.wait(remaining)
+            self._busy[key] = self._busy.get(key, 0) + 1
+        finally:
+            self._lock.release()
+
+        if connection is not None:
+            if time.time() - last_used < self.check_after or \
+               self._alive(connection):
+                self._count('hits')
+                return connection
+            self._close(connection)
+            self._count('reconnects')
+        else:
+            self._count('misses')
+
+        try:
+            return self._connect(imap)
+        except:
+            self._release_slot(key)
+            raise
+
+    def put(self, imap, connection, discard=False):
+        """
+        Gives a borrowed connection back to the pool. Set ``discard`` if the
+        connection is in an unknown state (an error occured while using it),
+        it is then closed instead of being reused.
+        """
+        key = imap.pk
+        self._lock.acquire()
+        try:
+            self._busy[key] = max(self._busy.get(key, 0) - 1, 0)
+            idle = self._idle.setdefault(key, [])
+            if not discard and len(idle) < self.max_size:
+                idle.append((connection, time.time()))
+                connection = None
+            self._lock.notify()
+        finally:
+            self._lock.release()
+
+        if connection is not None:
+            self._close(connection)
+
+    def clear(self, imap):
+        """
+        Closes every idle connection of an account, for instance when its
+        credentials have changed.
+        """
+        self._lock.acquire()
+        try:
+            idle = self._idle.pop(imap.pk, [])
+        finally:
+            self._lock.release()
+        for connection, last_used in idle:
+            self._close(connection)
+
+    def _pop_idle(self, key):
+        """
+        Returns the most recently used idle connection that hasn't timed out.
+        Must be called with the lock held.
+        """
+        idle = self._idle.get(key, [])
+        now = time.time()
+        while idle:
+            connection, last_used = idle.pop()
+            if now - last_used < self.idle_timeout:
+                return connection, last_used
+            self._close(connection)
+        return None, None
+
+    def _release_slot(self, key):
+        self._lock.acquire()
+        try:
+            self._busy[key] = max(self._busy.get(key, 0) - 1, 0)
+            self._lock.notify()
+        finally:
+            self._lock.release()
+
+    def _count(self, stat):
+        self._lock.acquire()
+        try:
+            self.stats[stat] += 1
+        finally:
+            self._lock.release()
+
+    def _connect(self, imap):
+        m = connect(imap)
+        if m is None:
+            self._release_slot(imap.pk)
+        return m
+
+    def _alive(self, connection):
+        # IMAPClient doesn't wrap NOOP, talking to imaplib directly
+        try:
+            typ, data = connection._imap.noop()
+        except (imaplib.IMAP4.error, socket.error):
+            return False
+        return typ == 'OK'
+
+    def _close(self, connection):
+        try:
+            connection.logout()
+        except (imaplib.IMAP4.error, socket.error):
+            pass
+
+
+pool = ConnectionPool()
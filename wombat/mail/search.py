@@ -0,0 +1,62 @@
+# -*- coding: utf-8 -*-
+"""
+Full-text search of the threads.
+
+Each thread stores the list of the words found in the subjects, addresses
+and bodies of its messages in its ``keywords`` field, which is indexed. A
+search is a single indexed query: the threads whose keywords contain all
+the words of the query.
+
+Messages whose content hasn't been fetched yet are only indexed by their
+headers. ``search_server`` queues a SEARCH job per inbox: the sync daemon
+runs the search on the server and downloads the threads found, which then
+match like the others.
+"""
+from mail.models import Thread, INBOX
+from mail.utils import tokenize
+
+
+def search_threads(mailboxes, query):
+    """
+    Returns the threads of ``mailboxes`` (a queryset of Mailbox) matching
+    all the words of ``query``, most recent first.
+    """
+    words = list(tokenize(query))
+    if not words:
+        return Thread.objects(id__in=[])
+
+    mbox_ids = list(mailboxes.values_list('id', flat=True))
+    return Thread.objects(mailboxes__in=mbox_ids, keywords__all=words)
+
+
+def search_server(mailboxes, query):
+    """
+    Queues the search of ``query`` in the inboxes of ``mailboxes`` on the
+    server. Returns the number of queued searches.
+    """
+    from mail.sync import enqueue, SEARCH
+    if not list(tokenize(query)):
+        return 0
+    count = 0
+    for mailbox in mailboxes.filter(folder_type=INBOX):
+        enqueue(SEARCH, mailbox.imap_id, mailbox=mailbox, query=query)
+        count += 1
+    return count
+
+
+def find_unfetched(mailbox, query, connection):
+    """
+    Searches ``query`` in ``mailbox`` on the server, over ``connection``.
+    Returns the ids of the threads found whose content hasn't been fetched
+    entirely.
+    """
+    words = list(tokenize(query))
+    if not words:
+        return []
+    pairs = [[mailbox.id, uid] for uid in mailbox.search(
+        words, connection=connection) or []]
+    if not pairs:
+        return []
+    threads = Thread.objects(messages__uids__in=pairs,
+                             messages__fetched=False)
+    return [thread.id for thread in threads.only('id')]
@@ -0,0 +1,94 @@
+# -*- coding: utf-8 -*-
+"""
+Folder sidebar of the mail pages.
+
+The accounts of a user, their directory trees and unread counts are built
+with two queries and kept in the cache as plain dicts, so that rendering a
+page doesn't run any query for the navigation. The counts are the ones
+stored by the sync (``Mailbox.unread``): the sidebars of an account are
+invalidated whenever its directories or their counts change.
+"""
+from __future__ import absolute_import
+
+from django.conf import settings
+from django.core.cache import cache
+
+from mail.models import Mailbox, NORMAL
+# wombat/utils.py, not mail.utils
+from utils import safe_cache_key
+
+
+def sidebar_key(profile_id):
+    return safe_cache_key('sidebar_%s' % profile_id)
+
+
+def _folder(mailbox, by_id, children):
+    return {
+        'id': mailbox.id,
+        'label': mailbox.get_label(by_id.get(mailbox.parent_id)),
+        'unread': mailbox.unread,
+        'no_select': mailbox.no_select,
+        'children': [_folder(child, by_id, children)
+                     for child in children.get(mailbox.id, [])],
+    }
+
+
+def build_sidebar(profile):
+    """
+    Returns the accounts of ``profile`` as a list of dicts: ``name`` and
+    the ``common`` (inbox, outbox, etc.) and ``custom`` directory trees.
+    Each directory is a dict: ``id``, ``label``, ``unread``, ``no_select``
+    and ``children``.
+    """
+    accounts = list(profile.accounts.all())
+    mailboxes = list(Mailbox.objects.filter(
+        imap__in=[account.imap_id for account in accounts]))
+    by_id = dict([(mailbox.id, mailbox) for mailbox in mailboxes])
+    children = {}
+    for mailbox in mailboxes:
+        if mailbox.parent_id is not None:
+            children.setdefault(mailbox.parent_id, []).append(mailbox)
+
+    sidebar = []
+    for account in accounts:
+        common = []
+        custom = []
+        for mailbox in mailboxes:
+            if mailbox.imap_id != account.imap_id:
+                continue
+            if mailbox.folder_type != NORMAL:
+                if mailbox.name.lower() != '[gmail]':
+                    common.append(mailbox)
+            elif mailbox.parent_id is None:
+                custom.append(mailbox)
+        common.sort(key=lambda mailbox: mailbox.folder_type)
+        sidebar.append({
+            'name': account.name,
+            'common': [_folder(m, by_id, children) for m in common],
+            'custom': [_folder(m, by_id, children) for m in custom],
+        })
+    return sidebar
+
+
+def get_sidebar(profile):
+    """
+    The sidebar of ``profile``, from the cache if possible.
+    """
+    key = sidebar_key(profile.pk)
+    sidebar = cache.get(key)
+    if sidebar is None:
+        sidebar = build_sidebar(profile)
+        cache.set(key, sidebar, getattr(settings, 'SIDEBAR_TIMEOUT', 3600))
+    return sidebar
+
+
+def invalidate_sidebars(imap_ids):
+    """
+    Drops the cached sidebars of the owners of the IMAP accounts
+    ``imap_ids``.
+    """
+    from users.models import Account
+    profiles = Account.objects.filter(imap__in=imap_ids).values_list(
+        'profile', flat=True)
+    for profile_id in set(profiles):
+        cache.delete(sidebar_key(profile_id))
@@ -0,0 +1,477 @@
+# -*- coding: utf-8 -*-
+"""
+Background synchronization with the IMAP servers.
+
+The views never talk to IMAP servers directly: they ``enqueue`` jobs, which
+are stored in MongoDB and run by a long-running daemon (``manage.py
+syncmail``). The daemon also schedules regular syncs of every account,
+more often for the accounts whose owner is currently active.
+"""
+import datetime
+import imaplib
+import logging
+import Queue
+import socket
+import threading
+import time
+
+from django.conf import settings
+
+from mail.actions import apply_action
+from mail.models import IMAP, Mailbox, Thread, MessageBody, SyncJob, \
+                        IdleMailbox, INBOX
+from mail.outbox import flush
+from mail.pool import pool
+from mail.search import find_unfetched
+
+logger = logging.getLogger('wombat.sync')
+
+# Job kinds
+CHECK = 'check'  # Refresh the counts of every folder of an account
+UPDATE = 'update'  # Synchronize the messages of a folder
+FETCH = 'fetch'  # Fetch the content of the messages of a thread
+PREFETCH = 'prefetch'  # Same thing, before someone asks for it
+ACTION = 'action'  # Apply an action (read, unread, move, delete) to threads
+FLUSH = 'flush'  # Push the pending flag changes, see mail.outbox
+SEARCH = 'search'  # Search an inbox on the server, see mail.search
+
+JOB_KINDS = (CHECK, UPDATE, FETCH, PREFETCH, ACTION, FLUSH, SEARCH)
+
+# Priorities, lowest first
+USER = 0  # Someone is waiting for it
+ACTIVE = 10  # Regular sync of an active user
+BACKGROUND = 20  # Regular sync of everyone else
+INBOX_BONUS = 5  # Inboxes go before the other folders
+
+
+def enqueue(kind, imap, mailbox=None, thread=None, priority=USER, **kwargs):
+    """
+    Queues a job for the sync daemon. If the same job is already waiting,
+    its priority is raised instead of queueing it twice.
+
+    Jobs with the USER priority mark the account as active.
+    """
+    if isinstance(imap, IMAP):
+        imap = imap.pk
+    if isinstance(mailbox, Mailbox):
+        mailbox = mailbox.pk
+    if isinstance(thread, Thread):
+        thread = str(thread.id)
+
+    if priority == USER:
+        IMAP.objects.filter(pk=imap).update(active_at=datetime.datetime.now())
+
+    if kind != ACTION:
+        for job in SyncJob.objects(kind=kind, imap=imap, mailbox=mailbox,
+                                   thread=thread, query=kwargs.get('query')):
+            if job.priority > priority:
+                job.priority = priority
+                job.save()
+            return job
+
+    job = SyncJob(kind=kind, imap=imap, mailbox=mailbox, thread=thread,
+                  priority=priority, **kwargs)
+    job.save()
+    return job
+
+
+def active_accounts(timeout=None):
+    """
+    Returns the healthy accounts whose owner did something in the last
+    ``timeout`` seconds.
+    """
+    if timeout is None:
+        timeout = getattr(settings, 'SYNC_ACTIVE_TIMEOUT', 1800)
+    since = datetime.datetime.now() - datetime.timedelta(seconds=timeout)
+    return IMAP.objects.filter(healthy=True, active_at__gte=since)
+
+
+def prefetch(threads, priority=ACTIVE):
+    """
+    Queues the download of the content of ``threads`` (a Thread queryset)
+    that has not been fetched yet, so that it's there when someone opens
+    them.
+    """
+    threads = list(threads.filter(messages__fetched=False).only('mailboxes'))
+    if not threads:
+        return
+    mbox_ids = set()
+    for thread in threads:
+        mbox_ids.update(thread.mailboxes)
+    accounts = dict(Mailbox.objects.filter(id__in=mbox_ids).values_list(
+        'id', 'imap'))
+    for thread in threads:
+        for mbox_id in thread.mailboxes:
+            if mbox_id in accounts:
+                enqueue(PREFETCH, accounts[mbox_id], thread=thread,
+                        priority=priority)
+                break
+
+
+def prefetch_inbox(mailbox, count=None):
+    """
+    Queues the download of the ``count`` most recent unread threads of an
+    inbox (SYNC_PREFETCH_THREADS by default).
+    """
+    if count is None:
+        count = getattr(settings, 'SYNC_PREFETCH_THREADS', 20)
+    if not count:
+        return
+    recent = Thread.objects(mailboxes=mailbox.pk, unread__gt=0)
+    ids = [thread.id for thread in recent.only('id')[:count]]
+    prefetch(Thread.objects(id__in=ids), priority=BACKGROUND)
+
+
+def run_job(job):
+    """
+    Runs a job, in the calling thread. Returns False if the account could not
+    be reached.
+
+    The jobs of deleted accounts, folders or threads are dropped.
+    """
+    try:
+        imap = IMAP.objects.get(pk=job.imap)
+    except IMAP.DoesNotExist:
+        logger.info('%s dropped, the account is gone' % job)
+        return True
+
+    if job.kind in (FETCH, PREFETCH):
+        # The thread may have been merged or deleted in the meantime
+        for thread in Thread.objects(id=job.thread):
+            if thread.fetch_missing() is False:
+                return False
+        return True
+
+    if job.kind == ACTION:
+        threads = list(Thread.objects(id__in=job.threads or [job.thread]))
+        if not threads:
+            return True
+        destination = None
+        if job.destination is not None:
+            try:
+                destination = imap.directories.get(pk=job.destination)
+            except Mailbox.DoesNotExist:
+                logger.info('%s dropped, the destination is gone' % job)
+                return True
+        return apply_action(threads, job.action, destination)
+
+    mailbox = None
+    if job.kind in (UPDATE, SEARCH):
+        try:
+            mailbox = imap.directories.get(pk=job.mailbox)
+        except Mailbox.DoesNotExist:
+            logger.info('%s dropped, the folder is gone' % job)
+            return True
+
+    m = imap.get_connection()
+    if m is None:
+        return False
+
+    discard = True
+    try:
+        # The pending flag changes (FLUSH jobs) go first, so that the sync
+        # doesn't revert them.
+        flush(imap, m)
+        if job.kind == CHECK:
+            imap.check_mail(connection=m)
+            MessageBody.evict(imap.pk)
+        elif job.kind == UPDATE:
+            mailbox.update_messages(connection=m)
+        elif job.kind == SEARCH:
+            found = find_unfetched(mailbox, job.query, m)
+        discard = False
+    finally:
+        imap.release_connection(m, discard=discard)
+
+    if job.kind == SEARCH:
+        for thread_id in found:
+            enqueue(FETCH, imap, thread=str(thread_id), priority=job.priority)
+
+    if job.kind == UPDATE and mailbox.folder_type == INBOX:
+        prefetch_inbox(mailbox)
+    return True
+
+
+class SyncDaemon(object):
+    """
+    Runs the queued jobs with a pool of threads.
+
+    * At most ``per_server`` jobs run at the same time against the same
+      server, and at most ``per_account`` per account (the folders of an
+      account are synced in parallel, over pooled connections). A folder is
+      never synced twice at the same time.
+    * With ``partition = (index, count)``, only the accounts whose id is
+      ``index`` modulo ``count`` are handled: ``count`` daemons can share
+      the accounts, in separate processes.
+    * Accounts that can't be reached are retried with an exponential
+      backoff and marked as unhealthy after ``max_failures`` attempts. The
+      unhealthy accounts are probed from time to time and marked as healthy
+      again once they work.
+    * Accounts for which a user asked for something in the last
+      ``active_timeout`` seconds are considered active: they are synced every
+      ``active_interval`` seconds instead of every ``interval`` seconds and
+      their jobs go first. If ``idle`` is set, the inboxes kept in IDLE by
+      the listener (``manage.py idlemail``) aren't polled.
+    * Prefetch jobs download at most ``prefetch_budget`` bytes per account
+      and per hour, the others are dropped.
+    * Every ``stats_interval`` seconds, ``stats()`` is logged.
+    """
+
+    def __init__(self, threads=None, per_server=None, per_account=None,
+                 interval=None, active_interval=None, active_timeout=None,
+                 idle=None, partition=None, prefetch_budget=None, poll=1,
+                 max_failures=5, max_backoff=3600, stats_interval=None):
+        def setting(value, name, default):
+            if value is None:
+                return getattr(settings, name, default)
+            return value
+
+        self.threads = setting(threads, 'SYNC_THREADS', 4)
+        self.per_server = setting(per_server, 'SYNC_PER_SERVER', 2)
+        self.per_account = setting(per_account, 'SYNC_PER_ACCOUNT', 2)
+        self.interval = setting(interval, 'SYNC_INTERVAL', 900)
+        self.active_interval = setting(active_interval,
+                                       'SYNC_ACTIVE_INTERVAL', 120)
+        self.active_timeout = setting(active_timeout,
+                                      'SYNC_ACTIVE_TIMEOUT', 1800)
+        self.idle = setting(idle, 'IMAP_IDLE', False)
+        self.partition = partition
+        self.prefetch_budget = setting(prefetch_budget,
+                                       'SYNC_PREFETCH_BUDGET',
+                                       10 * 1024 * 1024)
+        self.poll = poll
+        self.max_failures = max_failures
+        self.max_backoff = max_backoff
+        self.stats_interval = setting(stats_interval, 'SYNC_STATS_INTERVAL',
+                                      3600)
+
+        self._queue = Queue.Queue()
+        self._lock = threading.Lock()
+        self._servers = {}  # server -> number of running jobs
+        self._accounts = {}  # account -> number of running jobs
+        self._mailboxes = set()  # mailboxes being synced
+        self._failures = {}  # account -> number of consecutive failures
+        self._retry_at = {}  # account -> timestamp
+        self._last_sync = {}  # account -> timestamp
+        self._prefetched = {}  # account -> (timestamp, bytes)
+
+    def run(self, once=False):
+        """
+        Starts the worker threads and dispatches jobs until interrupted. With
+        ``once``, the jobs that are already queued are run and the daemon
+        stops.
+        """
+        workers = []
+        for i in range(self.threads):
+            worker = threading.Thread(target=self._work)
+            worker.setDaemon(True)
+            worker.start()
+            workers.append(worker)
+
+        logged = time.time()
+        while True:
+            if not once:
+                self.schedule()
+            dispatched = self.dispatch()
+            if once and not dispatched and not self._accounts:
+                break
+            time.sleep(self.poll)
+            if time.time() - logged >= self.stats_interval:
+                logger.info('Stats: %s' % self.stats())
+                logged = time.time()
+
+        for worker in workers:
+            self._queue.put(None)
+        for worker in workers:
+            worker.join()
+
+    def stats(self):
+        self._lock.acquire()
+        try:
+            running = sum(self._accounts.values())
+            failing = len(self._failures)
+        finally:
+            self._lock.release()
+        return {
+            'running': running,
+            'queued': self._queue.qsize(),
+            'failing': failing,
+            'pool': dict(pool.stats),
+            'bodies': MessageBody.stats(),
+        }
+
+    def schedule(self):
+        """
+        Queues the regular syncs of the accounts that are due and probes the
+        unhealthy ones.
+        """
+        now = time.time()
+        active_ids = set(active_accounts(self.active_timeout).values_list(
+            'id', flat=True))
+        idle_ids = self.idle and IdleMailbox.covered() or set()
+        for imap in IMAP.objects.all():
+            if not self.handles(imap.pk):
+                continue
+            if now < self._retry_at.get(imap.pk, 0):
+                continue
+
+            if not imap.healthy:
+                self._probe(imap)
+                continue
+
+            active = imap.pk in active_ids
+            interval = active and self.active_interval or self.interval
+            if now - self._last_sync.get(imap.pk, 0) < interval:
+                continue
+            self._last_sync[imap.pk] = now
+
+            priority = active and ACTIVE or BACKGROUND
+            enqueue(CHECK, imap, priority=priority)
+            for mailbox in imap.directories.filter(no_select=False):
+                if mailbox.pk in idle_ids:
+                    continue
+                bonus = mailbox.folder_type == INBOX and INBOX_BONUS or 0
+                enqueue(UPDATE, imap, mailbox=mailbox,
+                        priority=priority - bonus)
+
+    def handles(self, imap_id):
+        """
+        Tells if the account ``imap_id`` belongs to the partition of this
+        daemon.
+        """
+        if self.partition is None:
+            return True
+        index, count = self.partition
+        return imap_id % count == index
+
+    def dispatch(self):
+        """
+        Hands the queued jobs that can run right now to the worker threads.
+        Returns the number of dispatched jobs.
+        """
+        dispatched = 0
+        now = time.time()
+        servers = dict(IMAP.objects.values_list('id', 'server'))
+
+        for job in SyncJob.objects.order_by('priority', 'created'):
+            if not self.handles(job.imap):
+                continue
+            server = servers.get(job.imap)
+            if server is None:  # The account is gone
+                job.delete()
+                continue
+            if now < self._retry_at.get(job.imap, 0):
+                continue
+
+            self._lock.acquire()
+            try:
+                if self._accounts.get(job.imap, 0) >= self.per_account or \
+                   self._servers.get(server, 0) >= self.per_server or \
+                   (job.mailbox is not None and
+                    job.mailbox in self._mailboxes):
+                    continue
+                self._accounts[job.imap] = self._accounts.get(job.imap, 0) + 1
+                self._servers[server] = self._servers.get(server, 0) + 1
+                if job.mailbox is not None:
+                    self._mailboxes.add(job.mailbox)
+            finally:
+                self._lock.release()
+
+            job.delete()
+            self._queue.put((job, server))
+            dispatched += 1
+        return dispatched
+
+    def _work(self):
+        while True:
+            item = self._queue.get()
+            if item is None:
+                return
+            job, server = item
+            try:
+                try:
+                    if job.kind == PREFETCH and not self._charge(job):
+                        success = True
+                    else:
+                        success = run_job(job)
+                except (imaplib.IMAP4.error, socket.error):
+                    # The server or the connection, worth trying again
+                    logger.exception('%s failed' % job)
+                    success = False
+                except Exception:
+                    # A bug or bad data, retrying wouldn't help
+                    logger.exception('%s failed, dropped' % job)
+                    success = None
+                if success:
+                    self._failures.pop(job.imap, None)
+                    self._retry_at.pop(job.imap, None)
+                elif success is not None:
+                    self._failed(job)
+            finally:
+                self._lock.acquire()
+                try:
+                    self._accounts[job.imap] -= 1
+                    if not self._accounts[job.imap]:
+                        del self._accounts[job.imap]
+                    self._servers[server] -= 1
+                    self._mailboxes.discard(job.mailbox)
+                finally:
+                    self._lock.release()
+
+    def _charge(self, job):
+        """
+        Counts the bytes a prefetch job will download against the budget of
+        its account. Returns False if the budget is exhausted.
+        """
+        size = 0
+        for thread in Thread.objects(id=job.thread).only('messages'):
+            size = thread.missing_size()
+
+        now = time.time()
+        self._lock.acquire()
+        try:
+            start, spent = self._prefetched.get(job.imap, (now, 0))
+            if now - start > 3600:
+                start, spent = now, 0
+            if spent + size > self.prefetch_budget:
+                return False
+            self._prefetched[job.imap] = (start, spent + size)
+            return True
+        finally:
+            self._lock.release()
+
+    def _failed(self, job):
+        failures = self._failures.get(job.imap, 0) + 1
+        self._failures[job.imap] = failures
+        self._retry_at[job.imap] = time.time() + self._backoff(failures)
+        if failures >= self.max_failures:
+            logger.warning('Account %s marked as unhealthy' % job.imap)
+            IMAP.objects.filter(pk=job.imap).update(healthy=False)
+        # Trying again later
+        enqueue(job.kind, job.imap, mailbox=job.mailbox, thread=job.thread,
+                threads=job.threads, priority=job.priority,
+                action=job.action, destination=job.destination,
+                query=job.query)
+
+    def _backoff(self, failures):
+        return min(self.poll * 2 ** failures, self.max_backoff)
+
+    def _probe(self, imap):
+        """
+        Tries to log in to an unhealthy account, bypassing
+        ``IMAP.get_connection``.
+        """
+        try:
+            m = pool.get(imap)
+        except Exception:
+            m = None
+        if m is None:
+            failures = self._failures.get(imap.pk, 0) + 1
+            self._failures[imap.pk] = failures
+            self._retry_at[imap.pk] = time.time() + self._backoff(failures)
+            return
+        pool.put(imap, m)
+        logger.info('Account %s is healthy again' % imap.pk)
+        IMAP.objects.filter(pk=imap.pk).update(healthy=True)
+        self._failures.pop(imap.pk, None)
+        self._retry_at.pop(imap.pk, None)
@@ -3,8 +3,22 @@ import datetime
 from django import template
 from django.utils.tzinfo import LocalTimezone
 
+from mail.sidebar import get_sidebar
+
 register = template.Library()
 
+
+@register.inclusion_tag('inc/sidebar.html', takes_context=True)
+def sidebar(context):
+    """
+        Accounts and directories of the current user, see mail.sidebar
+    """
+    return {
+        'accounts': get_sidebar(context['user'].get_profile()),
+        'request': context['request'],
+    }
+
+
 @register.filter
 def numberize(instance, count_attr):
     """
@@ -0,0 +1,13 @@
+# -*- coding: utf-8 -*-
+"""
+Tests of the mail app. The benchmarks are skipped unless RUN_BENCHMARKS is
+set.
+"""
+from mail.tests.actions import *
+from mail.tests.benchmarks import *
+from mail.tests.mime import *
+from mail.tests.outbox import *
+from mail.tests.paging import *
+from mail.tests.pool import *
+from mail.tests.threader import *
+from mail.tests.views import *
@@ -0,0 +1,102 @@
+# -*- coding: utf-8 -*-
+from django.core.cache import cache
+from django.test import TestCase
+
+from mail.actions import apply_action, READ, DELETE, MOVE
+from mail.models import Thread, Mailbox, TRASH
+from mail.pool import pool
+from mail.sidebar import sidebar_key
+from mail.tests.fixtures import create_account, create_inbox, \
+                                create_mailbox, create_message, create_thread
+from mail.tests.imapserver import IMAPStandIn
+
+
+class ActionsTest(TestCase):
+    capabilities = ('IMAP4rev1', 'UIDPLUS', 'MOVE')
+
+    def setUp(self):
+        self.server = IMAPStandIn(capabilities=self.capabilities).start()
+        self.user, self.imap = create_account(port=self.server.port,
+                                              healthy=True)
+        self.inbox = create_inbox(self.imap)
+        self.trash = create_mailbox(self.imap, 'Trash', folder_type=TRASH)
+        self.thread = create_thread(self.inbox,
+                                    create_message(self.inbox, 1),
+                                    create_message(self.inbox, 2),
+                                    create_message(self.inbox, 5))
+
+    def tearDown(self):
+        pool.clear(self.imap)
+        self.server.stop()
+        Thread.objects.delete()
+        cache.delete(sidebar_key(self.user.get_profile().pk))
+
+    def unread(self):
+        return [Mailbox.objects.get(pk=mailbox.pk).unread
+                for mailbox in (self.inbox, self.trash)]
+
+    def uid_commands(self):
+        return [(command, args) for command, args in self.server.commands
+                if command in ('STORE', 'COPY', 'MOVE', 'EXPUNGE')]
+
+    def test_read(self):
+        self.assertTrue(apply_action([self.thread], READ))
+        self.assertEqual(self.uid_commands(),
+                         [('STORE', '1:2,5 +FLAGS.SILENT (\\Seen)')])
+        thread = Thread.objects.with_id(self.thread.id)
+        self.assertEqual(thread.unread, 0)
+        self.assertTrue(all([msg.read for msg in thread.messages]))
+
+    def test_delete(self):
+        Mailbox.objects.filter(pk=self.inbox.pk).update(synced_messages=3,
+                                                        unread=3)
+        cache.set(sidebar_key(self.user.get_profile().pk), [])
+        self.assertTrue(apply_action([self.thread], DELETE))
+        self.assertEqual(self.uid_commands(), [
+            ('STORE', '1:2,5 +FLAGS.SILENT (\\Deleted)'),
+            ('EXPUNGE', '1:2,5'),
+        ])
+        self.assertEqual(Thread.objects.count(), 0)
+        self.assertEqual(Mailbox.objects.get(pk=self.inbox.pk).synced_messages,
+                         0)
+        self.assertEqual(self.unread(), [0, 0])
+        self.assertEqual(cache.get(sidebar_key(self.user.get_profile().pk)),
+                         None)
+
+    def test_move(self):
+        Mailbox.objects.filter(pk=self.inbox.pk).update(unread=3)
+        self.assertTrue(apply_action([self.thread], MOVE, self.trash))
+        self.assertEqual(self.uid_commands(), [('MOVE', '1:2,5 "Trash"')])
+        thread = Thread.objects.with_id(self.thread.id)
+        self.assertEqual(thread.mailboxes, [self.trash.id])
+        self.assertEqual([msg.get_uid(self.trash.id)
+                          for msg in thread.messages], [100, 101, 102])
+        self.assertEqual(self.unread(), [0, 3])
+
+    def test_unreachable(self):
+        self.server.accept_login = False
+        self.assertFalse(apply_action([self.thread], READ))
+        thread = Thread.objects.with_id(self.thread.id)
+        self.assertEqual(thread.unread, 3)
+
+
+class ActionsWithoutExtensionsTest(ActionsTest):
+    capabilities = ('IMAP4rev1',)
+
+    def test_delete(self):
+        self.assertTrue(apply_action([self.thread], DELETE))
+        self.assertEqual(self.uid_commands(), [
+            ('STORE', '1:2,5 +FLAGS.SILENT (\\Deleted)'),
+            ('EXPUNGE', ''),
+        ])
+        self.assertEqual(Thread.objects.count(), 0)
+
+    def test_move(self):
+        self.assertTrue(apply_action([self.thread], MOVE, self.trash))
+        self.assertEqual(self.uid_commands(), [
+            ('COPY', '1:2,5 "Trash"'),
+            ('STORE', '1:2,5 +FLAGS.SILENT (\\Deleted)'),
+            ('EXPUNGE', ''),
+        ])
+        thread = Thread.objects.with_id(self.thread.id)
+        self.assertEqual(thread.mailboxes, [self.trash.id])
@@ -0,0 +1,377 @@
+# -*- coding: utf-8 -*-
+"""
+Benchmarks, run with RUN_BENCHMARKS = True:
+
+    ./manage.py test mail
+
+They print their figures and only check that the faster path gives the same
+results.
+"""
+import datetime
+import email.header
+import email.parser
+import gc
+import os
+import resource
+import time
+import unittest
+
+from django.conf import settings
+from django.db import connection
+from django.test import TransactionTestCase
+
+from mail import utils
+from mail.mime import parse_message
+from mail.models import Message, Mailbox, Thread, SyncJob
+from mail.pool import pool
+from mail.sync import SyncDaemon, enqueue, UPDATE
+from mail.tests.fixtures import create_account, create_inbox, create_mailbox
+from mail.tests.imapserver import IMAPStandIn
+from mail.threader import ThreadIndex
+
+benchmark = unittest.skipUnless(getattr(settings, 'RUN_BENCHMARKS', False),
+                                'RUN_BENCHMARKS is not set')
+
+# Size of the synthetic mailbox of the threading benchmark
+THREADING_MESSAGES = 100000
+
+# Sync benchmark: accounts, folders per account, seconds per IMAP command
+SYNC_ACCOUNTS = 8
+SYNC_FOLDERS = 4
+SYNC_LATENCY = 0.02
+
+# Header decoding benchmark: messages, distinct senders and subjects,
+# messages per FETCH response
+ENVELOPES = 20000
+ENVELOPE_SENDERS = 200
+ENVELOPE_SUBJECTS = 500
+ENVELOPE_WINDOW = 500
+
+
+def _report(name, figures):
+    print ''
+    print name
+    for label, value in figures:
+        print '    %-30s %s' % (label, value)
+
+
+def _peak_memory(function, *args):
+    """
+    Runs ``function(*args)`` in a child process and returns by how many KB
+    its peak memory grew.
+    """
+    read, write = os.pipe()
+    pid = os.fork()
+    if not pid:
+        os.close(read)
+        before = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+        function(*args)
+        after = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+        os.write(write, str(after - before))
+        os._exit(0)
+    os.close(write)
+    grown = int(os.read(read, 100) or 0)
+    os.close(read)
+    os.waitpid(pid, 0)
+    return grown
+
+
+def synthetic_mailbox(count, length=10, missing=7, drift=3):
+    """
+    ``count`` messages in conversations of ``length`` messages, each one
+    replying to the previous one. One message out of ``missing`` isn't in
+    the mailbox and the replies of one conversation out of ``drift`` change
+    subject, as it happens on mailing lists.
+    """
+    start = datetime.datetime(2010, 1, 1)
+    messages = []
+    uid = 0
+    for conversation in range(count / length):
+        references = []
+        subject = u'Topic %s' % conversation
+        for position in range(length):
+            message_id = '<%s.%s@example.com>' % (conversation, position)
+            uid += 1
+            if position and conversation % drift == 0:
+                subject = u'Re: Topic %s (was %s)' % (conversation, position)
+            elif position:
+                subject = u'Re: Topic %s' % conversation
+            message = Message(uids=[[1, uid]], message_id=message_id,
+                              references=list(references),
+                              in_reply_to=references and references[-1] or
+                                          None,
+                              subject=subject, fro=u'user%s' % position,
+                              date=start + datetime.timedelta(minutes=uid))
+            references.append(message_id)
+            if uid % missing:
+                messages.append(message)
+    return messages
+
+
+def thread_messages(messages):
+    """
+    Threads ``messages`` in memory, returns the number of threads.
+    """
+    index = ThreadIndex([1])
+    index.add_messages(messages, 1)
+    return len([key for key in index.threads if key not in index.aliases])
+
+
+class ThreadingBenchmark(unittest.TestCase):
+
+    @benchmark
+    def test_references(self):
+        messages = synthetic_mailbox(THREADING_MESSAGES)
+        conversations = THREADING_MESSAGES / 10
+
+        # What the threading saw before References were fetched: the
+        # In-Reply-To of the ENVELOPE and the subject.
+        envelope_only = []
+        for message in messages:
+            envelope_only.append(Message(
+                uids=message.uids, message_id=message.message_id,
+                in_reply_to=message.in_reply_to, subject=message.subject,
+                fro=message.fro, date=message.date))
+
+        started = time.time()
+        before = thread_messages(envelope_only)
+        before_time = time.time() - started
+
+        started = time.time()
+        after = thread_messages(messages)
+        after_time = time.time() - started
+
+        _report('Threading %s messages (%s conversations)' % (
+            len(messages), conversations), [
+            ('In-Reply-To and subject', '%s threads, %.2fs' % (before,
+                                                                before_time)),
+            ('References (JWZ)', '%s threads, %.2fs' % (after, after_time)),
+        ])
+        self.assertEqual(after, conversations)
+        self.assertTrue(before >= after)
+
+
+class SyncBenchmark(TransactionTestCase):
+    """
+    Syncs the folders of several accounts with more and more worker threads,
+    against a local server that answers each command after SYNC_LATENCY
+    seconds.
+
+    The workers need to share the test database: it can't be an in-memory
+    SQLite database (set TEST_NAME).
+    """
+
+    def setUp(self):
+        self.server = IMAPStandIn(latency=SYNC_LATENCY).start()
+        self.accounts = []
+        for i in range(SYNC_ACCOUNTS):
+            user, imap = create_account(username='user%s' % i,
+                                        port=self.server.port, healthy=True)
+            create_inbox(imap)
+            for j in range(SYNC_FOLDERS - 1):
+                create_mailbox(imap, 'Folder %s' % j)
+            self.accounts.append(imap)
+
+    def tearDown(self):
+        for imap in self.accounts:
+            pool.clear(imap)
+        self.server.stop()
+        Thread.objects.delete()
+        SyncJob.objects.delete()
+
+    def sync(self, threads):
+        for imap in self.accounts:
+            pool.clear(imap)
+        # A full sync every time
+        Mailbox.objects.update(uidvalidity=None, uidnext=None)
+        for mailbox in Mailbox.objects.all():
+            enqueue(UPDATE, mailbox.imap_id, mailbox=mailbox)
+        daemon = SyncDaemon(threads=threads, per_server=threads, poll=0.01)
+        started = time.time()
+        daemon.run(once=True)
+        return time.time() - started
+
+    @benchmark
+    def test_workers(self):
+        if connection.settings_dict['NAME'] in ('', ':memory:'):
+            self.skipTest('the test database is in memory')
+        figures = []
+        for threads in (1, 2, 4, 8):
+            figures.append(('%s thread(s)' % threads,
+                            '%.2fs' % self.sync(threads)))
+            self.assertEqual(SyncJob.objects.count(), 0)
+            self.assertEqual(Mailbox.objects.filter(
+                uidvalidity__isnull=True).count(), 0)
+        _report('Syncing %s accounts of %s folders, %sms per command' % (
+            SYNC_ACCOUNTS, SYNC_FOLDERS, int(SYNC_LATENCY * 1000)), figures)
+
+
+def _email_parser_bodies(raw):
+    """
+    What Message.parse did before mail.mime.parse_message: the whole MIME
+    tree is built and every part is decoded.
+    """
+    body = u''
+    html_body = u''
+    msg = email.parser.Parser().parsestr(raw)
+    for part in msg.walk():
+        payload = part.get_payload(decode=1)
+        charset = part.get_content_charset()
+        if charset is not None:
+            payload = payload.decode(charset)
+        if part.get_content_type() == 'text/plain':
+            body += payload
+        if part.get_content_type() == 'text/html':
+            html_body += payload
+    return body, html_body
+
+
+def _mime_message(content_type, body, **headers):
+    headers['Content-Type'] = content_type
+    headers.setdefault('MIME-Version', '1.0')
+    lines = ['%s: %s' % item for item in sorted(headers.items())]
+    return '\r\n'.join(lines) + '\r\n\r\n' + body
+
+
+def _multipart(subtype, parts, boundary):
+    body = ''.join(['--%s\r\n%s\r\n' % (boundary, part) for part in parts])
+    body += '--%s--\r\n' % boundary
+    return _mime_message('multipart/%s; boundary="%s"' % (subtype, boundary),
+                         body)
+
+
+def mime_corpus():
+    """
+    Raw messages of the MIME parsing benchmark:
+    (name, raw message, number of parsings).
+    """
+    text = u'Un caf\xe9 ? Na klar, gerne.\r\n' * 100
+    html = u'<html><body>%s</body></html>' % text.replace(u'\r\n',
+                                                          u'<br>\r\n')
+    plain = _mime_message('text/plain; charset="utf-8"',
+                          text.encode('utf-8'),
+                          **{'Content-Transfer-Encoding': '8bit'})
+    html_part = _mime_message('text/html; charset="utf-8"',
+                              html.encode('utf-8').encode('quoted-printable'),
+                              **{'Content-Transfer-Encoding':
+                                 'quoted-printable'})
+    alternative = _multipart('alternative', [plain, html_part], 'alt')
+
+    attachment = _mime_message(
+        'application/pdf; name="report.pdf"',
+        os.urandom(10 * 1024 * 1024).encode('base64'),
+        **{'Content-Transfer-Encoding': 'base64',
+           'Content-Disposition': 'attachment; filename="report.pdf"'})
+    images = [_mime_message('image/png', os.urandom(20 * 1024).encode(
+        'base64'), **{'Content-Transfer-Encoding': 'base64',
+                      'Content-ID': '<image%s@example.com>' % i})
+              for i in range(100)]
+    return [
+        ('plain', plain, 2000),
+        ('multipart', alternative, 2000),
+        ('huge attachment', _multipart('mixed', [plain, attachment],
+                                       'mixed'), 5),
+        ('newsletter', _multipart('related', [alternative] + images,
+                                  'related'), 50),
+    ]
+
+
+def _parse_all(parse, raw, count):
+    for i in xrange(count):
+        parse(raw)
+
+
+class MIMEBenchmark(unittest.TestCase):
+
+    @benchmark
+    def test_parse_message(self):
+        figures = []
+        for name, raw, count in mime_corpus():
+            expected = _email_parser_bodies(raw)
+            self.assertEqual(tuple([text.strip()
+                                    for text in parse_message(raw)]),
+                             tuple([text.strip() for text in expected]))
+            size = len(raw) * count / 1024. / 1024
+            for label, parse in (('email.parser', _email_parser_bodies),
+                                 ('parse_message', parse_message)):
+                started = time.time()
+                _parse_all(parse, raw, count)
+                elapsed = time.time() - started
+                memory = _peak_memory(_parse_all, parse, raw, count)
+                figures.append(('%s, %s' % (name, label),
+                                '%.0f msg/s, %.1f MB/s, +%s KB peak' % (
+                                    count / elapsed, size / elapsed,
+                                    memory)))
+        _report('Parsing raw messages', figures)
+
+
+class _NoCache(utils.HeaderCache):
+
+    def set(self, header, decoded):
+        pass
+
+
+def synthetic_envelopes(count, senders, subjects):
+    """
+    FETCH response of ``count`` ENVELOPEs, whose encoded display names and
+    subjects are taken from ``senders`` and ``subjects`` distinct values, as
+    on mailing lists.
+    """
+    response = {}
+    for uid in range(1, count + 1):
+        name = u'Andr\xe9 %s' % (uid % senders)
+        subject = u'[list] Caf\xe9 \u2014 topic %s' % (uid % subjects)
+        encoded = str(email.header.Header(subject, 'utf-8'))
+        sender = ((str(email.header.Header(name, 'iso-8859-1')), None,
+                   'user%s' % (uid % senders), 'example.com'),)
+        to = (('"List"', None, 'list', 'example.com'),)
+        response[uid] = {'ENVELOPE': (
+            'Fri, 1 Jan 2010 00:00:00 +0000', encoded, sender, sender,
+            sender, to, None, None, None, '<%s@example.com>' % uid)}
+    return response
+
+
+class HeaderBenchmark(unittest.TestCase):
+
+    def decode(self, windows, function):
+        gc.collect()
+        started = time.time()
+        decoded = {}
+        for window in windows:
+            decoded.update(function(window))
+        return decoded, time.time() - started
+
+    @benchmark
+    def test_decode_envelopes(self):
+        response = synthetic_envelopes(ENVELOPES, ENVELOPE_SENDERS,
+                                       ENVELOPE_SUBJECTS)
+        # Split like the FETCH responses of an import, see IMAP_FETCH_WINDOW
+        uids = sorted(response)
+        windows = [dict([(uid, response[uid])
+                         for uid in uids[i:i + ENVELOPE_WINDOW]])
+                   for i in range(0, len(uids), ENVELOPE_WINDOW)]
+
+        def one_by_one(window):
+            return dict([(uid, utils.decode_envelope(data['ENVELOPE']))
+                         for uid, data in window.items()])
+
+        cache = utils._header_cache
+        utils._header_cache = _NoCache(0)
+        try:
+            single, single_time = self.decode(windows, one_by_one)
+            batch, batch_time = self.decode(windows, utils.decode_envelopes)
+        finally:
+            utils._header_cache = cache
+
+        utils._header_cache.clear()
+        cached, cached_time = self.decode(windows, utils.decode_envelopes)
+
+        _report('Decoding %s envelopes (%s senders, %s subjects, %s per '
+                'response)' % (ENVELOPES, ENVELOPE_SENDERS, ENVELOPE_SUBJECTS,
+                               ENVELOPE_WINDOW), [
+            ('One by one, without the cache', '%.2fs' % single_time),
+            ('Batched, without the cache', '%.2fs' % batch_time),
+            ('Batched, with the cache', '%.2fs' % cached_time),
+        ])
+        self.assertEqual(batch, single)
+        self.assertEqual(cached, single)
@@ -0,0 +1,68 @@
+# -*- coding: utf-8 -*-
+"""
+Accounts, folders and threads for the tests.
+"""
+import datetime
+
+from django.contrib.auth.models import User
+
+from mail.models import IMAP, SMTP, Mailbox, Thread, Message, INBOX, NORMAL
+from users.models import Account
+
+
+def create_account(username='bob', server='127.0.0.1', port=143,
+                   healthy=False):
+    """
+    Creates a user with a single account, whose IMAP account is on
+    ``server``. Saving a healthy account lists its folders on the server:
+    the account is created as unhealthy and marked as ``healthy`` after.
+    """
+    user = User.objects.create_user(username, '%s@example.com' % username,
+                                    'secret')
+    imap = IMAP.objects.create(server=server, port=port, username=username,
+                               password='secret', healthy=False)
+    if healthy:
+        IMAP.objects.filter(pk=imap.pk).update(healthy=True)
+        imap.healthy = True
+    smtp = SMTP.objects.create(server=server, username=username,
+                               password='secret')
+    Account.objects.create(name='Work', email=user.email,
+                           profile=user.get_profile(), imap=imap, smtp=smtp)
+    return user, imap
+
+
+def create_mailbox(imap, name, folder_type=NORMAL, parent=None):
+    return Mailbox.objects.create(imap=imap, name=name, parent=parent,
+                                  folder_type=folder_type)
+
+
+def create_inbox(imap):
+    return create_mailbox(imap, 'INBOX', folder_type=INBOX)
+
+
+def create_message(mailbox, uid, date=None, subject=u'Hello', read=False,
+                   **kwargs):
+    if date is None:
+        date = datetime.datetime(2010, 1, 1) + datetime.timedelta(
+            minutes=uid)
+    kwargs.setdefault('message_id', '<%s.%s@example.com>' % (mailbox.id,
+                                                             uid))
+    return Message(uids=[[mailbox.id, uid]], date=date, subject=subject,
+                   fro=u'alice@example.com', read=read, **kwargs)
+
+
+def create_thread(mailbox, *messages):
+    """
+    Saves a thread of ``messages``, or of a single new message of
+    ``mailbox``.
+    """
+    messages = list(messages)
+    if not messages:
+        uid = Thread.objects(mailboxes=mailbox.id).count() + 1
+        messages = [create_message(mailbox, uid)]
+    thread = Thread(date=messages[0].date, messages=messages)
+    thread.update_mailboxes()
+    thread.update_summary()
+    thread.update_keywords()
+    thread.save(safe=True)
+    return thread
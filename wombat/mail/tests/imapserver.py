@@ -0,0 +1,176 @@
+# -*- coding: utf-8 -*-
+"""
+A local IMAP server standing in for a real one in the tests and benchmarks.
+
+It knows just enough of IMAP4rev1 to log in, list the folders and sync
+them (every folder is empty) and to accept the UID commands of the actions.
+``latency`` seconds are spent on each command, like the round-trip to a
+remote server.
+"""
+import SocketServer
+import threading
+import time
+
+from mail.utils import parse_uid_set, uid_ranges
+
+
+class IMAPHandler(SocketServer.StreamRequestHandler):
+
+    def handle(self):
+        self.send('* OK IMAP4rev1 stand-in ready')
+        self.server.count('connections')
+        while True:
+            # The responses of a command are sent in one go
+            self.wfile.flush()
+            line = self.rfile.readline()
+            if not line:
+                return
+            tokens = line.strip().split(' ', 2)
+            if len(tokens) < 2:
+                self.send('* BAD syntax error')
+                continue
+            tag, command = tokens[0], tokens[1].upper()
+            args = len(tokens) > 2 and tokens[2] or ''
+            if command == 'UID':
+                command, args = (args.split(' ', 1) + [''])[:2]
+                command = command.upper()
+            self.server.count(command)
+            self.server.commands.append((command, args))
+            time.sleep(self.server.latency)
+            handler = getattr(self, 'do_%s' % command, None)
+            if handler is None:
+                self.send('%s BAD unknown command' % tag)
+                continue
+            if command in self.server.refuse:
+                self.send('%s NO refused' % tag)
+                continue
+            if handler(tag, args) is False:
+                self.wfile.flush()
+                return
+
+    def send(self, line):
+        self.wfile.write(line + '\r\n')
+
+    def ok(self, tag, text='done'):
+        self.send('%s OK %s' % (tag, text))
+
+    def do_CAPABILITY(self, tag, args):
+        self.send('* CAPABILITY %s' % ' '.join(self.server.capabilities))
+        self.ok(tag)
+
+    def do_LOGIN(self, tag, args):
+        if not self.server.accept_login:
+            self.send('%s NO wrong password' % tag)
+            return
+        self.ok(tag, 'logged in')
+
+    def do_LIST(self, tag, args):
+        for name in self.server.folders:
+            self.send('* LIST (\\HasNoChildren) "/" "%s"' % name)
+        self.ok(tag)
+
+    def do_STATUS(self, tag, args):
+        name, items = args.split(' (', 1)
+        values = {'MESSAGES': 0, 'RECENT': 0, 'UNSEEN': 0, 'UIDNEXT': 1,
+                  'UIDVALIDITY': 1}
+        status = ' '.join(['%s %s' % (item, values.get(item.upper(), 0))
+                           for item in items.rstrip(')').split()])
+        self.send('* STATUS %s (%s)' % (name, status))
+        self.ok(tag)
+
+    def select(self):
+        self.send('* FLAGS (\\Answered \\Flagged \\Deleted \\Seen \\Draft)')
+        self.send('* 0 EXISTS')
+        self.send('* 0 RECENT')
+        self.send('* OK [UIDVALIDITY 1] UIDs valid')
+        self.send('* OK [UIDNEXT 1] Predicted next UID')
+
+    def do_SELECT(self, tag, args):
+        self.select()
+        self.ok(tag, '[READ-WRITE] selected')
+
+    def do_EXAMINE(self, tag, args):
+        self.select()
+        self.ok(tag, '[READ-ONLY] examined')
+
+    def do_SEARCH(self, tag, args):
+        self.send('* SEARCH')
+        self.ok(tag)
+
+    def copyuid(self, args):
+        source = parse_uid_set(args.split()[0])
+        destination = range(self.server.uidnext,
+                            self.server.uidnext + len(source))
+        self.server.uidnext += len(source)
+        return '[COPYUID 1 %s %s]' % (uid_ranges(source),
+                                      uid_ranges(destination))
+
+    def do_STORE(self, tag, args):
+        self.ok(tag)
+
+    def do_COPY(self, tag, args):
+        self.ok(tag, '%s copied' % self.copyuid(args))
+
+    def do_MOVE(self, tag, args):
+        self.send('* OK %s moved' % self.copyuid(args))
+        self.ok(tag)
+
+    def do_EXPUNGE(self, tag, args):
+        self.ok(tag)
+
+    def do_NOOP(self, tag, args):
+        self.ok(tag)
+
+    def do_CLOSE(self, tag, args):
+        self.ok(tag)
+
+    def do_LOGOUT(self, tag, args):
+        self.send('* BYE see you')
+        self.ok(tag)
+        return False
+
+
+class IMAPStandIn(SocketServer.ThreadingTCPServer):
+    """
+    Serves ``folders`` (a list of names) on a free port of localhost, in a
+    background thread, until ``stop`` is called. ``stats`` counts the
+    connections and the commands received, ``commands`` lists them with
+    their arguments. Logins are refused if ``accept_login`` is False, the
+    commands of ``refuse`` ('STORE'...) fail.
+
+    The messages copied or moved get UIDs from ``uidnext`` on.
+    """
+    allow_reuse_address = True
+    daemon_threads = True
+
+    def __init__(self, folders=('INBOX',), latency=0,
+                 capabilities=('IMAP4rev1', 'IDLE')):
+        SocketServer.ThreadingTCPServer.__init__(self, ('127.0.0.1', 0),
+                                                 IMAPHandler)
+        self.folders = list(folders)
+        self.latency = latency
+        self.capabilities = list(capabilities)
+        self.accept_login = True
+        self.refuse = set()
+        self.uidnext = 100
+        self.commands = []
+        self.port = self.server_address[1]
+        self.stats = {}
+        self._lock = threading.Lock()
+
+    def count(self, what):
+        self._lock.acquire()
+        try:
+            self.stats[what] = self.stats.get(what, 0) + 1
+        finally:
+            self._lock.release()
+
+    def start(self):
+        thread = threading.Thread(target=self.serve_forever)
+        thread.setDaemon(True)
+        thread.start()
+        return self
+
+    def stop(self):
+        self.shutdown()
+        self.server_close()
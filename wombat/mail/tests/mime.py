@@ -0,0 +1,135 @@
+# -*- coding: utf-8 -*-
+import base64
+import unittest
+
+from django.test import TestCase
+
+from mail.mime import parse_bodystructure, decode_text, decode_part, \
+                      decode_stream, parse_message
+from mail.models import Mailbox, Thread
+from mail.tests.fixtures import create_account, create_inbox, create_message
+
+PLAIN = ('Subject: Hello\r\n'
+         'Content-Type: text/plain; charset=iso-8859-1\r\n'
+         'Content-Transfer-Encoding: quoted-printable\r\n'
+         '\r\n'
+         'Caf=E9\r\n')
+
+MULTIPART = ('Subject: Report\r\n'
+             'Content-Type: multipart/mixed; boundary="outer"\r\n'
+             '\r\n'
+             'Preamble\r\n'
+             '--outer\r\n'
+             'Content-Type: multipart/alternative; boundary="inner"\r\n'
+             '\r\n'
+             '--inner\r\n'
+             'Content-Type: text/plain; charset=utf-8\r\n'
+             '\r\n'
+             'Plain text\r\n'
+             '--inner\r\n'
+             'Content-Type: text/html; charset=utf-8\r\n'
+             'Content-Transfer-Encoding: base64\r\n'
+             '\r\n'
+             '%s\r\n'
+             '--inner--\r\n'
+             '--outer\r\n'
+             'Content-Type: text/plain; name="notes.txt"\r\n'
+             'Content-Disposition: attachment; filename="notes.txt"\r\n'
+             '\r\n'
+             'Not the body\r\n'
+             '--outer--\r\n') % base64.encodestring('<p>HTML</p>').strip()
+
+
+class BodyStructureTest(unittest.TestCase):
+
+    def test_text(self):
+        parts = parse_bodystructure(('TEXT', 'PLAIN', ('CHARSET', 'UTF-8'),
+                                     None, None, '7BIT', 42, 3))
+        self.assertEqual(parts, [{
+            'part': '1',
+            'content_type': 'text/plain',
+            'charset': 'UTF-8',
+            'encoding': '7bit',
+            'size': 42,
+            'filename': None,
+            'attachment': False,
+        }])
+
+    def test_multipart(self):
+        structure = (
+            (('TEXT', 'PLAIN', ('CHARSET', 'utf-8'), None, None, '7BIT', 10,
+              1),
+             ('TEXT', 'HTML', ('CHARSET', 'utf-8'), None, None, 'BASE64',
+              20, 1),
+             'ALTERNATIVE'),
+            ('APPLICATION', 'PDF', ('NAME', 'report.pdf'), None, None,
+             'BASE64', 3000, None, ('ATTACHMENT', ('FILENAME', 'report.pdf')),
+             None),
+            ('MESSAGE', 'RFC822', None, None, None, '7BIT', 500, None, None,
+             5, None, ('INLINE', None)),
+            'MIXED')
+        parts = parse_bodystructure(structure)
+        self.assertEqual([part['part'] for part in parts],
+                         ['1.1', '1.2', '2', '3'])
+        self.assertEqual([part['attachment'] for part in parts],
+                         [False, False, True, True])
+        self.assertEqual(parts[1]['encoding'], 'base64')
+        self.assertEqual(parts[2]['filename'], u'report.pdf')
+        self.assertEqual(parts[2]['size'], 3000)
+
+    def test_empty(self):
+        self.assertEqual(parse_bodystructure(None), [])
+
+
+class DecodeTest(unittest.TestCase):
+
+    def test_charset_fallback(self):
+        self.assertEqual(decode_text('caf\xc3\xa9', 'unknown'), u'café')
+        self.assertEqual(decode_text('caf\xe9', 'utf-8'), u'café')
+        self.assertEqual(decode_text(u'café'), u'café')
+
+    def test_part(self):
+        self.assertEqual(decode_part('Y2Fmw6k=\n', 'base64', 'utf-8'),
+                         u'café')
+        self.assertEqual(decode_part('caf=E9', 'quoted-printable',
+                                     'iso-8859-1'), u'café')
+
+    def test_stream(self):
+        data = 'x' * 100 + 'y' * 57
+        encoded = base64.encodestring(data)
+        chunks = [encoded[i:i + 7] for i in range(0, len(encoded), 7)]
+        self.assertEqual(''.join(decode_stream(chunks, 'base64')), data)
+        self.assertEqual(''.join(decode_stream(chunks, 'base64', 95, 104)),
+                         data[95:105])
+
+    def test_stream_quoted_printable(self):
+        encoded = 'Caf=E9 au=\r\n lait\r\n'
+        chunks = [encoded[i:i + 3] for i in range(0, len(encoded), 3)]
+        self.assertEqual(''.join(decode_stream(chunks, 'quoted-printable')),
+                         'Caf\xe9 au lait\r\n')
+
+
+class ParseMessageTest(unittest.TestCase):
+
+    def test_plain(self):
+        self.assertEqual(parse_message(PLAIN), (u'Café\r\n', u''))
+
+    def test_multipart(self):
+        text, html = parse_message(MULTIPART)
+        self.assertEqual(text, u'Plain text')
+        self.assertEqual(html, u'<p>HTML</p>')
+
+    def test_no_text(self):
+        raw = ('Content-Type: multipart/mixed; boundary="b"\n\n'
+               '--b\nContent-Type: image/png\n\nPNG\n--b--\n')
+        self.assertEqual(parse_message(raw), (u'', u''))
+
+
+class FetchMissingTest(TestCase):
+
+    def test_deleted_mailbox(self):
+        user, imap = create_account()
+        inbox = create_inbox(imap)
+        thread = Thread(messages=[create_message(inbox, 1)])
+        Mailbox.objects.filter(pk=inbox.pk).delete()
+        self.assertEqual(thread.fetch_missing(), False)
@@ -0,0 +1,96 @@
+# -*- coding: utf-8 -*-
+from django.conf import settings
+from django.core.cache import cache
+from django.test import TestCase
+
+from mail.models import Mailbox, Thread, FlagChange, SyncJob
+from mail.outbox import mark_read, flush
+from mail.pool import connect
+from mail.sidebar import sidebar_key
+from mail.sync import FLUSH
+from mail.tests.fixtures import create_account, create_inbox, \
+                                create_mailbox, create_message, create_thread
+from mail.tests.imapserver import IMAPStandIn
+
+
+class OutboxTest(TestCase):
+
+    def setUp(self):
+        self.server = IMAPStandIn().start()
+        self.user, self.imap = create_account(port=self.server.port,
+                                              healthy=True)
+        self.inbox = create_inbox(self.imap)
+        self.archives = create_mailbox(self.imap, 'Archives')
+        self.thread = create_thread(self.inbox,
+                                    create_message(self.inbox, 1),
+                                    create_message(self.inbox, 2),
+                                    create_message(self.archives, 7))
+        Mailbox.objects.filter(pk=self.inbox.pk).update(unread=2)
+        Mailbox.objects.filter(pk=self.archives.pk).update(unread=1)
+        self.connection = connect(self.imap)
+
+    def tearDown(self):
+        self.connection.logout()
+        self.server.stop()
+        Thread.objects.delete()
+        FlagChange.objects.delete()
+        SyncJob.objects.delete()
+        cache.delete(self.sidebar_key())
+
+    def sidebar_key(self):
+        return sidebar_key(self.user.get_profile().pk)
+
+    def unread(self):
+        return [Mailbox.objects.get(pk=mailbox.pk).unread
+                for mailbox in (self.inbox, self.archives)]
+
+    def stores(self):
+        return sorted([args for command, args in self.server.commands
+                       if command == 'STORE'])
+
+    def test_mark_read(self):
+        cache.set(self.sidebar_key(), [])
+        self.assertEqual(mark_read([self.thread]), 3)
+        self.assertEqual(self.unread(), [0, 0])
+        self.assertEqual(cache.get(self.sidebar_key()), None)
+        # Nothing sent yet
+        self.assertEqual(self.stores(), [])
+        self.assertEqual(FlagChange.objects.count(), 3)
+        self.assertEqual(SyncJob.objects(kind=FLUSH,
+                                         imap=self.imap.pk).count(), 1)
+        thread = Thread.objects.with_id(self.thread.id)
+        self.assertEqual(thread.unread, 0)
+
+        # Already read
+        self.assertEqual(mark_read([thread]), 0)
+
+        self.assertEqual(mark_read([thread], read=False), 3)
+        self.assertEqual(self.unread(), [2, 1])
+
+    def test_counts_behind(self):
+        # The sync hasn't counted the messages yet
+        Mailbox.objects.filter(pk=self.inbox.pk).update(unread=1)
+        mark_read([self.thread])
+        self.assertEqual(self.unread(), [0, 0])
+
+    def test_flush(self):
+        mark_read([self.thread])
+        mark_read([Thread.objects.with_id(self.thread.id)], read=False)
+        flush(self.imap, self.connection)
+        # The last change wins, one command per mailbox
+        self.assertEqual(self.stores(), ['1:2 -FLAGS.SILENT (\\Seen)',
+                                         '7 -FLAGS.SILENT (\\Seen)'])
+        self.assertEqual(FlagChange.objects.count(), 0)
+
+    def test_refused(self):
+        self.server.refuse.add('STORE')
+        mark_read([self.thread])
+        attempts = getattr(settings, 'FLAG_OUTBOX_ATTEMPTS', 5)
+        for i in range(attempts - 1):
+            flush(self.imap, self.connection)
+            self.assertEqual(FlagChange.objects.count(), 3)
+        self.assertEqual(self.unread(), [0, 0])
+        flush(self.imap, self.connection)
+        self.assertEqual(FlagChange.objects.count(), 0)
+        # Still unread on the server
+        self.assertEqual(self.unread(), [2, 1])
@@ -0,0 +1,87 @@
+# -*- coding: utf-8 -*-
+from __future__ import absolute_import
+
+import datetime
+import unittest
+
+from django.core.cache import cache
+from django.test import TestCase
+
+from mail.models import Thread
+from mail.paging import make_cursor, parse_cursor, page_threads, \
+                        count_threads
+from mail.tests.fixtures import create_account, create_inbox, \
+                                create_mailbox, create_message, create_thread
+# wombat/utils.py, not mail.utils
+from utils import safe_cache_key
+
+
+class CursorTest(unittest.TestCase):
+
+    def test_invalid(self):
+        for cursor in (None, '', 'abc', '20100101000000000000_xyz',
+                       'a_b_c'):
+            self.assertEqual(parse_cursor(cursor), None)
+
+
+class PagingTest(TestCase):
+
+    def setUp(self):
+        self.user, self.imap = create_account()
+        self.inbox = create_inbox(self.imap)
+        self.other = create_mailbox(self.imap, 'Archives')
+        date = datetime.datetime(2010, 1, 1)
+        # Two threads per date, the ties are ordered by id
+        for uid in range(1, 8):
+            create_thread(self.inbox, create_message(
+                self.inbox, uid, date=date + datetime.timedelta(days=uid / 2)))
+        create_thread(self.other)
+        self.mbox_ids = [self.inbox.id]
+        self.expected = list(Thread.objects(mailboxes=self.inbox.id).order_by(
+            '-date', '-_id'))
+
+    def tearDown(self):
+        Thread.objects.delete()
+        cache.delete(self.count_key())
+
+    def count_key(self):
+        return safe_cache_key('thread_count_%s' % self.inbox.id)
+
+    def ids(self, threads):
+        return [thread.id for thread in threads]
+
+    def test_cursor(self):
+        thread = self.expected[0]
+        self.assertEqual(parse_cursor(make_cursor(thread)),
+                         (thread.date, thread.id))
+
+    def test_pages(self):
+        first, more = page_threads(self.mbox_ids, 3)
+        self.assertTrue(more)
+        self.assertEqual(self.ids(first), self.ids(self.expected[:3]))
+
+        second, more = page_threads(self.mbox_ids, 3,
+                                    before=make_cursor(first[-1]))
+        self.assertTrue(more)
+        self.assertEqual(self.ids(second), self.ids(self.expected[3:6]))
+
+        last, more = page_threads(self.mbox_ids, 3,
+                                  before=make_cursor(second[-1]))
+        self.assertFalse(more)
+        self.assertEqual(self.ids(last), self.ids(self.expected[6:]))
+
+        # And back
+        previous, more = page_threads(self.mbox_ids, 3,
+                                      after=make_cursor(last[0]))
+        self.assertTrue(more)
+        self.assertEqual(self.ids(previous), self.ids(second))
+
+    def test_invalid_cursor(self):
+        page, more = page_threads(self.mbox_ids, 3, before='garbage')
+        self.assertEqual(self.ids(page), self.ids(self.expected[:3]))
+
+    def test_count(self):
+        self.assertEqual(count_threads(self.mbox_ids), 7)
+        create_thread(self.inbox)
+        # Cached
+        self.assertEqual(count_threads(self.mbox_ids), 7)
@@ -0,0 +1,75 @@
+# -*- coding: utf-8 -*-
+import time
+import unittest
+
+from mail.models import IMAP
+from mail.pool import ConnectionPool, connect
+from mail.tests.imapserver import IMAPStandIn
+from mail.utils import has_capability
+
+
+class PoolTest(unittest.TestCase):
+
+    def setUp(self):
+        self.server = IMAPStandIn(
+            capabilities=('IMAP4rev1', 'IDLE', 'MOVE')).start()
+        self.imap = IMAP(pk=1, server='127.0.0.1', port=self.server.port,
+                         username='bob', password='secret')
+        self.pool = ConnectionPool(max_size=2, idle_timeout=60,
+                                   check_after=10, wait=0)
+
+    def tearDown(self):
+        self.pool.clear(self.imap)
+        self.server.stop()
+
+    def test_capabilities_after_login(self):
+        m = connect(self.imap)
+        self.assertEqual(self.server.stats['CAPABILITY'], 2)
+        self.assertTrue(has_capability(m, 'move'))
+        self.assertFalse(has_capability(m, 'QRESYNC'))
+        m.logout()
+
+    def test_login_refused(self):
+        self.server.accept_login = False
+        self.assertEqual(self.pool.get(self.imap), None)
+        # The slot of the failed connection is given back
+        self.assertEqual(self.pool._busy[self.imap.pk], 0)
+
+    def test_reuse(self):
+        m = self.pool.get(self.imap)
+        self.pool.put(self.imap, m)
+        self.assertTrue(self.pool.get(self.imap) is m)
+        self.assertEqual(self.pool.stats['misses'], 1)
+        self.assertEqual(self.pool.stats['hits'], 1)
+        self.assertEqual(self.server.stats['connections'], 1)
+
+    def test_discard(self):
+        m = self.pool.get(self.imap)
+        self.pool.put(self.imap, m, discard=True)
+        self.assertEqual(self.server.stats.get('LOGOUT'), 1)
+        self.assertFalse(self.pool.get(self.imap) is m)
+        self.assertEqual(self.pool.stats['misses'], 2)
+
+    def test_idle_timeout(self):
+        m = self.pool.get(self.imap)
+        self.pool.put(self.imap, m)
+        self.pool.idle_timeout = 0
+        self.assertFalse(self.pool.get(self.imap) is m)
+
+    def test_dead_connection(self):
+        m = self.pool.get(self.imap)
+        self.pool.put(self.imap, m)
+        self.pool._idle[self.imap.pk] = [(m, time.time() - 30)]
+        m._imap.shutdown()
+        self.assertFalse(self.pool.get(self.imap) is m)
+        self.assertEqual(self.pool.stats['reconnects'], 1)
+
+    def test_overflow(self):
+        connections = [self.pool.get(self.imap) for i in range(3)]
+        self.assertEqual(len(set(connections)), 3)
+        self.assertEqual(self.pool.stats['overflows'], 1)
+        for m in connections:
+            self.pool.put(self.imap, m)
+        # Only max_size connections are kept
+        self.assertEqual(len(self.pool._idle[self.imap.pk]), 2)
+        self.assertEqual(self.server.stats.get('LOGOUT'), 1)
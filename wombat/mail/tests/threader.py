@@ -0,0 +1,144 @@
+# -*- coding: utf-8 -*-
+import datetime
+import unittest
+
+from django.test import TestCase
+from pymongo.objectid import ObjectId
+
+from mail.models import Thread, Message
+from mail.threader import build_tree, ThreadIndex
+from mail.tests.fixtures import create_account, create_inbox, \
+                                create_message, create_thread
+
+START = datetime.datetime(2010, 1, 1)
+
+
+def message(number, references=(), subject=u'Topic', mbox_id=1):
+    """
+    Message ``<number@example.com>``, replying to the last of
+    ``references`` (numbers too).
+    """
+    references = ['<%s@example.com>' % ref for ref in references]
+    return Message(uids=[[mbox_id, number]],
+                   message_id='<%s@example.com>' % number,
+                   references=references,
+                   in_reply_to=references and references[-1] or None,
+                   subject=subject, fro=u'user%s' % number,
+                   date=START + datetime.timedelta(minutes=number))
+
+
+def numbers(container):
+    return sorted([int(c.message_id[1:].split('@')[0])
+                   for c in container.walk() if c.message is not None])
+
+
+class BuildTreeTest(unittest.TestCase):
+
+    def test_missing_parent(self):
+        # 2 is missing, 3 only knows it through its References
+        roots = build_tree([message(1), message(3, [1, 2])])
+        self.assertEqual(len(roots), 1)
+        self.assertEqual(numbers(roots[0]), [1, 3])
+
+    def test_order(self):
+        # Replies first
+        roots = build_tree([message(3, [1, 2]), message(2, [1]),
+                            message(1)])
+        self.assertEqual(len(roots), 1)
+        self.assertEqual(roots[0].message.message_id, '<1@example.com>')
+
+    def test_loop(self):
+        roots = build_tree([message(1, [2]), message(2, [1])])
+        self.assertEqual(len(roots), 1)
+        self.assertEqual(numbers(roots[0]), [1, 2])
+
+    def test_duplicates(self):
+        # Same message in two mailboxes
+        roots = build_tree([message(1, mbox_id=1), message(1, mbox_id=2)])
+        self.assertEqual(len(roots), 1)
+        self.assertEqual(len([c for c in roots[0].walk()
+                              if c.message is not None]), 2)
+
+
+class ThreadIndexTest(unittest.TestCase):
+
+    def thread(self, messages):
+        index = ThreadIndex([1])
+        index.add_messages(messages, 1)
+        return [index.threads[key] for key in index.threads
+                if key not in index.aliases]
+
+    def test_conversations(self):
+        threads = self.thread([message(1), message(2, [1]),
+                               message(3, subject=u'Other'),
+                               message(4, [1, 2])])
+        self.assertEqual(sorted([len(t.messages) for t in threads]), [1, 3])
+
+    def test_subject(self):
+        # No reference, a Re: is threaded with its subject
+        threads = self.thread([message(1), message(2, subject=u'Re: Topic'),
+                               message(3, subject=u'Re: Unknown')])
+        self.assertEqual(sorted([len(t.messages) for t in threads]), [1, 2])
+
+    def test_merge(self):
+        # 3 links the threads of 1 and 2
+        threads = self.thread([message(1, subject=u'A'),
+                               message(2, subject=u'B'),
+                               message(3, [1, 2], subject=u'C')])
+        self.assertEqual(len(threads), 1)
+        self.assertEqual(threads[0].messages_count, 3)
+
+    def stored(self, index, *messages):
+        thread = Thread(id=ObjectId(), date=messages[-1].date,
+                        messages=list(messages))
+        thread.update_mailboxes()
+        return index._register(thread)
+
+    def test_merge_stored(self):
+        index = ThreadIndex([1, 2, 3])
+        # Registered newest first, the oldest one is kept anyway
+        newer = self.stored(index, message(2, subject=u'B', mbox_id=3))
+        older = self.stored(index, message(1, subject=u'A', mbox_id=2))
+        index.add_messages([message(3, [1, 2], subject=u'C')], 1)
+
+        self.assertEqual(index.aliases, {newer: older})
+        self.assertEqual(index.deleted, [index.threads[newer].id])
+        thread = index.threads[older]
+        self.assertEqual([msg.uids for msg in thread.messages],
+                         [[[2, 1]], [[3, 2]], [[1, 3]]])
+        self.assertEqual(sorted(thread.mailboxes), [1, 2, 3])
+        self.assertEqual([(msg.message_id, mbox_id)
+                          for msg, mbox_id, existing in index.added[older]],
+                         [('<2@example.com>', 3), ('<3@example.com>', 1)])
+
+
+class ThreadIndexFlushTest(TestCase):
+
+    def setUp(self):
+        self.user, self.imap = create_account()
+        self.inbox = create_inbox(self.imap)
+
+    def tearDown(self):
+        Thread.objects.delete()
+
+    def test_flush(self):
+        first = create_message(self.inbox, 1, message_id='<1@example.com>')
+        thread = create_thread(self.inbox, first)
+
+        index = ThreadIndex([self.inbox.id])
+        batch = [create_message(self.inbox, 2, message_id='<2@example.com>',
+                                references=['<1@example.com>']),
+                 create_message(self.inbox, 3, subject=u'Other')]
+        index.load(batch)
+        index.add_messages(batch, self.inbox.id)
+        # Read while the batch was threaded
+        Thread.set_flags(self.inbox.id, {1: True})
+        index.flush()
+
+        self.assertEqual(Thread.objects.count(), 2)
+        thread = Thread.objects.with_id(thread.id)
+        self.assertEqual([msg.get_uid(self.inbox.id)
+                          for msg in thread.messages], [1, 2])
+        self.assertEqual(thread.messages_count, 2)
+        self.assertTrue(thread.messages[0].read)
+        self.assertEqual(thread.unread, 1)
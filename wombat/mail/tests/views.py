@@ -0,0 +1,82 @@
+# -*- coding: utf-8 -*-
+from django.conf import settings
+from django.core.urlresolvers import reverse
+from django.db import connection
+from django.test import TestCase
+
+from mail.models import Thread, SyncJob
+from mail.models.mongo import Part
+from mail.tests.fixtures import create_account, create_inbox, \
+                                create_mailbox, create_message, create_thread
+
+
+class ListingQueriesTest(TestCase):
+    """
+    The listings run the same number of SQL queries whatever the number of
+    threads on the page.
+    """
+
+    def setUp(self):
+        self.user, self.imap = create_account()
+        self.inbox = create_inbox(self.imap)
+        parent = create_mailbox(self.imap, 'Lists')
+        self.few = create_mailbox(self.imap, 'Lists/Django', parent=parent)
+        self.many = create_mailbox(self.imap, 'Lists/Python', parent=parent)
+        for i in range(3):
+            create_thread(self.few)
+        for i in range(50):
+            create_thread(self.many)
+        self.client.login(username='bob', password='secret')
+        self.debug = settings.DEBUG
+        settings.DEBUG = True
+
+    def tearDown(self):
+        settings.DEBUG = self.debug
+        Thread.objects.delete()
+        SyncJob.objects.delete()
+
+    def count_queries(self, mailbox):
+        url = reverse('directory', args=[mailbox.pk])
+        # The sidebar is cached by the first request
+        self.client.get(url)
+        start = len(connection.queries)
+        response = self.client.get(url)
+        self.assertEqual(response.status_code, 200)
+        threads = len(response.context['threads'])
+        return len(connection.queries) - start, threads
+
+    def test_directory(self):
+        few, few_threads = self.count_queries(self.few)
+        many, many_threads = self.count_queries(self.many)
+        self.assertEqual((few_threads, many_threads), (3, 50))
+        self.assertEqual(few, many)
+
+
+class AttachmentRangeTest(TestCase):
+    """
+    Unsatisfiable ranges of attachments sent as is are refused without
+    asking the server.
+    """
+
+    def setUp(self):
+        self.user, self.imap = create_account()
+        self.inbox = create_inbox(self.imap)
+        message = create_message(self.inbox, 1, attachments=[
+            Part(part='2', content_type='application/octet-stream',
+                 encoding='7bit', size=100, filename=u'data.bin')])
+        self.thread = create_thread(self.inbox, message)
+        self.url = reverse('attachment', args=[self.inbox.pk, self.thread.id,
+                                               message.oid, '2'])
+        self.client.login(username='bob', password='secret')
+
+    def tearDown(self):
+        Thread.objects.delete()
+
+    def get(self, header):
+        return self.client.get(self.url, HTTP_RANGE=header)
+
+    def test_unsatisfiable(self):
+        for header in ('bytes=100-', 'bytes=150-200', 'bytes=50-10'):
+            response = self.get(header)
+            self.assertEqual(response.status_code, 416)
+            self.assertEqual(response['Content-Range'], 'bytes */100')
@@ -0,0 +1,338 @@
+# -*- coding: utf-8 -*-
+"""
+Batch threading of new messages.
+
+This is Jamie Zawinski's threading algorithm, applied to a batch of messages
+and then to the threads stored in the DB (see
+http://www.jwz.org/doc/threading.html):
+
+* The container tree of the batch is built in one pass, using the
+  References and In-Reply-To headers. Messages that are referenced but
+  missing get an empty container, so that a chain with a missing message in
+  the middle still ends up in a single tree.
+* Each tree of the root set becomes a thread. The threads it may belong to
+  in the DB are found with an in-memory index (Message-ID, referenced ids,
+  subject) loaded with a few queries for the whole batch.
+* The threads are then written back in bulk: the new ones are inserted,
+  the messages added to the existing ones are pushed with atomic updates,
+  which keep the changes made to them in the meantime (flags).
+
+Folders of the same account can be synced in parallel but their batches are
+threaded one at a time, under ``account_lock``: the index of a batch always
+sees the threads written by the previous ones, so that a conversation spread
+over several folders ends up in a single thread.
+"""
+import threading
+
+from mail.models.mongo import Thread
+from mail.utils import clean_subject
+
+_locks = {}  # account id -> lock
+_locks_lock = threading.Lock()
+
+
+def account_lock(imap_id):
+    """
+    Returns the lock serializing the threading of the account ``imap_id``
+    in this process.
+    """
+    _locks_lock.acquire()
+    try:
+        return _locks.setdefault(imap_id, threading.Lock())
+    finally:
+        _locks_lock.release()
+
+
+class Container(object):
+    """
+    A node of the JWZ tree: a message, or an empty placeholder for a message
+    that is referenced but that we don't have.
+    """
+    __slots__ = ('message_id', 'message', 'parent', 'children')
+
+    def __init__(self, message_id=None):
+        self.message_id = message_id
+        self.message = None
+        self.parent = None
+        self.children = []
+
+    def has_descendant(self, other):
+        stack = list(self.children)
+        while stack:
+            container = stack.pop()
+            if container is other:
+                return True
+            stack.extend(container.children)
+        return False
+
+    def set_parent(self, parent):
+        if self.parent is not None:
+            self.parent.children.remove(self)
+        self.parent = parent
+        if parent is not None:
+            parent.children.append(self)
+
+    def walk(self):
+        stack = [self]
+        while stack:
+            container = stack.pop()
+            yield container
+            stack.extend(container.children)
+
+
+def build_tree(messages):
+    """
+    Links the messages together and returns the root set: the containers
+    that don't have a parent.
+    """
+    id_table = {}
+    containers = []
+
+    def get_container(message_id):
+        if message_id not in id_table:
+            container = Container(message_id)
+            id_table[message_id] = container
+            containers.append(container)
+        return id_table[message_id]
+
+    for message in messages:
+        duplicate_of = None
+        if message.message_id is not None:
+            container = get_container(message.message_id)
+            if container.message is not None:
+                # Same message in several mailboxes, keeping them together
+                duplicate_of = container
+                container = Container()
+                containers.append(container)
+        else:
+            container = Container()
+            containers.append(container)
+        container.message = message
+
+        # Linking the references together, without changing existing links
+        # and without creating loops.
+        parent = None
+        for message_id in message.ancestors:
+            ref = get_container(message_id)
+            if parent is not None and ref.parent is None and \
+               ref is not parent and not ref.has_descendant(parent):
+                ref.set_parent(parent)
+            parent = ref
+
+        # The last reference is the parent of this message, whatever we
+        # thought before.
+        if parent is not None and (parent is container or
+                                   container.has_descendant(parent)):
+            parent = None
+        if parent is None:
+            parent = duplicate_of
+        container.set_parent(parent)
+
+    return [c for c in containers if c.parent is None]
+
+
+class ThreadIndex(object):
+    """
+    In-memory index of the threads of an account, for a batch of messages.
+
+    Threads are referenced by integer keys since new threads don't have an
+    id until they are inserted. Merged threads are aliased to the thread
+    they've been merged into.
+    """
+
+    def __init__(self, mailboxes):
+        self.mailboxes = list(mailboxes)
+        self.threads = {}  # key -> Thread
+        self.aliases = {}  # merged key -> key
+        self.new = set()  # keys of threads that aren't in the DB yet
+        self.dirty = set()  # keys of threads that have to be saved
+        self.added = {}  # key -> [(message, mailbox id, existing message)]
+        self.deleted = []  # ids of merged threads to delete from the DB
+
+        self.by_id = {}  # thread id -> key
+        self.by_message_id = {}  # Message-ID -> set of keys
+        self.by_reference = {}  # referenced Message-ID -> set of keys
+        self.by_subject = {}  # subject -> key of the most recent thread
+
+    def load(self, messages):
+        """
+        Fetches the threads that may be related to ``messages`` from the DB:
+        one query per kind of lookup, whatever the size of the batch.
+        """
+        ids = set()
+        subjects = set()
+        for message in messages:
+            if message.message_id is not None:
+                ids.add(message.message_id)
+            ids.update(message.ancestors)
+            subject = clean_subject(message.subject)
+            if subject != message.subject:
+                subjects.add(subject)
+
+        queries = []
+        if ids:
+            ids = list(ids)
+            queries.append({'messages__message_id__in': ids})
+            queries.append({'messages__references__in': ids})
+            # Messages stored before References were fetched
+            queries.append({'messages__in_reply_to__in': ids})
+        if subjects:
+            queries.append({'messages__subject__in': list(subjects)})
+
+        for query in queries:
+            # Querysets are filtered in place, each lookup starts afresh
+            for thread in Thread.objects(mailboxes__in=self.mailboxes,
+                                         **query):
+                if thread.id not in self.by_id:
+                    self._register(thread)
+
+    def add_messages(self, messages, mbox_id):
+        """
+        Threads a batch of messages. Nothing is written until ``flush`` is
+        called.
+        """
+        trees = []
+        for root in build_tree(messages):
+            containers = list(root.walk())
+            found = [c.message for c in containers if c.message is not None]
+            if found:
+                found.sort(key=lambda m: m.date)
+                trees.append((containers, found))
+        # Oldest first, so that replies can be matched by subject with the
+        # threads created for the messages they reply to.
+        trees.sort(key=lambda tree: tree[1][0].date)
+
+        for containers, found in trees:
+            self._add_tree(containers, found, mbox_id)
+
+    def flush(self):
+        """
+        Writes the changes to the DB: one insert for all the new threads,
+        one update per message added to an existing thread and one delete
+        for the merged ones.
+        """
+        new = []
+        for key in self.dirty:
+            if key in self.aliases:
+                continue
+            thread = self.threads[key]
+            if key in self.new:
+                new.append(thread)
+            else:
+                for message, mbox_id, existing in self.added.get(key, []):
+                    thread.push_message(message, mbox_id, existing)
+
+        if new:
+            collection = Thread.objects._collection
+            ids = collection.insert([t.to_mongo() for t in new], safe=True)
+            for thread, thread_id in zip(new, ids):
+                thread.id = thread_id
+
+        if self.deleted:
+            Thread.objects(id__in=self.deleted).delete()
+
+        self.new = set()
+        self.dirty = set()
+        self.added = {}
+        self.deleted = []
+
+    def _add_tree(self, containers, messages, mbox_id):
+        keys = set()
+        for container in containers:
+            if container.message_id is not None:
+                keys.update(self._lookup(self.by_message_id,
+                                         container.message_id))
+                keys.update(self._lookup(self.by_reference,
+                                         container.message_id))
+
+        if not keys:
+            for message in messages:
+                subject = clean_subject(message.subject)
+                if subject != message.subject:
+                    # This is a Re: RE or whatever without any known
+                    # reference. Trying to guess which thread it's in.
+                    keys.update(self._lookup(self.by_subject, subject))
+                    break
+
+        if keys:
+            # The same thread survives whatever the order of the set: one
+            # from the DB, the oldest one.
+            key = min(keys, key=lambda k: (k in self.new,
+                                           self.threads[k].date, k))
+            keys.remove(key)
+            for other in sorted(keys):
+                self._merge(key, other)
+            thread = self.threads[key]
+        else:
+            first = messages[0]
+            thread = Thread(date=first.date, mailboxes=first.mailboxes,
+                            messages=[first])
+            thread.update_summary()
+            thread.update_keywords()
+            key = self._register(thread)
+            self.new.add(key)
+            messages = messages[1:]
+
+        for message in messages:
+            self._add_message(key, message, mbox_id)
+            self._index_message(key, thread, message)
+        self.dirty.add(key)
+
+    def _add_message(self, key, message, mbox_id):
+        thread = self.threads[key]
+        existing = thread.add_message(message, mbox_id, update=False)
+        if key not in self.new:
+            self.added.setdefault(key, []).append((message, mbox_id,
+                                                   existing))
+        return existing
+
+    def _find(self, key):
+        while key in self.aliases:
+            key = self.aliases[key]
+        return key
+
+    def _lookup(self, table, value):
+        found = table.get(value)
+        if found is None:
+            return set()
+        if not isinstance(found, set):
+            found = (found,)
+        return set([self._find(key) for key in found])
+
+    def _register(self, thread):
+        key = len(self.threads)
+        self.threads[key] = thread
+        if thread.id is not None:
+            self.by_id[thread.id] = key
+        for message in thread.messages:
+            self._index_message(key, thread, message)
+        return key
+
+    def _index_message(self, key, thread, message):
+        if message.message_id is not None:
+            self.by_message_id.setdefault(message.message_id, set()).add(key)
+        for message_id in message.ancestors:
+            self.by_reference.setdefault(message_id, set()).add(key)
+        if message.subject:
+            current = self.by_subject.get(message.subject)
+            if current is None or \
+               self.threads[self._find(current)].date <= thread.date:
+                self.by_subject[message.subject] = key
+
+    def _merge(self, key, other):
+        """
+        Moves the messages of thread ``other`` into thread ``key``, each one
+        with the mailboxes it is in.
+        """
+        other_thread = self.threads[other]
+        for message in other_thread.messages:
+            mailboxes = message.mailboxes
+            existing = self._add_message(key, message, mailboxes[0])
+            if existing is not None:
+                # A copy is already there, it gets the other UIDs too
+                for mbox_id in mailboxes[1:]:
+                    self._add_message(key, message, mbox_id)
+        self.aliases[other] = key
+        self.dirty.add(key)
+        if other not in self.new:
+            self.deleted.append(other_thread.id)
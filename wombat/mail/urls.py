@@ -5,17 +5,18 @@ msg = '(?P<uid>[a-f0-9]{24})'
 
 urlpatterns = patterns('mail.views',
     url(r'^$', 'inbox', name='inbox'),
-    url(r'^p/(?P<page>\d+)/$', 'inbox', name='inbox'),
     url(r'^check/$', 'check_mail', name='check_mail'),
     url(r'^check/inboxes/$', 'check_directory', name='check_directory'),
     url(r'^compose/$', 'compose', name='compose'),
+    url(r'^search/$', 'search', name='search'),
+    url(r'^actions/$', 'bulk_action', name='bulk_action'),
 
     url(r'^%(mbox)s/$' % locals(), 'directory', name='directory'),
-    url(r'^%(mbox)s/p/(?P<page>\d+)/$' % locals(),
-        'directory', name='directory'),
 
     url(r'^%(mbox)s/check/$' % locals(),
         'check_directory', name='check_directory'),
 
     url(r'^%(mbox)s/%(msg)s/$' % locals(), 'message', name='message'),
+    url(r'^%(mbox)s/%(msg)s/(?P<message_id>[a-f0-9]{24})/'
+        r'(?P<part>[\d.]+)/$' % locals(), 'attachment', name='attachment'),
 )
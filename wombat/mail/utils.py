@@ -1,22 +1,97 @@
+import collections
 import email.header
+import imaplib
 import re
+import threading
 
 SUBJECT_RE = re.compile(r'^(\[[^\]]+\])?\s*re\s*:\s+(.*)$', re.IGNORECASE)
+MESSAGE_ID_RE = re.compile(r'<[^<>\s]+>')
+WORD_RE = re.compile(r'\w+', re.UNICODE)
+WORD_MIN_LENGTH = 2
+WORD_MAX_LENGTH = 40
+LIST_RE = re.compile(r'^\((?P<flags>[^)]*)\) '
+                     r'(?P<delimiter>NIL|"(?:\\.|[^"])*") ?(?P<name>.*)$',
+                     re.IGNORECASE)
+STATUS_RE = re.compile(r'^(?P<name>.*?) ?\((?P<items>[^()]*)\)\s*$')
+LITERAL_RE = re.compile(r'\{\d+\}$')
+FETCH_UID_RE = re.compile(r'\bUID (\d+)', re.IGNORECASE)
+FETCH_FLAGS_RE = re.compile(r'\bFLAGS \(([^)]*)\)', re.IGNORECASE)
+# COPYUID response code, tagged ('[COPYUID 38 1:3 10:12] Done') or
+# untagged (stored by imaplib as '38 1:3 10:12')
+COPYUID_RE = re.compile(r'^(?:\[COPYUID )?\d+ ([\d:,]+) ([\d:,]+)',
+                        re.IGNORECASE)
 
+# Decoded headers kept in memory: mailing lists repeat the same encoded
+# names and subjects over and over.
+HEADER_CACHE_SIZE = 10000
 
-def address_struct_to_addresses(address_struct):
+# Address fields of an ENVELOPE and their position
+ENVELOPE_ADDRESSES = (
+    ('from', 2),
+    ('sender', 3),
+    ('reply-to', 4),
+    ('to', 5),
+    ('cc', 6),
+    ('bcc', 7),
+)
+
+
+class HeaderCache(object):
+    """
+    Decoded headers, at most ``size`` of them. When it's full, the oldest
+    half is dropped: the headers that keep coming back are decoded again
+    once and stay, instead of the whole cache starting over.
+    """
+
+    def __init__(self, size):
+        self.size = size
+        self._decoded = {}
+        self._order = collections.deque()  # Oldest first
+        self._lock = threading.Lock()
+
+    def get(self, header):
+        return self._decoded.get(header)
+
+    def set(self, header, decoded):
+        self._lock.acquire()
+        try:
+            if header in self._decoded:
+                return
+            if len(self._order) >= self.size:
+                for i in range(max(self.size / 2, 1)):
+                    del self._decoded[self._order.popleft()]
+            self._decoded[header] = decoded
+            self._order.append(header)
+        finally:
+            self._lock.release()
+
+    def clear(self):
+        self._lock.acquire()
+        try:
+            self._decoded.clear()
+            self._order.clear()
+        finally:
+            self._lock.release()
+
+
+_header_cache = HeaderCache(HEADER_CACHE_SIZE)
+
+
+def address_struct_to_addresses(address_struct, decode=None):
     """
     Converts an IMAP "address structure" to a proper list of email
     addresses with a format looking like:
         ('First Last <username@example.com>',
          'Other Dude <foo.bar@baz.org>')
     """
+    if decode is None:
+        decode = clean_header
     addresses = []
     for name, at_domain, mailbox_name, host in address_struct:
         if name is None:
             addresses.append('%s@%s' % (mailbox_name, host))
             continue
-        name = clean_header(name)
+        name = decode(name)
         cleaned = '%s <%s@%s>' % (name, mailbox_name, host)
         addresses.append(cleaned)
     return addresses
@@ -31,6 +106,14 @@ def clean_header(header):
     """
     if header is None:
         return ''
+    if '=?' not in header and not header.startswith('"'):
+        # Nothing to decode
+        return header
+    decoded = _header_cache.get(header)
+    if decoded is not None:
+        return decoded
+
+    raw = header
     if header.startswith('"'):
         header = header.replace('"', '')
     cleaned = email.header.decode_header(header)
@@ -45,9 +128,91 @@ def clean_header(header):
         else:
             decoded = element[0]
         assembled += '%s%s' % (separator, decoded)
+
+    _header_cache.set(raw, assembled)
     return assembled
 
 
+def decode_envelope(envelope, decode=None):
+    """
+    Decodes an ENVELOPE structure to a dict: 'subject', 'in-reply-to',
+    'message-id' and the lists of addresses 'from', 'sender', 'reply-to',
+    'to', 'cc' and 'bcc' (None if missing).
+
+    ``decode`` cleans the subject and the names, ``clean_header`` by default.
+    """
+    if decode is None:
+        decode = clean_header
+    decoded = {
+        'subject': decode(envelope[1]),
+        'in-reply-to': envelope[8],
+        'message-id': envelope[9],
+    }
+    for key, index in ENVELOPE_ADDRESSES:
+        value = envelope[index]
+        if value is not None:
+            value = address_struct_to_addresses(value, decode)
+        decoded[key] = value
+    return decoded
+
+
+def decode_envelopes(response):
+    """
+    Decodes the ENVELOPEs of a whole FETCH response at once. Returns a
+    {uid: envelope} dict, see ``decode_envelope``.
+
+    The distinct subjects and names of the response are collected first and
+    each one is decoded once, however many messages share it.
+    """
+    envelopes = dict([(uid, data['ENVELOPE'])
+                      for uid, data in response.items() if 'ENVELOPE' in data])
+    headers = set()
+    for envelope in envelopes.values():
+        headers.add(envelope[1])
+        for key, index in ENVELOPE_ADDRESSES:
+            for address in envelope[index] or ():
+                if address[0] is not None:
+                    headers.add(address[0])
+    decoded = dict([(header, clean_header(header)) for header in headers])
+    return dict([(uid, decode_envelope(envelope, decoded.__getitem__))
+                 for uid, envelope in envelopes.items()])
+
+
+def uid_ranges(uids):
+    """
+    Compresses a list of UIDs to an IMAP sequence set: [1, 2, 3, 5] becomes
+    '1:3,5'.
+    """
+    ranges = []
+    start = end = None
+    for uid in sorted(uids):
+        if end is not None and uid == end + 1:
+            end = uid
+            continue
+        if start is not None:
+            ranges.append(start == end and str(start) or
+                          '%s:%s' % (start, end))
+        start = end = uid
+    if start is not None:
+        ranges.append(start == end and str(start) or '%s:%s' % (start, end))
+    return ','.join(ranges)
+
+
+def parse_references(header):
+    """
+    Extracts the list of message ids from a References header, as returned
+    by ``FETCH BODY[HEADER.FIELDS (REFERENCES)]``. The ids keep their angle
+    brackets, like the ones in ENVELOPE responses.
+    """
+    if not header:
+        return []
+    ids = []
+    for message_id in MESSAGE_ID_RE.findall(header):
+        if message_id not in ids:
+            ids.append(message_id)
+    return ids
+
+
 def clean_subject(subject):
     """
     Removes the Re: RE : RE: crap from a subject.
@@ -57,3 +222,263 @@ def clean_subject(subject):
         subject = ' '.join([m for m in match.groups() if m is not None])
         match = SUBJECT_RE.match(subject)
     return subject
+
+
+def has_capability(connection, capability):
+    """
+    Checks if the server behind an IMAPClient connection advertises
+    ``capability`` (CONDSTORE, QRESYNC, MOVE...).
+
+    The capabilities sent after LOGIN are stored on the connection by the
+    pool, the ones sent before are used otherwise.
+    """
+    capabilities = getattr(connection, '_capabilities', None)
+    if capabilities is None:
+        capabilities = connection._imap.capabilities
+    return capability.upper() in capabilities
+
+
+def enable_qresync(connection):
+    """
+    Sends ENABLE QRESYNC (RFC 5162) if the server supports it. Must be called
+    before selecting a folder. The result is remembered on the connection
+    since pooled connections are reused.
+
+    Returns True if QRESYNC is enabled.
+    """
+    if getattr(connection, '_qresync', None) is not None:
+        return connection._qresync
+
+    connection._qresync = False
+    if has_capability(connection, 'QRESYNC'):
+        if 'ENABLE' not in imaplib.Commands:
+            # RFC 5161, unknown to imaplib
+            imaplib.Commands['ENABLE'] = ('AUTH',)
+        typ, data = connection._imap._simple_command('ENABLE', 'QRESYNC')
+        connection._qresync = typ == 'OK'
+    return connection._qresync
+
+
+def pop_vanished(connection):
+    """
+    Returns the set of UIDs reported as expunged by the VANISHED responses
+    (RFC 5162) received on this connection.
+    """
+    uids = set()
+    for data in connection._imap.untagged_responses.pop('VANISHED', []):
+        if data.upper().startswith('(EARLIER)'):
+            data = data[len('(EARLIER)'):]
+        uids.update(parse_uid_set(data.strip()))
+    return uids
+
+
+def fetch_changed_flags(connection, uid_set, modseq, vanished=False):
+    """
+    Returns the {UID: seen} flags of the messages of ``uid_set`` whose flags
+    changed since ``modseq`` (CHANGEDSINCE, RFC 4551). With ``vanished``
+    (QRESYNC only), the server also reports the expunged messages, they are
+    left for ``pop_vanished``.
+
+    IMAPClient can't send FETCH modifiers, the command is sent through
+    imaplib.
+    """
+    modifiers = 'CHANGEDSINCE %s' % modseq
+    if vanished:
+        modifiers += ' VANISHED'
+    imap = connection._imap
+    imap.untagged_responses.pop('FETCH', None)
+    typ, data = imap._simple_command('UID', 'FETCH', uid_set, '(FLAGS)',
+                                     '(%s)' % modifiers)
+    if typ != 'OK':
+        raise imaplib.IMAP4.error('UID FETCH failed: %s' % data)
+    flags = {}
+    for line, literal in _untagged_lines(
+            imap.untagged_responses.pop('FETCH', [])):
+        uid = FETCH_UID_RE.search(line)
+        seen = FETCH_FLAGS_RE.search(line)
+        if uid is None or seen is None:
+            continue
+        flags[int(uid.group(1))] = '\\SEEN' in seen.group(1).upper().split()
+    return flags
+
+
+def discard_expunges(connection):
+    """
+    Drops the EXPUNGE and VANISHED responses caused by our own commands, so
+    that they aren't taken for the expunges of another folder later on.
+    """
+    for response in ('EXPUNGE', 'VANISHED'):
+        connection._imap.untagged_responses.pop(response, None)
+
+
+def parse_copyuid(data):
+    """
+    Returns the {source UID: destination UID} mapping of the COPYUID
+    response code (RFC 4315) found in ``data``, a list of response lines.
+    Empty if the server didn't send one (no UIDPLUS support).
+    """
+    for line in data:
+        match = COPYUID_RE.search(line or '')
+        if match is not None:
+            return dict(zip(parse_uid_set(match.group(1)),
+                            parse_uid_set(match.group(2))))
+    return {}
+
+
+def parse_uid_set(uid_set):
+    """
+    Expands an IMAP sequence set such as '1:3,7' to a list of integers:
+    [1, 2, 3, 7].
+    """
+    uids = []
+    for token in uid_set.split(','):
+        if ':' in token:
+            first, last = sorted(map(int, token.split(':')))
+            uids.extend(range(first, last + 1))
+        elif token:
+            uids.append(int(token))
+    return uids
+
+
+def _untagged_lines(data):
+    """
+    Yields (line, literal) for each untagged response stored by imaplib. A
+    response containing a literal (a folder name, here) is split in several
+    items: the literal is returned apart and removed from the line.
+    """
+    data = [item for item in data if item is not None]
+    i = 0
+    while i < len(data):
+        item = data[i]
+        if isinstance(item, tuple):
+            line = LITERAL_RE.sub('', item[0])
+            if i + 1 < len(data) and not isinstance(data[i + 1], tuple):
+                i += 1
+                line += data[i]
+            yield line, item[1]
+        else:
+            yield item, None
+        i += 1
+
+
+def _unquote(string):
+    if len(string) >= 2 and string[0] == string[-1] == '"':
+        return string[1:-1].replace('\\"', '"').replace('\\\\', '\\')
+    return string
+
+
+def _decode_folder_name(connection, name):
+    if getattr(connection, 'folder_encode', False):
+        from imapclient import imap_utf7
+        return imap_utf7.decode(name)
+    return name
+
+
+def encode_folder_name(connection, name):
+    """
+    Returns the quoted name of a folder, to send in a raw command.
+    """
+    if getattr(connection, 'folder_encode', False):
+        from imapclient import imap_utf7
+        name = imap_utf7.encode(name)
+    return _quote(name)
+
+
+def _quote(string):
+    return '"%s"' % string.replace('\\', '\\\\').replace('"', '\\"')
+
+
+def _parse_status(line, literal):
+    match = STATUS_RE.match(line)
+    if match is None:
+        return None, None
+    name = literal is None and _unquote(match.group('name')) or literal
+    items = match.group('items').split()
+    status = {}
+    for i in range(0, len(items) - 1, 2):
+        status[items[i].upper()] = int(items[i + 1])
+    return name, status
+
+
+def list_folders(connection, status=None):
+    """
+    Lists every folder of an account with a single ``LIST "" "*"``. Returns
+    a list of (flags, delimiter, name, status) tuples. The flags are
+    lowercased.
+
+    If ``status`` is a list of STATUS items (MESSAGES, UNSEEN...), the status
+    of each selectable folder is returned as a dict, in the same round-trip
+    if the server supports LIST-STATUS (RFC 5819). Otherwise the STATUS
+    commands are pipelined: they are all sent before reading the responses.
+    """
+    imap = connection._imap
+    args = ['""', '"*"']
+    list_status = status and has_capability(connection, 'LIST-STATUS')
+    if list_status:
+        args.extend(['RETURN', '(STATUS (%s))' % ' '.join(status)])
+    typ, data = imap._simple_command('LIST', *args)
+    typ, data = imap._untagged_response(typ, data, 'LIST')
+    if typ != 'OK':
+        raise imaplib.IMAP4.error('LIST failed: %s' % data)
+
+    folders = []
+    for line, literal in _untagged_lines(data):
+        match = LIST_RE.match(line)
+        if match is None:
+            continue
+        name = literal is None and _unquote(match.group('name')) or literal
+        delimiter = match.group('delimiter')
+        if delimiter.upper() == 'NIL':
+            delimiter = None
+        else:
+            delimiter = _unquote(delimiter)
+        flags = [flag.lower() for flag in match.group('flags').split()]
+        folders.append((flags, delimiter, name))
+
+    statuses = {}
+    if status and not list_status:
+        names = [folder_name
+                 for folder_flags, folder_delimiter, folder_name in folders
+                 if '\\noselect' not in folder_flags and
+                 '\\nonexistent' not in folder_flags]
+        tags = [imap._command('STATUS', _quote(folder_name),
+                              '(%s)' % ' '.join(status))
+                for folder_name in names]
+        for tag in tags:
+            imap._command_complete('STATUS', tag)
+    if status:
+        for line, literal in _untagged_lines(
+                imap.untagged_responses.pop('STATUS', [])):
+            name, values = _parse_status(line, literal)
+            if name is not None:
+                statuses[name] = values
+
+    return [(folder_flags, folder_delimiter,
+             _decode_folder_name(connection, folder_name),
+             statuses.get(folder_name))
+            for folder_flags, folder_delimiter, folder_name in folders]
+
+
+def tokenize(text):
+    """
+    Returns the set of the words of ``text``, lowercased. Used to build the
+    search index, see ``mail.search``.
+    """
+    if not text:
+        return set()
+    if isinstance(text, str):
+        text = text.decode('utf-8', 'replace')
+    return set([word for word in WORD_RE.findall(text.lower())
+                if WORD_MIN_LENGTH <= len(word) <= WORD_MAX_LENGTH])
+
+
+def message_keywords(message):
+    """
+    The words a message can be found with: subject, addresses and body.
+    """
+    words = set()
+    for text in [message.subject, message.fro, message.body] + \
+                list(message.to or []) + list(message.cc or []):
+        words.update(tokenize(text))
+    return words
+
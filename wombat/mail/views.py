@@ -1,21 +1,104 @@
 # -*- coding: utf-8 -*-
+import re
 
 from django.contrib import messages
 from django.contrib.auth.decorators import login_required
 from django.core.urlresolvers import reverse
-from django.http import Http404
+from django.http import Http404, HttpResponse
 from django.shortcuts import get_object_or_404, get_list_or_404, redirect
+from django.utils.http import urlencode
 from django.utils.translation import ugettext as _
 
 from shortcuts import render
 
-from mail.models import IMAP, Mailbox, Thread, INBOX
-from mail.forms import MailForm, ActionForm, MoveForm
+from mail.models import IMAP, Mailbox, Thread, INBOX, OUTBOX
+from mail.forms import MailForm, ActionForm, MoveForm, BulkActionForm
+from mail.actions import READ, UNREAD
+from mail.mime import decode_stream
+from mail.outbox import mark_read
+from mail.paging import (PAGE_SIZES, count_threads, make_cursor,
+                         page_threads)
+from mail.search import search_threads, search_server
+from mail.sync import enqueue, prefetch, UPDATE, CHECK, FETCH, ACTION
+
+RANGE_RE = re.compile(r'^bytes=(\d+)-(\d*)$')
+CHECKBOX_RE = re.compile(r'^m_([a-f0-9]{24})$')
+
+
+def _label_threads(threads, unified=False, directory=None):
+    """
+    Sets ``thread.labels`` to the names of the mailboxes each thread is in,
+    except the outboxes and the inboxes (``unified`` listings) or
+    ``directory``. The mailboxes of all the threads are loaded with a
+    single query.
+    """
+    ids = set()
+    for thread in threads:
+        ids.update(thread.mailboxes)
+    mailboxes = Mailbox.objects.filter(id__in=ids).exclude(
+        folder_type=OUTBOX).select_related('parent')
+
+    labels = {}
+    for mailbox in mailboxes:
+        if unified and mailbox.folder_type == INBOX:
+            continue
+        if directory is not None and mailbox.id == directory.id:
+            continue
+        parent = None
+        if mailbox.parent_id is not None:
+            parent = mailbox.parent
+        labels[mailbox.id] = mailbox.get_label(parent)
+
+    for thread in threads:
+        thread.labels = [labels[mbox_id] for mbox_id in thread.mailboxes
+                         if mbox_id in labels]
+    return labels
+
+
+def _listing(request, mbox_ids, url):
+    """
+    Context of a page of the threads of ``mbox_ids``, whose listing is at
+    ``url``. The page is given by the ``before`` or ``after`` cursors of
+    the GET parameters, ``start`` is the position of its first thread.
+    """
+    size = request.user.get_profile().get_page_size()
+    if size not in PAGE_SIZES:
+        size = PAGE_SIZES[0]
+    before = request.GET.get('before')
+    after = request.GET.get('after')
+    try:
+        start = max(int(request.GET.get('start', 1)), 1)
+    except ValueError:
+        start = 1
+
+    total = count_threads(mbox_ids)
+    threads, more = page_threads(mbox_ids, size, before=before, after=after)
+    if after is not None and not more:
+        # Back to the first page
+        start = 1
+    prefetch(Thread.objects(id__in=[thread.id for thread in threads]))
+    context = {
+        'bulk_form': BulkActionForm(request.user.get_profile()),
+        'threads': threads,
+        'begin': start,
+        'end': start + len(threads) - 1,
+        'total': total,
+    }
+    if threads and (more or after is not None):
+        context['next_url'] = '%s?%s' % (url, urlencode({
+            'before': make_cursor(threads[-1]),
+            'start': start + len(threads),
+        }))
+    if threads and (more or before is not None) and start > 1:
+        context['previous_url'] = '%s?%s' % (url, urlencode({
+            'after': make_cursor(threads[0]),
+            'start': max(start - size, 1),
+        }))
+    return context
 
 
 @login_required
-def inbox(request, account_slug=None, page=1):
-    page = int(page)
+def inbox(request, account_slug=None):
     profile = request.user.get_profile()
     accounts = profile.accounts.all()
     if account_slug is not None:
@@ -26,27 +109,15 @@ def inbox(request, account_slug=None, page=1):
                                  'fill in the form below'))
         return redirect(reverse('add_account'))
 
-    inboxes = Mailbox.objects.filter(imap__account__in=accounts,
-                                     folder_type=INBOX).values_list('id',
-                                                                    flat=True)
-    total = Thread.objects(mailboxes__in=inboxes).count()
-    begin = (page - 1) * 50
-    end = min(total, begin + 50)
-
-    threads = Thread.objects(mailboxes__in=inboxes)[begin:end]
-    directory = profile.get_directory(inboxes[0])
-    context = {
+    inboxes = list(Mailbox.objects.filter(imap__account__in=accounts,
+                                          folder_type=INBOX).values_list(
+                                              'id', flat=True))
+    context = _listing(request, inboxes, reverse('inbox'))
+    context.update({
         'unified': True,
-        'directory': directory,
-        'threads': threads,
-        'begin': begin + 1,
-        'end': end,
-        'total': total,
-    }
-    if total > end:
-        context['next_url'] = reverse('inbox', args=[page+1])
-    if page > 1:
-        context['previous_url'] = reverse('inbox', args=[page-1])
+        'directory': profile.get_directory(inboxes[0]),
+        'labels': _label_threads(context['threads'], unified=True),
+    })
     return render(request, 'mail.html', context)
 
 
@@ -57,32 +128,130 @@ def compose(request):
 
 
 @login_required
-def directory(request, mbox_id, page=1):
+def directory(request, mbox_id):
     mbox_id = int(mbox_id)
-    page = int(page)
+    # Filter with user profile to be sure you are looking at your mails !
+    # TODO Replace account's id with something more fashion
+    directory = request.user.get_profile().get_directory(mbox_id)
+    context = _listing(request, [mbox_id],
+                       reverse('directory', args=[mbox_id]))
+    context.update({
+        'directory': directory,
+        'labels': _label_threads(context['threads'], directory=directory),
+    })
+    return render(request, 'mail.html', context)
+
 
-    total = Thread.objects(mailboxes=mbox_id).count()
+@login_required
+def search(request):
+    query = request.GET.get('q', '')
+    try:
+        page = max(int(request.GET.get('page', 1)), 1)
+    except ValueError:
+        page = 1
+    profile = request.user.get_profile()
+    mailboxes = Mailbox.objects.filter(imap__account__profile=profile)
+
+    if request.GET.get('server'):
+        # Searched in the background, see mail.search
+        if search_server(mailboxes, query):
+            messages.info(request, _('The inboxes are being searched on the '
+                                     'server, more conversations may show '
+                                     'up in a moment.'))
+        return redirect('%s?%s' % (reverse('search'), urlencode({
+            'q': query.encode('utf-8')})))
+
+    threads = search_threads(mailboxes, query)
+    total = threads.count()
+    # Past the last page (stale link, fewer results), the last one is shown
+    page = min(page, max(1, (total + 49) // 50))
     begin = (page - 1) * 50
     end = min(total, begin + 50)
 
-    threads = Thread.objects(mailboxes=mbox_id)[begin:end]
-    # Filter with user profile to be sure you are looking at your mails !
-    # TODO Replace account's id with something more fashion
-    directory = request.user.get_profile().get_directory(mbox_id)
+    threads = list(threads.only(*Thread.SUMMARY_FIELDS)[begin:end])
     context = {
-        'directory': directory,
+        'unified': True,
+        'query': query,
         'threads': threads,
+        'labels': _label_threads(threads, unified=True),
+        'bulk_form': BulkActionForm(profile),
         'begin': begin + 1,
         'end': end,
         'total': total,
     }
+    params = {'q': query.encode('utf-8')}
     if total > end:
-        context['next_url'] = reverse('directory',
-                                      args=[mbox_id, page+1])
+        params['page'] = page + 1
+        context['next_url'] = '%s?%s' % (reverse('search'), urlencode(params))
     if page > 1:
-        context['previous_url'] = reverse('directory',
-                                          args=[mbox_id, page-1])
-    return render(request, 'mail.html', context)
+        params['page'] = page - 1
+        context['previous_url'] = '%s?%s' % (reverse('search'),
+                                             urlencode(params))
+    return render(request, 'search.html', context)
+
+
+@login_required
+def bulk_action(request):
+    """
+    Applies an action to the threads checked in a listing. Flag changes are
+    written behind (see mail.outbox). For moves and deletions, the threads
+    are grouped by account and each account gets a single job (see
+    mail.actions).
+    """
+    next_url = request.POST.get('next', '')
+    if not next_url.startswith('/'):
+        next_url = reverse('inbox')
+    if request.method != 'POST':
+        return redirect(next_url)
+
+    profile = request.user.get_profile()
+    form = BulkActionForm(profile, data=request.POST)
+    ids = []
+    for key in request.POST.keys():
+        match = CHECKBOX_RE.match(key)
+        if match is not None:
+            ids.append(match.group(1))
+    if not ids:
+        messages.info(request, _('No conversation selected'))
+        return redirect(next_url)
+    if not form.is_valid():
+        messages.error(request, _('Unable to apply the action'))
+        return redirect(next_url)
+
+    action = form.cleaned_data['action']
+    destination = form.cleaned_data['destination']
+    accounts = dict(Mailbox.objects.filter(
+        imap__account__profile=profile).values_list('id', 'imap'))
+    threads = Thread.objects(id__in=ids, mailboxes__in=accounts.keys())
+    if action in (READ, UNREAD):
+        # Written behind, see mail.outbox
+        threads = list(threads.only('mailboxes', 'messages'))
+        mark_read(threads, read=action == READ)
+        messages.success(request, _('%(count)s conversation(s) updated') % {
+            'count': len(threads)})
+        return redirect(next_url)
+
+    groups = {}
+    for thread in threads.only('mailboxes'):
+        for mbox_id in thread.mailboxes:
+            if mbox_id in accounts:
+                groups.setdefault(accounts[mbox_id], []).append(
+                    str(thread.id))
+                break
+    if destination is not None:
+        # Threads are only moved within their account
+        imap_id = accounts[destination]
+        groups = {imap_id: groups.get(imap_id, [])}
+
+    count = 0
+    for imap_id, thread_ids in groups.items():
+        if thread_ids:
+            enqueue(ACTION, imap_id, threads=thread_ids, action=action,
+                    destination=destination)
+            count += len(thread_ids)
+    messages.success(request, _('%(count)s conversation(s) will be '
+                                'updated shortly') % {'count': count})
+    return redirect(next_url)
 
 
 @login_required
@@ -98,12 +267,12 @@ def message(request, mbox_id, uid):
         mailboxes = Mailbox.objects.filter(imap=mailbox.imap)
         action = request.POST.get('action', None)
         if action == 'unread':
-            thread.mark_as_unread()
+            mark_read([thread], read=False)
             messages.success(request, _('The conversation has been marked as'
                                         ' new'))
 
         if action == 'delete':
-            thread.delete_from_imap()
+            enqueue(ACTION, mailbox.imap, thread=thread, action='delete')
             messages.success(request, _('The conversation has been '
                                         'successfully deleted'))
 
@@ -111,7 +280,8 @@ def message(request, mbox_id, uid):
             form = MoveForm(mailbox.imap, data=request.POST)
             if form.is_valid():
                 dest = mailboxes.get(pk=form.cleaned_data['destination'])
-                thread.move_to(dest.name)
+                enqueue(ACTION, mailbox.imap, thread=thread, action='move',
+                        destination=dest.pk)
                 messages.success(request, _('The conversation has been '
                                             'successfully moved to '
                                             '"%s"' % dest.name))
@@ -119,17 +289,94 @@ def message(request, mbox_id, uid):
                 messages.error(request, _('Unable to move the conversation'))
         return redirect(reverse('directory', args=[mbox_id]))
 
-    thread.fetch_missing()
+    # The content is downloaded in the background, the page refreshes
+    # itself until it's there.
+    thread.load_bodies()
+    fetching = bool(thread.find_missing())
+    if fetching:
+        enqueue(FETCH, mailbox.imap, thread=thread)
+    thread.messages.sort(key=lambda m: m.date)
+    _label_threads([thread])
     context = {
         'directory': mailbox,
         'thread': thread,
+        'fetching': fetching,
         'move_form': MoveForm(mailbox.imap, exclude=directory),
         'unread_form': ActionForm('unread'),
         'delete_form': ActionForm('delete'),
     }
     response = render(request, 'message.html', context)
-    if not thread.read:
-        thread.mark_as_read()
+    # Marked once rendered, the unread messages are displayed as such
+    mark_read([thread])
+    return response
+
+
+@login_required
+def attachment(request, mbox_id, uid, message_id, part):
+    """
+    Streams an attachment from the IMAP server, decoding it on the fly.
+
+    Single byte ranges are supported. For parts sent as is (7bit, 8bit or
+    binary) the range is fetched from the server directly. For parts
+    encoded in base64 or quoted-printable, the decoded size is unknown: the
+    part is decoded from the start and open-ended ranges are ignored.
+    """
+    profile = request.user.get_profile()
+    mailbox = profile.get_directory(mbox_id)
+    thread = Thread.objects.get(id=uid)
+    for message in thread.messages:
+        if message.oid == message_id:
+            break
+    else:
+        raise Http404
+    attachment = message.get_attachment(part)
+    if attachment is None or mailbox.id not in message.mailboxes:
+        raise Http404
+
+    identity = attachment.encoding not in ('base64', 'quoted-printable')
+    start = 0
+    end = None
+    status = 200
+    match = RANGE_RE.match(request.META.get('HTTP_RANGE', ''))
+    if match is not None:
+        start = int(match.group(1))
+        if match.group(2):
+            end = int(match.group(2))
+        if identity:
+            if start >= attachment.size or (end is not None and end < start):
+                response = HttpResponse(status=416)
+                response['Content-Range'] = 'bytes */%s' % attachment.size
+                return response
+            end = min(end is None and attachment.size or end,
+                      attachment.size - 1)
+            status = 206
+        elif end is not None and end >= start:
+            status = 206
+        else:
+            start, end = 0, None
+
+    imap_uid = message.get_uid(mailbox.id)
+    if identity:
+        length = end is not None and end - start + 1 or None
+        chunks = mailbox.stream_part(imap_uid, part, offset=start,
+                                     length=length)
+        content = decode_stream(chunks, attachment.encoding)
+    else:
+        chunks = mailbox.stream_part(imap_uid, part)
+        content = decode_stream(chunks, attachment.encoding, start, end)
+
+    response = HttpResponse(content, content_type=attachment.content_type,
+                            status=status)
+    filename = (attachment.filename or 'attachment').encode('utf-8')
+    response['Content-Disposition'] = 'attachment; filename="%s"' % (
+        filename.replace('"', ''))
+    response['Accept-Ranges'] = 'bytes'
+    if identity:
+        response['Content-Length'] = (end is None and attachment.size or
+                                      end + 1) - start
+    if status == 206:
+        response['Content-Range'] = 'bytes %s-%s/%s' % (
+            start, end, identity and attachment.size or '*')
     return response
 
 
@@ -139,7 +386,7 @@ def check_mail(request):
     accounts = get_list_or_404(IMAP, account__profile=profile)
 
     for account in accounts:
-        account.check_mail()
+        enqueue(CHECK, account)
     # TODO make sure the 'from' field is safe
     return redirect(request.GET.get('from', reverse('inbox')))
 
@@ -159,5 +406,5 @@ def check_directory(request, mbox_id=None):
         url = reverse('directory', args=[mbox_id])
 
     for directory in directories:
-        directory.update_messages()
+        enqueue(UPDATE, directory.imap_id, mailbox=directory)
     return redirect(url)
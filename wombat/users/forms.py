@@ -20,6 +20,10 @@ class ProfileForm(forms.ModelForm):
         model = Profile
         exclude = ('user',)
 
+    def __init__(self, *args, **kwargs):
+        super(ProfileForm, self).__init__(*args, **kwargs)
+        self.initial['page_size'] = self.instance.get_page_size()
+
 
 class IMAPForm(forms.ModelForm):
     class Meta:
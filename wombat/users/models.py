@@ -2,13 +2,17 @@
 
 from django.conf import settings
 from django.contrib.auth.models import User
+from django.core.cache import cache
 from django.db import models
 from django.http import Http404
-from django.shortcuts import get_object_or_404
 from django.template.defaultfilters import slugify
 from django.utils.translation import ugettext_lazy as _
 
 from mail.models import Mailbox, IMAP, SMTP, NORMAL
+from mail.sidebar import sidebar_key
+
+# The page sizes used to be stored as their position in the choices
+OLD_PAGE_SIZES = {0: 50, 1: 100}
 
 
 class Profile(models.Model):
@@ -20,12 +24,22 @@ class Profile(models.Model):
     language = models.CharField(_('Language'), max_length=5,
                                 choices=settings.LANGUAGES)
     page_size = models.PositiveIntegerField(_('Page size'), default=50,
-                                            choices=((0, 50), (1, 100)))
+                                            choices=((50, 50), (100, 100)))
     signature = models.TextField(_('Signature'), max_length=200, blank=True)
 
     def __unicode__(self):
         return u'%s\'s profile' % self.user
 
+    def save(self, *args, **kwargs):
+        self.page_size = self.get_page_size()
+        super(Profile, self).save(*args, **kwargs)
+
+    def get_page_size(self):
+        """
+        Number of threads per page, the old stored values are translated.
+        """
+        return OLD_PAGE_SIZES.get(self.page_size, self.page_size)
+
     def _get_emails(self):
         return [a.email for a in self.accounts.all()]
 
@@ -33,10 +47,9 @@ class Profile(models.Model):
 
     def get_directory(self, id):
         """ Return user's IMAP directory matching the id """
-        mailbox = get_object_or_404(Mailbox, id=id)
-        if mailbox.imap.account in self.accounts.all():
-            return mailbox
-        else:
+        try:
+            return Mailbox.objects.get(id=id, imap__account__profile=self)
+        except Mailbox.DoesNotExist:
             raise Http404(_("Directory not found"))
 
 
@@ -94,3 +107,10 @@ def account_pre_save(sender, instance, **kwargs):
     instance.slug = slugify(instance.name)
 
 models.signals.pre_save.connect(account_pre_save, sender=Account)
+
+
+def account_changed(sender, instance, **kwargs):
+    cache.delete(sidebar_key(instance.profile_id))
+
+models.signals.post_save.connect(account_changed, sender=Account)
+models.signals.post_delete.connect(account_changed, sender=Account)